@@ -0,0 +1,198 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+import config
+from metrics.metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Take the tokens if they are there, otherwise return how long until they will be."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+
+class KeyedRateLimiter:
+    """One token bucket per key, the least recently seen keys are forgotten past max_keys."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 10000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def try_acquire(self, key: str) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+
+class AdmissionTicket:
+    def __init__(self, controller: "AdmissionController", session_id: Optional[str]):
+        self._controller = controller
+        self._session_id = session_id
+        self._released = False
+
+    def release(self):
+        # called by the stream when it ends and by the response once it is sent, whichever comes first
+        if not self._released:
+            self._released = True
+            self._controller._release(self._session_id)
+
+
+class AdmissionController:
+    """Caps the graph runs in flight; the requests over the cap wait in a bounded queue or are turned away."""
+
+    def __init__(self,
+                 max_in_flight: int = config.ADMISSION_MAX_IN_FLIGHT,
+                 max_queue: int = config.ADMISSION_MAX_QUEUE,
+                 queue_timeout: float = config.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                 max_batch_in_flight: int = config.BATCH_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_batch_in_flight = min(max_batch_in_flight, max_in_flight)
+        self.in_flight = 0
+        self.queued = 0
+        self.batch_in_flight = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._batch_slots = asyncio.Semaphore(self.max_batch_in_flight)
+        self._session_runs: Dict[str, int] = {}
+        self.session_limiter = KeyedRateLimiter(config.SESSION_REQUESTS_PER_MINUTE, config.SESSION_BURST) \
+            if config.SESSION_REQUESTS_PER_MINUTE > 0 else None
+        self.client_limiter = KeyedRateLimiter(config.CLIENT_REQUESTS_PER_MINUTE, config.CLIENT_BURST) \
+            if config.CLIENT_REQUESTS_PER_MINUTE > 0 else None
+        ADMISSION_IN_FLIGHT.set(0)
+        ADMISSION_QUEUE_DEPTH.set(0)
+
+    def _reject(self, status_code: int, reason: str, retry_after: float):
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        raise AdmissionRejected(status_code, reason, retry_after)
+
+    def _check_rates(self, client: str, session_id: Optional[str] = None):
+        for limiter, key, reason in ((self.client_limiter, client, "client_rate"),
+                                     (self.session_limiter, session_id, "session_rate")):
+            if limiter is not None and key is not None:
+                retry_after = limiter.try_acquire(key)
+                if retry_after:
+                    self._reject(429, reason, retry_after)
+
+    async def admit(self, session_id: str, client: str) -> AdmissionTicket:
+        # the cheap checks come first, a rejected request never takes a queue position
+        if 0 < config.SESSION_MAX_IN_FLIGHT <= self._session_runs.get(session_id, 0):
+            self._reject(429, "session_busy", config.ADMISSION_RETRY_AFTER_SECONDS)
+        self._check_rates(client, session_id)
+        if not self._slots.locked():
+            # a free slot is taken without suspending, so concurrent requests can not all see it free
+            await self._slots.acquire()
+            self._session_runs[session_id] = self._session_runs.get(session_id, 0) + 1
+        else:
+            if self.queued >= self.max_queue:
+                self._reject(503, "queue_full", config.ADMISSION_RETRY_AFTER_SECONDS)
+            await self._wait_for_slot(session_id)
+
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        return AdmissionTicket(self, session_id)
+
+    def admit_batch(self, client: str):
+        """A batch request counts as one request of its client, its runs are admitted one by one."""
+        self._check_rates(client)
+
+    async def admit_batch_run(self) -> AdmissionTicket:
+        """Slot for one graph run of a batch.
+
+        Batch runs wait for a slot for as long as it takes instead of being turned away, but no more than
+        max_batch_in_flight of them hold or wait for one, so the other slots stay free for /stream.
+        """
+        await self._batch_slots.acquire()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            self._batch_slots.release()
+            raise
+        self.batch_in_flight += 1
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        return AdmissionTicket(self, None)
+
+    async def _wait_for_slot(self, session_id: str):
+        self._session_runs[session_id] = self._session_runs.get(session_id, 0) + 1
+        self.queued += 1
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._forget_session_run(session_id)
+            self._reject(503, "queue_timeout", config.ADMISSION_RETRY_AFTER_SECONDS)
+        except BaseException:
+            self._forget_session_run(session_id)
+            raise
+        finally:
+            self.queued -= 1
+            ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+    def _forget_session_run(self, session_id: str):
+        runs = self._session_runs.get(session_id, 0) - 1
+        if runs > 0:
+            self._session_runs[session_id] = runs
+        else:
+            self._session_runs.pop(session_id, None)
+
+    def _release(self, session_id: Optional[str]):
+        if session_id is None:
+            self.batch_in_flight -= 1
+            self._batch_slots.release()
+        else:
+            self._forget_session_run(session_id)
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        self._slots.release()
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "queued": self.queued, "batch_in_flight": self.batch_in_flight,
+                "max_in_flight": self.max_in_flight, "max_queue": self.max_queue,
+                "max_batch_in_flight": self.max_batch_in_flight}
+
+
+_upstream_limiters: Dict[str, Optional[InMemoryRateLimiter]] = {}
+
+
+def get_upstream_rate_limiter(upstream: str) -> Optional[InMemoryRateLimiter]:
+    """Token bucket shared by every call to the upstream ("llm" or "search") made by this process."""
+    if upstream not in _upstream_limiters:
+        rate, burst = {
+            "llm": (config.LLM_REQUESTS_PER_SECOND, config.LLM_BURST),
+            "search": (config.SEARCH_REQUESTS_PER_SECOND, config.SEARCH_BURST),
+        }[upstream]
+        _upstream_limiters[upstream] = InMemoryRateLimiter(
+            requests_per_second=rate, check_every_n_seconds=0.05, max_bucket_size=burst
+        ) if rate > 0 else None
+    return _upstream_limiters[upstream]
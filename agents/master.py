@@ -1,16 +1,26 @@
 import aiosqlite
+import asyncio
 from dotenv import load_dotenv
 import json
+import logging
 
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, ToolMessage
-from langchain_core.output_parsers import StrOutputParser
+import config as settings
+
+from langchain_core.callbacks import adispatch_custom_event
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, ToolMessage, message_chunk_to_message
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.constants import END
 
-from agents.websearchagent.websearchagent import WebSearchAgent
+from agents.router import get_router, SMALLTALK, WEBSEARCH
+from agents.websearchagent.answer_cache import get_cached_answer, is_cacheable
+from agents.websearchagent.websearchagent import get_websearch_agent, needs_rewrite, search_messages, \
+    split_query_and_history
+from deadline.deadline import answer_budget, first_chunk_within
+from llm.llm import LLMFactory
+from metrics.metrics import DEADLINE_DEGRADATIONS
 
 import operator
 from typing import TypedDict, Annotated, List
@@ -23,10 +33,38 @@ from typing_extensions import TypedDict
 from langchain_core.prompts import ChatPromptTemplate
 
 
+logger = logging.getLogger(__name__)
+
+# reply of a run whose conversation agent did not answer before the deadline
+REPLY_TIMEOUT_MESSAGE = "Sorry, I could not reply in time. Please try again."
+
+
 class ChatState(BaseModel):
     messages: Annotated[List[BaseMessage], add_messages] = []
 
 
+async def answer_before_run(agent, query: str, config: RunnableConfig):
+    """Cached answer of a question that is searched as asked, looked up before the graph runs.
+
+    On a hit the turn is written to the conversation as if the web search agent had answered it, and
+    `config` records the lookup so that the web search agent does not repeat it on a miss.
+    """
+    question = query.strip()
+    if not is_cacheable(question):
+        return None
+    state = await agent.aget_state(config)
+    _, history_msgs = split_query_and_history(state.values.get("messages", []) + [HumanMessage(content=query)])
+    if needs_rewrite(question, history_msgs):
+        return None
+    cached = await get_cached_answer(question, LLMFactory.model_for_node("chat_response", config))
+    if cached is None:
+        config["configurable"]["answer_cache_checked"] = question
+        return None
+    await agent.aupdate_state(config, {"messages": [HumanMessage(content=query), AIMessage(content=cached["answer"])]},
+                              as_node="websearcheagent")
+    return cached
+
+
 @tool
 def websearchtool():
     """Call to pass the request to web search agent"""
@@ -37,29 +75,38 @@ def get_route(state: ChatState):
     messages_list = state.messages
     last_msg = messages_list[-1]
     if isinstance(last_msg, AIMessage) and last_msg.tool_calls:
-        print(last_msg.tool_calls)
+        logger.debug("tool calls: %s", last_msg.tool_calls)
         # implement a factory for getting the agent from the tool
         return "websearcheagent"
     #     if master agent wants to reply to user directly from here last message in list would be of assistant's
     return END
 
 
+def route_message(state: ChatState):
+    # clear search intents and small talk skip the tool calling round trip of the conversation agent
+    last_msg = state.messages[-1]
+    route = get_router().classify(last_msg.content) if isinstance(last_msg, HumanMessage) else None
+    if route == WEBSEARCH:
+        return "websearcheagent"
+    if route == SMALLTALK:
+        return "smalltalk"
+    return "converstationagent"
+
+
 async def call_websearchagent(state: ChatState, config: RunnableConfig):
-    websearchagent = WebSearchAgent().get_agent()
-    print("Calling websearch agent")
-    resp = await websearchagent.ainvoke({"messages": state.messages}, config)
-    print(resp)
+    websearchagent = get_websearch_agent()
+    logger.debug("calling websearch agent")
+    resp = await websearchagent.ainvoke({"messages": search_messages(state.messages)}, config)
     return {"messages": [AIMessage(content=resp['search_result'])]}
 
 
-async def converse(state: ChatState, config: RunnableConfig):
-    sys_prompt = """
+SYSTEM_PROMPT = """
     You are Ross, an AI agent.
     
     Your primary goal is to help user search the internet. Your tone is friendly and helpful, and you should adapt to the context to make the user feel comfortable.
     """
 
-    prompt = """
+CONVERSE_PROMPT = """
         Go through the conversation carefully and respond while keeping the below rules in mind:
 
         1. If user is engaging in smalltalk then engage in a new topic to keep the conversation flowing or conclude it politely. 
@@ -73,46 +120,76 @@ async def converse(state: ChatState, config: RunnableConfig):
         Your response:
         """
 
-    prompt_template = ChatPromptTemplate.from_messages(
-        [("system", sys_prompt), ("user", prompt)]
-    )
+SMALLTALK_PROMPT = """
+        Go through the conversation carefully and reply to the last message. The user is engaging in smalltalk,
+        engage in a new topic to keep the conversation flowing or conclude it politely.
+           - Example: “It’s always nice chatting with you! Is there anything else you’d like to discuss?” 
+
+        ### Conversation:
+        {conversation}
+        
+        Your response:
+        """
 
-    parser = StrOutputParser()
 
-    model = ChatOpenAI(
-        model="gpt-4o",
-        temperature=0,
-        max_tokens=None,
-        timeout=None,
-        max_retries=2,
-    ).bind_tools([websearchtool])
+async def reply(state: ChatState, config: RunnableConfig, node: str, prompt: str, model) -> dict:
+    prompt_template = ChatPromptTemplate.from_messages(
+        [("system", SYSTEM_PROMPT), ("user", prompt)]
+    )
 
     chain = prompt_template | model
 
-    conversation = "\n".join(f"{msg.type}: {msg.content}" for msg in state.messages)
+    recent_messages = state.messages[-settings.MASTER_HISTORY_MAX_MESSAGES:]
+    conversation = "\n".join(
+        f"{msg.type}: {msg.content[:settings.MASTER_HISTORY_MAX_CHARS_PER_MESSAGE]}" for msg in recent_messages
+    )
 
-    conv_resp = await chain.ainvoke({"conversation": conversation}, config)
-    print("resp", conv_resp)
+    # like the answer of the web search agent, the reply has to start within what is left of the deadline
+    try:
+        chunks = [chunk async for chunk in first_chunk_within(chain.astream({"conversation": conversation}, config),
+                                                            answer_budget(config))]
+        conv_resp = message_chunk_to_message(sum(chunks[1:], chunks[0])) if chunks else AIMessage(content="")
+    except asyncio.TimeoutError:
+        logger.warning("conversation agent did not reply before the deadline")
+        DEADLINE_DEGRADATIONS.inc(node=node)
+        conv_resp = AIMessage(content=REPLY_TIMEOUT_MESSAGE)
+        await adispatch_custom_event("fallback_answer", {"answer": REPLY_TIMEOUT_MESSAGE}, config=config)
+    logger.debug("conversation agent response: %s", conv_resp)
 
     return {"messages": [conv_resp]}
 
 
+async def converse(state: ChatState, config: RunnableConfig):
+    model = LLMFactory().get_llm_for_node("converstationagent", config).bind_tools([websearchtool])
+    return await reply(state, config, "converstationagent", CONVERSE_PROMPT, model)
+
+
+async def smalltalk(state: ChatState, config: RunnableConfig):
+    # greetings and thanks never need the web search tool, they are answered by the cheap model without it
+    model = LLMFactory().get_llm_for_node("smalltalk", config)
+    return await reply(state, config, "smalltalk", SMALLTALK_PROMPT, model)
+
+
 _ = load_dotenv()
 
 
 class Master:
-    def __init__(self):
-        conn = aiosqlite.connect("master_checkpoints.sqlite", check_same_thread=False)
-        self.memory = AsyncSqliteSaver(conn)
+    def __init__(self, checkpointer: BaseCheckpointSaver = None):
+        if checkpointer is None:
+            conn = aiosqlite.connect(settings.CHECKPOINT_SQLITE_PATH, check_same_thread=False)
+            checkpointer = AsyncSqliteSaver(conn)
+        self.memory = checkpointer
 
         master = StateGraph(ChatState)
         master.add_node("converstationagent", converse)
         master.add_node("websearcheagent", call_websearchagent)
+        master.add_node("smalltalk", smalltalk)
 
         master.add_conditional_edges("converstationagent", get_route, ["websearcheagent", END])
         master.add_edge("websearcheagent", END)
+        master.add_edge("smalltalk", END)
         # master.add_edge("converstationagent", END)
-        master.set_entry_point("converstationagent")
+        master.set_conditional_entry_point(route_message, ["converstationagent", "websearcheagent", "smalltalk"])
 
         self.master_agent = master.compile(checkpointer=self.memory)
 
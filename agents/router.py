@@ -0,0 +1,53 @@
+import re
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import config
+
+WEBSEARCH = "websearch"
+SMALLTALK = "smalltalk"
+
+SMALLTALK_RE = re.compile(
+    r"^(hi|hii+|hello|hey|yo|thanks|thank you|thx|good (morning|afternoon|evening|night)|bye|goodbye|see you|"
+    r"how are you|how's it going|who are you|what's up|whats up|ok|okay|cool|nice|great|awesome|lol)\b"
+)
+SEARCH_KEYWORDS_RE = re.compile(
+    r"\b(search|look up|google|find|latest|news|today|price|prices|weather|forecast|compare|vs|versus|"
+    r"how to|how much|how many|score|release|review|reviews|19\d\d|20\d\d)\b"
+)
+QUESTION_RE = re.compile(r"^(what|who|whom|when|where|which|how|why|is|are|does|do|did|can|could|will|should)\b")
+# questions about the assistant itself are better answered by the conversation agent
+ABOUT_ASSISTANT_RE = re.compile(r"\b(you|your|yourself|ross)\b")
+
+
+class Router(ABC):
+    @abstractmethod
+    def classify(self, message: str) -> Optional[str]:
+        """Return WEBSEARCH or SMALLTALK, or None when the master llm has to decide."""
+        ...
+
+
+class KeywordRouter(Router):
+    def classify(self, message: str) -> Optional[str]:
+        text = re.sub(r"\s+", " ", message.strip().lower())
+        words = text.split(" ")
+        if SMALLTALK_RE.match(text) and len(words) <= 6:
+            return SMALLTALK
+        if SEARCH_KEYWORDS_RE.search(text):
+            return WEBSEARCH
+        if QUESTION_RE.match(text) and len(words) >= 3 and not ABOUT_ASSISTANT_RE.search(text):
+            return WEBSEARCH
+        return None
+
+
+class LLMRouter(Router):
+    """Leaves every decision to the master llm."""
+
+    def classify(self, message: str) -> Optional[str]:
+        return None
+
+
+def get_router() -> Router:
+    if config.ROUTER == "llm":
+        return LLMRouter()
+    return KeywordRouter()
@@ -0,0 +1,50 @@
+import hashlib
+import re
+from typing import List, Optional
+
+import config
+from cache.cache import CacheBackend, get_cache
+from metrics.metrics import ANSWER_CACHE_LOOKUPS
+from schemas import QueryPlan, SingleStepResults
+from search.search import normalize_query
+
+BYPASS_RE = re.compile(config.ANSWER_CACHE_BYPASS_PATTERN, re.IGNORECASE) if config.ANSWER_CACHE_BYPASS_PATTERN \
+    else None
+
+
+def get_answer_cache() -> CacheBackend:
+    return get_cache("answers", config.ANSWER_CACHE_TTL_SECONDS, config.ANSWER_CACHE_MAX_SIZE)
+
+
+def answer_cache_key(query: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\n{normalize_query(query)}".encode()).hexdigest()
+
+
+def is_cacheable(query: str) -> bool:
+    # questions about what is happening now must not be answered from an earlier run
+    return config.ANSWER_CACHE_ENABLED and not (BYPASS_RE is not None and BYPASS_RE.search(query))
+
+
+async def get_cached_answer(query: str, model: str) -> Optional[dict]:
+    cached = await get_answer_cache().get(answer_cache_key(query, model))
+    ANSWER_CACHE_LOOKUPS.inc(outcome="miss" if cached is None else "hit")
+    return cached
+
+
+async def store_answer(query: str, model: str, plan: QueryPlan, step_results: List[SingleStepResults], answer: str):
+    # answers of runs cut short by the deadline or without any search result are not worth repeating
+    if not is_cacheable(query) or not answer or len(step_results) < len(plan.steps) \
+            or not any(step_result.results for step_result in step_results):
+        return
+    # what the replayed stream shows: the plan, the sources of every step and the answer
+    sources = [{"step_id": step.id, "step": step.step,
+                "results": [{"url": result.url, "content": result.content[:config.SOURCE_SNIPPET_MAX_CHARS]}
+                            for result in step_result.results]}
+               for step, step_result in zip(plan.steps, step_results)]
+    await get_answer_cache().set(answer_cache_key(query, model), {
+        "query": query,
+        "model": model,
+        "plan": plan.model_dump(),
+        "sources": sources,
+        "answer": answer,
+    })
@@ -0,0 +1,108 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from schemas import PageContent, SearchResult, SingleStepResults
+
+TOKEN_RE = re.compile(r"\w+")
+# content shingles overlapping more than this are treated as the same passage
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for english text, close enough for budgeting without loading a tokenizer
+    return len(text) // 4 + 1
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip().lower())
+    host = parts.netloc.removeprefix("www.")
+    return f"{host}{parts.path.rstrip('/')}?{parts.query}"
+
+
+def _shingles(tokens: List[str], size: int = 3) -> set:
+    return {" ".join(tokens[i:i + size]) for i in range(max(len(tokens) - size + 1, 1))}
+
+
+def dedupe_results(results: List[Tuple[int, SearchResult]]) -> List[Tuple[int, SearchResult]]:
+    seen_urls = set()
+    kept, kept_shingles = [], []
+    for step_idx, result in results:
+        url = normalize_url(result.url)
+        if url in seen_urls:
+            continue
+        shingles = _shingles(tokenize(result.content))
+        if any(len(shingles & other) / len(shingles | other) > NEAR_DUPLICATE_THRESHOLD for other in kept_shingles):
+            continue
+        seen_urls.add(url)
+        kept.append((step_idx, result))
+        kept_shingles.append(shingles)
+    return kept
+
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    docs_tokens = [tokenize(doc) for doc in documents]
+    if not docs_tokens:
+        return []
+    avg_len = sum(len(tokens) for tokens in docs_tokens) / len(docs_tokens) or 1.0
+    doc_freq = Counter(token for tokens in docs_tokens for token in set(tokens))
+    query_tokens = set(tokenize(query))
+
+    scores = []
+    for tokens in docs_tokens:
+        term_freq = Counter(tokens)
+        score = 0.0
+        for token in query_tokens:
+            if token not in term_freq:
+                continue
+            idf = math.log(1 + (len(docs_tokens) - doc_freq[token] + 0.5) / (doc_freq[token] + 0.5))
+            tf = term_freq[token]
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg_len))
+        scores.append(score)
+    return scores
+
+
+def select_context(step_results: List[SingleStepResults], query: str, token_budget: int) -> List[SingleStepResults]:
+    """Deduplicate the results of the steps, rank them against the query and keep what fits the token budget.
+
+    Steps keep their order, results inside a step are ordered by relevance.
+    """
+    candidates = dedupe_results(
+        [(step_idx, result) for step_idx, step_result in enumerate(step_results) for result in step_result.results]
+    )
+    scores = bm25_scores(query, [f"{result.url} {result.content}" for _, result in candidates])
+    ranked = sorted(zip(scores, range(len(candidates))), key=lambda x: (-x[0], x[1]))
+
+    selected = [[] for _ in step_results]
+    used_tokens = sum(estimate_tokens(f"Step: {x.step}\n Context: ") for x in step_results)
+    for _, candidate_idx in ranked:
+        step_idx, result = candidates[candidate_idx]
+        tokens = estimate_tokens(str(result))
+        if used_tokens + tokens > token_budget:
+            continue
+        used_tokens += tokens
+        selected[step_idx].append(result)
+
+    return [SingleStepResults(step=step_result.step, results=results)
+            for step_result, results in zip(step_results, selected)]
+
+
+def attach_page_chunks(results: List[SearchResult], pages: Dict[str, PageContent], query: str,
+                       chunks_per_page: int) -> List[SearchResult]:
+    # the chunks of a fetched page closest to the query replace its search snippet, in page order
+    attached = []
+    for result in results:
+        page = pages.get(result.url)
+        if page is None:
+            attached.append(result)
+            continue
+        scores = bm25_scores(query, page.chunks)
+        best = sorted(sorted(range(len(page.chunks)), key=lambda idx: -scores[idx])[:chunks_per_page])
+        attached.append(SearchResult(url=result.url, content="\n".join(page.chunks[idx] for idx in best)))
+    return attached
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import uuid
+from typing import Dict, Optional, Tuple
+
+import config
+from metrics.metrics import SPECULATIVE_SEARCHES
+from search.search import search_query
+
+logger = logging.getLogger(__name__)
+
+# speculative searches of the runs in flight in this process, by speculation id. only the id goes
+# into the graph state, the task itself can not be checkpointed
+_searches: Dict[str, Tuple[str, asyncio.Task]] = {}
+# session that started every speculative search, for cancelling the ones of a cancelled run
+_owners: Dict[str, str] = {}
+
+
+def start_speculative_search(query: str, timeout: float = config.SEARCH_TIMEOUT_SECONDS,
+                             owner: Optional[str] = None) -> str:
+    speculation_id = uuid.uuid4().hex
+    _searches[speculation_id] = (query, asyncio.create_task(search_query(query, timeout)))
+    if owner is not None:
+        _owners[speculation_id] = owner
+    # runs that fail or are abandoned before their first step never pick the search up
+    asyncio.get_running_loop().call_later(config.SPECULATIVE_SEARCH_TTL_SECONDS,
+                                          cancel_speculative_search, speculation_id)
+    return speculation_id
+
+
+def take_speculative_search(speculation_id: Optional[str]) -> Optional[Tuple[str, asyncio.Task]]:
+    if speculation_id is None:
+        return None
+    _owners.pop(speculation_id, None)
+    return _searches.pop(speculation_id, None)
+
+
+def cancel_speculative_search(speculation_id: Optional[str]):
+    speculative = take_speculative_search(speculation_id)
+    if speculative is None:
+        return
+    query, task = speculative
+    if not task.done():
+        logger.debug("cancelling unused speculative search: %s", query)
+    task.cancel()
+    SPECULATIVE_SEARCHES.inc(outcome="cancelled")
+
+
+def cancel_speculative_searches(owner: str):
+    for speculation_id in [speculation_id for speculation_id, started_by in _owners.items() if started_by == owner]:
+        cancel_speculative_search(speculation_id)
@@ -1,11 +1,11 @@
 import operator
-from typing import TypedDict, Annotated, List
+from typing import TypedDict, Annotated, List, Dict, Optional
 
 from langchain_core.messages import HumanMessage, BaseMessage
 from langgraph.graph import add_messages
 from pydantic import BaseModel, Field
 
-from schemas import ChatRequest, QueryPlan, StepSearchResultsTracker, SingleStepResults, Message
+from schemas import ChatRequest, QueryPlan, QueryPlanStep, StepSearchResultsTracker, StepResultsRef, Message
 
 
 class WebSearchState(BaseModel):
@@ -13,5 +13,15 @@ class WebSearchState(BaseModel):
     plan: QueryPlan = None
     query: str = None
     search_result: str = None
-    current_step_idx: int = 0
-    search_result_tracker: List[SingleStepResults] = []
+    # keyed by QueryPlanStep.id so parallel steps can finish in any order; the results themselves are in
+    # the result store so that the checkpoints of every superstep stay small
+    search_result_tracker: Annotated[Dict[int, StepResultsRef], operator.or_] = {}
+    # search for the rewritten query started next to plan generation, see speculative.py
+    speculation_id: Optional[str] = None
+
+
+class StepExecutorState(BaseModel):
+    query: str
+    step: QueryPlanStep
+    dependency_results: List[StepResultsRef] = []
+    speculation_id: Optional[str] = None
@@ -1,23 +1,40 @@
-import aiosqlite
+import asyncio
+import logging
+import re
 
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+from langchain_core.callbacks import adispatch_custom_event
+from langchain_core.messages import BaseMessage, HumanMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableConfig
 from langgraph.constants import END
 from langgraph.graph import StateGraph
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
+import config as settings
+from agents.websearchagent.answer_cache import get_cached_answer, is_cacheable, store_answer
+from agents.websearchagent.context import attach_page_chunks, select_context
 from agents.websearchagent.prompts import SUMMARIZE_CHAT_PROMPT, QUERY_PLAN_PROMPT, SEARCH_QUERY_PROMPT, CHAT_PROMPT
-from agents.websearchagent.state import WebSearchState
+from agents.websearchagent.speculative import start_speculative_search, take_speculative_search, \
+    cancel_speculative_search
+from agents.websearchagent.state import WebSearchState, StepExecutorState
+from deadline.deadline import answer_budget, first_chunk_within, is_expired, stage_budget
+from fetch.fetch import get_page_fetcher
+from index.index import get_passage_index
+from llm.cache import cached_ainvoke
 from llm.llm import LLMFactory
-from schemas import ChatRequest, QueryPlan, StepContext, QueryPlanStep, QueryStepExecution, SingleStepResults, \
-    SearchResult
+from metrics.metrics import ANSWER_CACHE_LOOKUPS, DEADLINE_DEGRADATIONS, SPECULATIVE_SEARCHES
+from results.results import get_result_store
+from schemas import QueryPlan, StepContext, QueryPlanStep, QueryStepExecution, SingleStepResults, \
+    SearchResult, StepResultsRef
 
-from tavily import TavilyClient
+from search.search import iter_search_queries, normalize_query
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# reply of a run whose answer could not start before the deadline
+ANSWER_TIMEOUT_MESSAGE = "Sorry, I could not put an answer together in time. Please try again."
 
 class WebSearchAgent:
     def __init__(self):
@@ -27,12 +44,20 @@ class WebSearchAgent:
         workflow = StateGraph(WebSearchState)
         workflow.add_node("summarize_query", rephrase_query_with_history_v0)
         workflow.add_node("generate_plan", generate_plan_v0)
-        workflow.add_node("step_executor", step_executor)
+        workflow.add_node("step_executor", execute_plan)
+        workflow.add_node("direct_search", direct_search)
+        workflow.add_node("lookup_answer", lookup_answer)
         workflow.add_node("chat_response", summarize_results)
 
-        workflow.add_edge("summarize_query", "generate_plan")
+        # a repeated question is replayed from the answer cache, simple lookups skip the planning and
+        # search query generation calls
+        workflow.add_conditional_edges("summarize_query", route_query,
+                                       ["lookup_answer", "direct_search", "generate_plan"])
+        workflow.add_conditional_edges("lookup_answer", route_cached_answer, [END, "direct_search", "generate_plan"])
+        workflow.add_edge("direct_search", "chat_response")
+        # the steps of the plan run concurrently inside one node, each as soon as its own dependencies are done
         workflow.add_edge("generate_plan", "step_executor")
-        workflow.add_conditional_edges("step_executor", check_if_summarize)
+        workflow.add_edge("step_executor", "chat_response")
         workflow.add_edge("chat_response", END)
 
         workflow.set_entry_point("summarize_query")
@@ -43,84 +68,322 @@ class WebSearchAgent:
         return self.graph
 
 
+_websearch_agent = None
+
+
+def get_websearch_agent():
+    # the compiled graph is stateless, one instance is shared by every request
+    global _websearch_agent
+    if _websearch_agent is None:
+        _websearch_agent = WebSearchAgent().get_agent()
+    return _websearch_agent
+
+
 async def rephrase_query_with_history_v0(
         state: WebSearchState,
         config: RunnableConfig
 ):
-    history_msgs = state.messages[:-1]
-    query = state.messages[-1]
-    print(len(state.messages), len(history_msgs))
-    history_str = "\n".join("\n".join(f"{msg.type}: {msg.content}" for msg in history_msgs))
-    model_name = config["configurable"].get("model", "gpt-4o")
-    llm_factory = LLMFactory()
-    llm = llm_factory.get_llm_by_name(model_name)
-    parser = StrOutputParser()
-    prompt_template = ChatPromptTemplate.from_messages(
-        [("user", SUMMARIZE_CHAT_PROMPT)]
+    query, history_msgs = split_query_and_history(state.messages)
+
+    if not needs_rewrite(query.content, history_msgs):
+        return {"query": query.content.strip()}
+
+    # only a bounded window of recent messages goes into the prompt
+    history_msgs = history_msgs[-settings.REWRITE_HISTORY_MAX_MESSAGES:]
+    history_str = "\n".join(
+        f"{msg.type}: {msg.content[:settings.REWRITE_HISTORY_MAX_CHARS_PER_MESSAGE]}" for msg in history_msgs
+    )
+    llm = LLMFactory().get_llm_for_node("summarize_query", config)
+    summarize_prompt = SUMMARIZE_CHAT_PROMPT.format(
+        chat_history=history_str,
+        question=query.content
     )
-    chain = prompt_template | llm | parser
-    question = await chain.ainvoke({
-        'chat_history': history_str,
-        'question': query.content
-    })
+    try:
+        question = await cached_ainvoke(llm, summarize_prompt, runnable_config=config,
+                                        timeout=llm_budget(config))
+    except asyncio.TimeoutError:
+        # past the deadline the question is searched as asked
+        logger.warning("query rewrite timed out, using the question as is")
+        question = query.content.strip()
     return {"query": question}
 
 
-async def generate_plan_v0(state: WebSearchState, config: RunnableConfig):
-    model_name = config["configurable"].get("model", "gpt-4o")
-    llm = LLMFactory().get_llm_by_name(model_name)
+def llm_budget(config: RunnableConfig):
+    return stage_budget(config, settings.LLM_TIMEOUT_SECONDS or None)
+
+
+def split_query_and_history(messages: List[BaseMessage]):
+    # the master agent hands over its tool calling message last, the question is the last user message
+    query_idx = max((idx for idx, msg in enumerate(messages) if isinstance(msg, HumanMessage)),
+                    default=len(messages) - 1)
+    history_msgs = [msg for msg in messages[:query_idx] if msg.content]
+    return messages[query_idx], history_msgs
+
+
+def needs_rewrite(question: str, history_msgs: List[BaseMessage]) -> bool:
+    # first turn or a question that does not refer back to the conversation, nothing to rewrite
+    return bool(history_msgs) and not (settings.REWRITE_SKIP_SELF_CONTAINED and is_self_contained(question))
+
+
+def search_messages(messages: List[BaseMessage]) -> List[BaseMessage]:
+    # the question and the part of the history the rewrite looks at, the rest would only be copied
+    # into every checkpoint of the run
+    query, history_msgs = split_query_and_history(messages)
+    return history_msgs[-settings.REWRITE_HISTORY_MAX_MESSAGES:] + [query]
+
+
+# words that usually point back to something said earlier in the conversation
+FOLLOW_UP_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "him", "his", "she", "her",
+    "there", "same", "above", "previous", "former", "latter", "else", "more", "also", "again", "another",
+}
+FOLLOW_UP_PREFIXES = ("and ", "what about", "how about", "why", "but ", "so ", "then ", "ok", "okay")
+
+
+def is_self_contained(question: str) -> bool:
+    text = question.strip().lower()
+    words = re.findall(r"[\w']+", text)
+    if len(words) < 4 or text.startswith(FOLLOW_UP_PREFIXES):
+        return False
+    return not any(word in FOLLOW_UP_WORDS for word in words)
+
+
+# questions with several parts or entities whose results have to be combined
+MULTI_PART_RE = re.compile(
+    r"\b(compare|comparison|versus|vs|difference|differences|between|pros|cons|relationship|impact|affect|"
+    r"why|explain|steps|plan|history|timeline)\b|[,;]|\band\b|\bor\b|\?.+\?"
+)
+
+
+def is_simple_query(query: str) -> bool:
+    text = query.strip().lower()
+    words = re.findall(r"[\w']+", text)
+    return 0 < len(words) <= settings.DIRECT_MAX_WORDS and not MULTI_PART_RE.search(text)
 
-    llm = llm.with_structured_output(QueryPlan)
-    query_plan_prompt = QUERY_PLAN_PROMPT.format(query=state.query)
-    plan: QueryPlan = await llm.ainvoke(query_plan_prompt)
 
-    return {"plan": plan}
+def choose_execution_mode(state: WebSearchState):
+    if settings.EXECUTION_MODE == "direct" or (settings.EXECUTION_MODE == "adaptive" and is_simple_query(state.query)):
+        return "direct_search"
+    return "generate_plan"
 
 
-async def step_executor(state: WebSearchState, config: RunnableConfig):
-    model_name = config["configurable"].get("model", "gpt-4o")
-    llm = LLMFactory().get_llm_by_name(model_name)
-    search_query_llm = llm.with_structured_output(QueryStepExecution)
+def route_query(state: WebSearchState, config: RunnableConfig):
+    if not is_cacheable(state.query):
+        if settings.ANSWER_CACHE_ENABLED:
+            ANSWER_CACHE_LOOKUPS.inc(outcome="bypass")
+        return choose_execution_mode(state)
+    # a question searched as asked was already looked up before the run, see answer_before_run
+    if config["configurable"].get("answer_cache_checked") == state.query:
+        return choose_execution_mode(state)
+    return "lookup_answer"
 
-    step: QueryPlanStep = state.plan.steps[state.current_step_idx]
+
+def route_cached_answer(state: WebSearchState):
+    if state.search_result is not None:
+        return END
+    return choose_execution_mode(state)
+
+
+async def lookup_answer(state: WebSearchState, config: RunnableConfig):
+    cached = await get_cached_answer(state.query, LLMFactory.model_for_node("chat_response", config))
+    if cached is None:
+        return None
+    # the server replays the plan, the sources and the answer of the cached run to the client
+    await adispatch_custom_event("cached_answer", cached, config=config)
+    return {"plan": QueryPlan(**cached["plan"]), "search_result": cached["answer"]}
+
+
+async def direct_search(state: WebSearchState, config: RunnableConfig):
+    # a single step plan whose only search query is the rewritten query itself
+    step = QueryPlanStep(id=0, step=state.query, dependencies=[])
+    results = []
+    async for query, query_results in ranked_search_results_and_images_from_queries(
+            step.step, [state.query], timeout=stage_budget(config, settings.SEARCH_TIMEOUT_SECONDS)):
+        results += query_results
+        await adispatch_custom_event("search_results", {
+            "step_id": step.id,
+            "step": step.step,
+            "query": query,
+            "results": query_results,
+        }, config=config)
+
+    results = await fetch_page_content(state.query, results, stage_budget(config, settings.FETCH_BUDGET_SECONDS))
+
+    return {
+        "plan": QueryPlan(steps=[step]),
+        "search_result_tracker": {
+            step.id: await get_result_store().put(SingleStepResults(step=step.step, results=results))
+        },
+    }
+
+
+async def generate_plan_v0(state: WebSearchState, config: RunnableConfig):
+    llm = LLMFactory().get_llm_for_node("generate_plan", config)
+
+    # the rewritten query is usually a good search query on its own, searching it while the plan is
+    # generated takes one search round trip off the first step
+    speculation_id = None
+    if settings.SPECULATIVE_SEARCH:
+        speculation_id = start_speculative_search(state.query, stage_budget(config, settings.SEARCH_TIMEOUT_SECONDS),
+                                                  owner=config["configurable"].get("thread_id"))
+
+    query_plan_prompt = QUERY_PLAN_PROMPT.format(query=state.query)
+    try:
+        plan: QueryPlan = await cached_ainvoke(llm, query_plan_prompt, QueryPlan, runnable_config=config,
+                                               timeout=llm_budget(config))
+    except asyncio.TimeoutError:
+        # out of time for planning, the query is searched as a single step
+        logger.warning("plan generation timed out, falling back to a single step plan")
+        DEADLINE_DEGRADATIONS.inc(node="generate_plan")
+        plan = QueryPlan(steps=[QueryPlanStep(id=0, step=state.query, dependencies=[])])
+    except BaseException:
+        cancel_speculative_search(speculation_id)
+        raise
+
+    if not plan.steps:
+        cancel_speculative_search(speculation_id)
+        speculation_id = None
+
+    return {"plan": plan, "speculation_id": speculation_id}
+
+
+async def execute_step(state: StepExecutorState, config: RunnableConfig) -> StepResultsRef:
+    llm = LLMFactory().get_llm_for_node("step_executor", config)
+
+    step: QueryPlanStep = state.step
+
+    if is_expired(config, "step_executor"):
+        # no time for new searches, the step only keeps what the speculative search already has
+        speculative = take_speculative_search(state.speculation_id)
+        results = []
+        if speculative is not None and speculative[1].done() and not speculative[1].cancelled():
+            # a failed search leaves the step without results, like one that is not back yet
+            if speculative[1].exception() is None:
+                results = speculative[1].result()
+        elif speculative is not None:
+            speculative[1].cancel()
+        return await get_result_store().put(SingleStepResults(step=step.step, results=results))
 
     # get the context from dependencies. context is the search result
-    relevant_context_list = [build_context(state.search_result_tracker[dep]) for dep in step.dependencies]
+    dependency_results = await get_result_store().get_many(state.dependency_results)
+    dependency_context = select_context(dependency_results, f"{state.query} {step.step}",
+                                        settings.PREV_STEPS_CONTEXT_TOKEN_BUDGET)
+    relevant_context_list = [build_context(dep_result) for dep_result in dependency_context]
     relevant_context_str = "\n".join(relevant_context_list)
 
-    # returns current date and time
-    now = datetime.now()
+    # only the day goes into the prompt so that identical steps on the same day hit the llm cache
+    today = datetime.now().date()
     search_prompt = SEARCH_QUERY_PROMPT.format(
         user_query=state.query,
         current_step=step.step,
         prev_steps_context=relevant_context_str,
-        date=str(now)
+        date=str(today)
     )
 
-    query_step_execution: QueryStepExecution = await search_query_llm.ainvoke(search_prompt)
-
-    search_queries = query_step_execution.search_queries
-
-    search_results = ranked_search_results_and_images_from_queries(step.step, search_queries)
-
-    single_step_result = SingleStepResults(step=step.step, results=search_results)
-
-    return_tracker = state.search_result_tracker + [single_step_result]
-
-    return {"search_result_tracker": return_tracker, "current_step_idx": state.current_step_idx + 1}
+    try:
+        query_step_execution: QueryStepExecution = await cached_ainvoke(llm, search_prompt, QueryStepExecution,
+                                                                        runnable_config=config,
+                                                                        timeout=llm_budget(config))
+        search_queries = query_step_execution.search_queries
+    except asyncio.TimeoutError:
+        logger.warning("search query generation timed out, searching the step as is")
+        DEADLINE_DEGRADATIONS.inc(node="step_executor")
+        search_queries = [step.step]
+
+    in_flight = {}
+    speculative = take_speculative_search(state.speculation_id)
+    if speculative is not None:
+        # the speculative query is not searched again if the step generated it too, otherwise its
+        # results are added to the step's own
+        speculative_query, speculative_search = speculative
+        in_flight[speculative_query] = speculative_search
+        generated = {normalize_query(query) for query in search_queries}
+        SPECULATIVE_SEARCHES.inc(outcome="reused" if normalize_query(speculative_query) in generated else "merged")
 
-
-def check_if_summarize(state: WebSearchState):
-    if state.current_step_idx == len(state.plan.steps):
-        return "chat_response"
-    return "step_executor"
+    search_results = []
+    search_timeout = stage_budget(config, settings.SEARCH_TIMEOUT_SECONDS)
+    async for query, results in ranked_search_results_and_images_from_queries(step.step, search_queries, in_flight,
+                                                                              search_timeout):
+        search_results += results
+        # lets the client show the sources of this query while the other queries and steps still run
+        await adispatch_custom_event("search_results", {
+            "step_id": step.id,
+            "step": step.step,
+            "query": query,
+            "results": results,
+        }, config=config)
+
+    search_results = await fetch_page_content(f"{state.query} {step.step}", search_results,
+                                              stage_budget(config, settings.FETCH_BUDGET_SECONDS))
+    return await get_result_store().put(SingleStepResults(step=step.step, results=search_results))
+
+
+def plan_dependencies(plan: QueryPlan) -> Dict[int, List[int]]:
+    """Dependencies of every step that can run, in plan order.
+
+    Steps on a dependency cycle, or depending on one, can never be unblocked and are left out.
+    """
+    step_ids = {step.id for step in plan.steps}
+    # ignore self references and ids the planner made up
+    dependencies = {step.id: [dep for dep in step.dependencies if dep in step_ids and dep != step.id]
+                    for step in plan.steps}
+    runnable = set()
+    while True:
+        unblocked = {step_id for step_id, deps in dependencies.items()
+                     if step_id not in runnable and all(dep in runnable for dep in deps)}
+        if not unblocked:
+            break
+        runnable |= unblocked
+    return {step_id: deps for step_id, deps in dependencies.items() if step_id in runnable}
+
+
+async def execute_plan(state: WebSearchState, config: RunnableConfig):
+    steps = {step.id: step for step in state.plan.steps}
+    dependencies = plan_dependencies(state.plan)
+    # the speculative search belongs to the first step without dependencies
+    first_step_id = next((step_id for step_id, deps in dependencies.items() if not deps), None)
+    tasks: Dict[int, asyncio.Task] = {}
+
+    async def run_step(step_id: int) -> Optional[StepResultsRef]:
+        # a step starts as soon as its own dependencies are done, not when the other steps are
+        dependency_results = [await tasks[dep] for dep in dependencies[step_id]]
+        # a run out of time answers from the steps it has, and a skipped step skips its dependents
+        if any(ref is None for ref in dependency_results) or \
+                (dependency_results and is_expired(config, "step_executor")):
+            return None
+        return await execute_step(StepExecutorState(
+            query=state.query,
+            step=steps[step_id],
+            dependency_results=dependency_results,
+            speculation_id=state.speculation_id if step_id == first_step_id else None,
+        ), config)
+
+    for step_id in dependencies:
+        tasks[step_id] = asyncio.ensure_future(run_step(step_id))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        # a failed or cancelled step takes the others down with it
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    return {"search_result_tracker": {step_id: task.result() for step_id, task in tasks.items()
+                                      if task.result() is not None}}
 
 
 async def summarize_results(state: WebSearchState, config: RunnableConfig):
-    model_name = config["configurable"].get("model", "gpt-4o")
-    llm = LLMFactory().get_llm_by_name(model_name)
+    # no-op unless the plan never got to run a step
+    cancel_speculative_search(state.speculation_id)
+
+    llm = LLMFactory().get_llm_for_node("chat_response", config)
 
-    relevant_context_list = [build_context(x) for x in state.search_result_tracker]
+    step_results = await get_result_store().get_many([state.search_result_tracker[step.id]
+                                                      for step in state.plan.steps
+                                                      if step.id in state.search_result_tracker])
+    # deduplicated, ranked against the query and packed into the prompt token budget
+    relevant_context_list = [build_context(x) for x in
+                             select_context(step_results, state.query, settings.CONTEXT_TOKEN_BUDGET)]
     relevant_context_str = "\n".join(relevant_context_list)
 
     prompt = CHAT_PROMPT.format(
@@ -130,25 +393,57 @@ async def summarize_results(state: WebSearchState, config: RunnableConfig):
 
     chain = llm | StrOutputParser()
 
-    # need to pass this config so that it streams the llm token from this node
-    resp = await chain.ainvoke(prompt, config)
+    # need to pass this config so that it streams the llm token from this node. the answer has to start
+    # within what is left of the deadline
+    try:
+        resp = "".join([chunk async for chunk in first_chunk_within(chain.astream(prompt, config),
+                                                                    answer_budget(config))])
+    except asyncio.TimeoutError:
+        logger.warning("answer did not start before the deadline")
+        DEADLINE_DEGRADATIONS.inc(node="chat_response")
+        await adispatch_custom_event("fallback_answer", {"answer": ANSWER_TIMEOUT_MESSAGE}, config=config)
+        return {"search_result": ANSWER_TIMEOUT_MESSAGE}
+    await store_answer(state.query, LLMFactory.model_for_node("chat_response", config), state.plan, step_results, resp)
 
     return {"search_result": resp}
 
 
-def ranked_search_results_and_images_from_queries(step: str,
-                                                  queries: list[str],
-                                                  ) -> List[SearchResult]:
-    client = TavilyClient()
-
-    search_results = []
-    for query in queries:
-        result = []
-        tavily_resp = client.search(query)
-        result = [SearchResult(url=x['url'], content=x['content']) for x in tavily_resp['results']]
-        search_results = search_results + result
-
-    return search_results
+async def ranked_search_results_and_images_from_queries(step: str,
+                                                        queries: list[str],
+                                                        in_flight: Optional[dict] = None,
+                                                        timeout: float = settings.SEARCH_TIMEOUT_SECONDS,
+                                                        ) -> AsyncIterator[Tuple[str, List[SearchResult]]]:
+    # queries the local passage index can answer with enough fresh passages never reach the web
+    index = get_passage_index()
+    web_queries = queries
+    if index is not None:
+        web_queries = []
+        for query in queries:
+            local_results = await index.search(query)
+            if local_results is None:
+                web_queries.append(query)
+            else:
+                yield query, local_results
+
+    # all queries of the step run concurrently on the shared search provider, each query's results
+    # are yielded as soon as it returns
+    async for query, results in iter_search_queries(web_queries, timeout, in_flight=in_flight):
+        if index is not None:
+            await index.add(results)
+        yield query, results
+
+
+async def fetch_page_content(query: str, results: List[SearchResult],
+                             budget: float = settings.FETCH_BUDGET_SECONDS) -> List[SearchResult]:
+    if not settings.FETCH_PAGES or budget <= 0:
+        return results
+    # bounded by FETCH_BUDGET_SECONDS, results whose page did not make it keep the search snippet
+    urls = list(dict.fromkeys(result.url for result in results))[:settings.FETCH_TOP_K]
+    pages = await get_page_fetcher().fetch_pages(urls, budget)
+    index = get_passage_index()
+    if index is not None:
+        await index.add([SearchResult(url=page.url, content=chunk) for page in pages.values() for chunk in page.chunks])
+    return attach_page_chunks(results, pages, query, settings.FETCH_CHUNKS_PER_PAGE)
 
 
 def build_context(step_result: SingleStepResults):
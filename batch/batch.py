@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+import config
+from admission.admission import AdmissionController
+from agents.websearchagent.websearchagent import get_websearch_agent
+from metrics.callbacks import metrics_callback_handler
+from metrics.metrics import COALESCED_CALLS
+from results.results import get_result_store
+from schemas import ChatRequest, MessageRole
+from search.search import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(request: ChatRequest) -> str:
+    # requests asking the same thing after the same conversation get the same answer
+    return json.dumps({
+        "query": normalize_query(request.query),
+        "history": [[message.role.value, message.content] for message in request.history],
+        "model": request.llm_model_name,
+    })
+
+
+def to_messages(request: ChatRequest) -> List[BaseMessage]:
+    history = [HumanMessage(content=message.content) if message.role == MessageRole.USER
+               else AIMessage(content=message.content) for message in request.history]
+    return history + [HumanMessage(content=request.query)]
+
+
+async def run_request(request: ChatRequest) -> dict:
+    started_at = time.perf_counter()
+    configurable = {"model": request.llm_model_name} if request.llm_model_name else {}
+    try:
+        state = await get_websearch_agent().ainvoke({"messages": to_messages(request)},
+                                                    {"configurable": configurable,
+                                                     "callbacks": [metrics_callback_handler]})
+    except Exception as e:
+        logger.exception("batch request failed: %s", request.query)
+        return {"error": f"{type(e).__name__}: {e}", "duration": time.perf_counter() - started_at}
+
+    tracker = state.get("search_result_tracker", {})
+    step_results = await get_result_store().get_many([tracker[step_id] for step_id in sorted(tracker)])
+    return {
+        "rewritten_query": state["query"],
+        "answer": state["search_result"],
+        "plan": [step.step for step in state["plan"].steps] if state.get("plan") else [],
+        "sources": list(dict.fromkeys(result.url for step_result in step_results for result in step_result.results)),
+        "duration": time.perf_counter() - started_at,
+    }
+
+
+class BatchRun:
+    """Runs a list of requests through the web search agent, at most `concurrency` at a time.
+
+    Identical requests are run once. Searches and llm prompts shared by different requests are merged by
+    the caches and their in-flight deduplication, which the whole batch goes through. With an admission
+    controller every run also takes one of its batch slots.
+    """
+
+    def __init__(self, requests: List[ChatRequest], concurrency: int = config.BATCH_CONCURRENCY,
+                 admission: Optional[AdmissionController] = None):
+        self.requests = requests
+        self.concurrency = max(concurrency, 1)
+        self.admission = admission
+        self.groups: Dict[str, List[int]] = {}
+        for idx, request in enumerate(requests):
+            self.groups.setdefault(request_key(request), []).append(idx)
+        self.completed = 0
+        self.errors = 0
+        self.started_at = None
+        self.finished_at = None
+        self._coalesced_before = dict(COALESCED_CALLS.values)
+
+    async def results(self) -> AsyncIterator[dict]:
+        """Result of every request as soon as it is done, in completion order."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_group(indices: List[int]):
+            async with semaphore:
+                if self.admission is None:
+                    return indices, await run_request(self.requests[indices[0]])
+                ticket = await self.admission.admit_batch_run()
+                try:
+                    return indices, await run_request(self.requests[indices[0]])
+                finally:
+                    ticket.release()
+
+        self.started_at = time.perf_counter()
+        tasks = [asyncio.ensure_future(run_group(indices)) for indices in self.groups.values()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                indices, result = await next_done
+                for idx in indices:
+                    self.completed += 1
+                    self.errors += "error" in result
+                    yield {"index": idx, "query": self.requests[idx].query, "deduplicated": idx != indices[0],
+                           **result}
+        finally:
+            self.finished_at = time.perf_counter()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def summary(self) -> dict:
+        duration = ((self.finished_at or time.perf_counter()) - self.started_at) if self.started_at else 0.0
+        coalesced = {dict(labels)["upstream"]: value - self._coalesced_before.get(labels, 0)
+                     for labels, value in COALESCED_CALLS.values.items()}
+        return {
+            "requests": len(self.requests),
+            "unique_requests": len(self.groups),
+            "completed": self.completed,
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "duration": duration,
+            "requests_per_second": self.completed / duration if duration else 0.0,
+            "coalesced_calls": coalesced,
+        }
@@ -0,0 +1,65 @@
+"""Run a batch of queries through the web search agent and write the results as JSON Lines.
+
+    python batch_runner.py queries.jsonl --concurrency 16 --output results.jsonl
+
+Every input line is a ChatRequest object ({"query": ..., "history": [...], "llm_model_name": ...}) or a
+plain text query. The summary of the batch, with its throughput, is printed to stderr at the end.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+import config
+from batch.batch import BatchRun
+from runtime import get_runtime
+from schemas import ChatRequest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="file with one request per line, - for stdin")
+    parser.add_argument("--concurrency", type=int, default=config.BATCH_CONCURRENCY, help="graph runs in flight")
+    parser.add_argument("--output", help="JSON Lines file to write, defaults to stdout")
+    return parser.parse_args()
+
+
+def read_requests(lines) -> list:
+    requests = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            requests.append(ChatRequest.model_validate_json(line))
+        else:
+            requests.append(ChatRequest(query=line))
+    return requests
+
+
+async def main(args):
+    if args.input == "-":
+        requests = read_requests(sys.stdin)
+    else:
+        with open(args.input) as f:
+            requests = read_requests(f)
+
+    runtime = get_runtime()
+    await runtime.warm_up()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        run = BatchRun(requests, args.concurrency)
+        async for result in run.results():
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+        print(json.dumps(run.summary(), indent=2), file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        await runtime.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(parse_args()))
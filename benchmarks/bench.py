@@ -0,0 +1,219 @@
+"""Latency and throughput benchmark of the /stream endpoint and the agent graphs.
+
+OpenAI and Tavily are replaced by the deterministic fake providers, so runs are reproducible
+and only measure our own pipeline. Results are written as JSON:
+
+    python -m benchmarks.bench --requests 64 --concurrency 8 --output bench.json
+
+Requests cycle through the query templates. The defaults mix a single fact question, answered by one
+search in the adaptive execution mode, a comparison that goes through the planner, a greeting answered
+by the small talk node and a request the router leaves to the conversation agent, so that the breakdown
+covers every path. None matches ANSWER_CACHE_BYPASS_PATTERN, so that with --cache and --distinct-queries
+repeated questions are served from the caches.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+DEFAULT_QUERIES = [
+    "who founded the company number {i}",
+    "compare the history and the economy of city {i} and city {j}",
+    "hi, I am user {i}",
+    "tell me a story about the number {i}",
+]
+# graph nodes reported in the per-node breakdown, the web search nodes run as a subgraph of the master
+NODES = ["converstationagent", "smalltalk", "summarize_query", "lookup_answer", "generate_plan", "step_executor",
+         "direct_search", "chat_response"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=32, help="number of /stream requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--graph-runs", type=int, default=8, help="direct graph runs for the per-node breakdown")
+    parser.add_argument("--query", action="append", dest="queries",
+                        help="query template, can be repeated, requests cycle through them; {i} and {j} are "
+                             "replaced by the query number and the next one")
+    parser.add_argument("--distinct-queries", type=int, default=0,
+                        help="number of different query numbers, 0 makes every request unique")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="fake llm seconds to first token")
+    parser.add_argument("--token-rate", type=float, default=50, help="fake llm tokens per second")
+    parser.add_argument("--search-latency", type=float, default=0.5, help="fake search seconds per query")
+    parser.add_argument("--cache", action="store_true", help="keep the search and llm caches enabled")
+    parser.add_argument("--execution-mode", default="adaptive", choices=["adaptive", "plan", "direct"],
+                        help="web search execution mode")
+    parser.add_argument("--output", help="JSON file to write, defaults to stdout")
+    args = parser.parse_args()
+    args.queries = args.queries or DEFAULT_QUERIES
+    return args
+
+
+def make_query(args, i: int) -> str:
+    n = i % args.distinct_queries if args.distinct_queries else i
+    return args.queries[i % len(args.queries)].format(i=n, j=n + 1)
+
+
+def configure_environment(args):
+    # must run before the app modules are imported, they read the configuration at import time
+    data_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "LLM_PROVIDER": "fake",
+        "SEARCH_PROVIDER": "fake",
+        "FAKE_LLM_LATENCY_SECONDS": str(args.llm_latency),
+        "FAKE_LLM_TOKENS_PER_SECOND": str(args.token_rate),
+        "FAKE_SEARCH_LATENCY_SECONDS": str(args.search_latency),
+        "EXECUTION_MODE": args.execution_mode,
+        # every client of the benchmark shares one address, only the global cap applies
+        "CLIENT_REQUESTS_PER_MINUTE": "0",
+        "CHECKPOINT_SQLITE_PATH": os.path.join(data_dir, "checkpoints.sqlite"),
+        "CACHE_SQLITE_PATH": os.path.join(data_dir, "cache.sqlite"),
+    })
+    if not args.cache:
+        os.environ.update({"SEARCH_CACHE_ENABLED": "false", "LLM_CACHE_MODE": "off", "ANSWER_CACHE_ENABLED": "false"})
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(p: float) -> float:
+        return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": values[-1],
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def stream_once(client, query: str) -> dict:
+    timings = {}
+    start = time.perf_counter()
+    async with client.stream("GET", "/stream", params={"query": query, "session_id": str(uuid.uuid4())}) as resp:
+        async for line in resp.aiter_lines():
+            if not line.startswith("event:"):
+                continue
+            event = line.removeprefix("event:").strip()
+            elapsed = time.perf_counter() - start
+            if event == "thoughts":
+                timings.setdefault("time_to_first_thought", elapsed)
+            elif event == "assistant":
+                timings.setdefault("time_to_first_token", elapsed)
+            elif event == "end":
+                timings["total_latency"] = elapsed
+    return timings
+
+
+async def bench_endpoint(args) -> dict:
+    import httpx
+    import uvicorn
+    from server import app
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+        async def run(i: int):
+            async with semaphore:
+                return await stream_once(client, make_query(args, i))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run(i) for i in range(args.requests)), return_exceptions=True)
+        duration = time.perf_counter() - start
+
+    server.should_exit = True
+    await server_task
+
+    completed = [x for x in results if isinstance(x, dict) and "total_latency" in x]
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "completed": len(completed),
+        "errors": len(results) - len(completed),
+        "duration": duration,
+        "streams_per_second": len(completed) / duration,
+        "time_to_first_thought": summarize([x["time_to_first_thought"] for x in completed
+                                            if "time_to_first_thought" in x]),
+        "time_to_first_token": summarize([x["time_to_first_token"] for x in completed if "time_to_first_token" in x]),
+        "total_latency": summarize([x["total_latency"] for x in completed]),
+    }
+
+
+async def bench_graph(args) -> dict:
+    from langchain_core.messages import HumanMessage
+    from runtime import get_runtime
+
+    agent = get_runtime().master_agent
+    node_timings = {node: [] for node in NODES}
+    totals = []
+    for i in range(args.graph_runs):
+        started = {}
+        start = time.perf_counter()
+        async for event in agent.astream_events({"messages": [HumanMessage(content=make_query(args, i))]},
+                                                config={"configurable": {"thread_id": uuid.uuid4().hex}},
+                                                version="v2", include_names=NODES):
+            if not any(t.startswith("graph:step:") for t in event.get("tags", [])):
+                continue
+            if event["event"] == "on_chain_start":
+                started[event["run_id"]] = time.perf_counter()
+            elif event["event"] == "on_chain_end" and event["run_id"] in started:
+                node_timings[event["name"]].append(time.perf_counter() - started.pop(event["run_id"]))
+        totals.append(time.perf_counter() - start)
+
+    return {
+        "runs": args.graph_runs,
+        "total_latency": summarize(totals),
+        "nodes": {node: summarize(timings) for node, timings in node_timings.items()},
+    }
+
+
+async def main(args):
+    from runtime import get_runtime
+
+    results = {
+        "config": vars(args),
+        "endpoint": await bench_endpoint(args),
+    }
+    # the endpoint benchmark stops the runtime with the server, the graphs are driven on a fresh one
+    await get_runtime().start()
+    try:
+        results["graph"] = await bench_graph(args)
+    finally:
+        await get_runtime().stop()
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_environment(args)
+    results = asyncio.run(main(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aiosqlite
+
+import config
+from metrics.metrics import registry, CACHE_REQUESTS, COALESCED_CALLS
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CacheBackend(ABC):
+    """Async key/value cache with a TTL and a max number of entries (LRU eviction).
+
+    Values must be JSON serializable so that every backend can store them.
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: Optional[float], max_size: int):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.stats = CacheStats()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def peek(self, key: str) -> Optional[Any]:
+        """Like get, without counting a hit or a miss or refreshing the entry, for polling."""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any):
+        ...
+
+    async def flush(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class InMemoryCache(CacheBackend):
+    def __init__(self, namespace: str, ttl_seconds: Optional[float], max_size: int):
+        super().__init__(namespace, ttl_seconds, max_size)
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or self._is_expired(entry[0]):
+            if entry is not None:
+                del self._entries[key]
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry[1]
+
+    async def peek(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        return None if entry is None or self._is_expired(entry[0]) else entry[1]
+
+    async def set(self, key: str, value: Any):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+
+class SqliteCache(CacheBackend):
+    """Cache stored in a SQLite file so that every worker process on the host shares hits.
+
+    Access times are written in batches and eviction runs every tenth of max_size inserts, so the LRU order is
+    approximate and a namespace can briefly hold a little more than max_size entries.
+    """
+
+    TOUCH_BATCH_SIZE = 64
+
+    _connections: Dict[str, aiosqlite.Connection] = {}
+    # caches opened concurrently on first use would otherwise each connect and leak all but one connection.
+    # Created on first use, like the connections, so that they belong to the event loop that uses them
+    _connect_locks: Dict[str, asyncio.Lock] = {}
+
+    def __init__(self, namespace: str, ttl_seconds: Optional[float], max_size: int,
+                 path: str = config.CACHE_SQLITE_PATH):
+        super().__init__(namespace, ttl_seconds, max_size)
+        self.path = path
+        self.evict_every = max(max_size // 10, 1)
+        self._touched: Dict[str, float] = {}
+        self._inserted_since_eviction = 0
+
+    async def _get_conn(self) -> aiosqlite.Connection:
+        conn = self._connections.get(self.path)
+        if conn is not None:
+            return conn
+        async with self._connect_locks.setdefault(self.path, asyncio.Lock()):
+            conn = self._connections.get(self.path)
+            if conn is None:
+                conn = await aiosqlite.connect(self.path, check_same_thread=False)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache_entries ("
+                    "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                    "PRIMARY KEY (namespace, key))"
+                )
+                await conn.commit()
+                self._connections[self.path] = conn
+        return conn
+
+    async def _read(self, conn: aiosqlite.Connection, key: str) -> Optional[tuple]:
+        async with conn.execute(
+                "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+        ) as cursor:
+            return await cursor.fetchone()
+
+    async def get(self, key: str) -> Optional[Any]:
+        conn = await self._get_conn()
+        row = await self._read(conn, key)
+
+        # expired rows are left to the next eviction, a hit only writes once enough of them are pending
+        if row is None or self._is_expired(row[1]):
+            self.stats.misses += 1
+            return None
+
+        self._touched[key] = time.time()
+        if len(self._touched) >= self.TOUCH_BATCH_SIZE:
+            await self._write_touched(conn)
+            await conn.commit()
+        self.stats.hits += 1
+        return json.loads(row[0])
+
+    async def peek(self, key: str) -> Optional[Any]:
+        row = await self._read(await self._get_conn(), key)
+        return None if row is None or self._is_expired(row[1]) else json.loads(row[0])
+
+    async def set(self, key: str, value: Any):
+        conn = await self._get_conn()
+        now = time.time()
+        await conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), now, now)
+        )
+        self._touched.pop(key, None)
+        self._inserted_since_eviction += 1
+        if self._inserted_since_eviction >= self.evict_every:
+            await self._evict(conn, now)
+        await conn.commit()
+
+    async def _write_touched(self, conn: aiosqlite.Connection):
+        touched, self._touched = self._touched, {}
+        await conn.executemany(
+            "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            [(accessed_at, self.namespace, key) for key, accessed_at in touched.items()]
+        )
+
+    async def _evict(self, conn: aiosqlite.Connection, now: float):
+        self._inserted_since_eviction = 0
+        await self._write_touched(conn)
+        if self.ttl_seconds is not None:
+            cursor = await conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND created_at < ?",
+                                        (self.namespace, now - self.ttl_seconds))
+            self.stats.evictions += max(cursor.rowcount, 0)
+        # keep the max_size most recently used entries of this namespace
+        cursor = await conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key NOT IN ("
+            "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at DESC, rowid DESC LIMIT ?)",
+            (self.namespace, self.namespace, self.max_size)
+        )
+        self.stats.evictions += max(cursor.rowcount, 0)
+
+    async def flush(self):
+        conn = self._connections.get(self.path)
+        if conn is not None and self._touched:
+            await self._write_touched(conn)
+            await conn.commit()
+
+    async def aclose(self):
+        conn = self._connections.pop(self.path, None)
+        self._connect_locks.pop(self.path, None)
+        if conn is not None:
+            await conn.close()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution, the ones that find it running just wait for it.
+
+    Covers the gap the caches leave: identical requests that all miss before the first one is stored. Every
+    caller waits at most its own timeout, giving up does not cancel the call for the others. The shared call
+    is cancelled once every caller waiting for it is gone.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, list] = {}
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """Raises asyncio.TimeoutError when the call is not done within timeout seconds."""
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = self._calls[key] = [asyncio.ensure_future(call()), 0]
+            entry[0].add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            COALESCED_CALLS.inc(upstream=self.name)
+        entry[1] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry[0]), timeout)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                self._forget(key, entry)
+
+    def _forget(self, key: str, entry: list):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+
+_caches: Dict[str, CacheBackend] = {}
+
+
+def get_cache(namespace: str, ttl_seconds: Optional[float], max_size: int,
+              backend: Optional[str] = None) -> CacheBackend:
+    cache = _caches.get(namespace)
+    if cache is None:
+        if (backend or config.CACHE_BACKEND) == "sqlite":
+            cache = SqliteCache(namespace, ttl_seconds, max_size)
+        else:
+            cache = InMemoryCache(namespace, ttl_seconds, max_size)
+        _caches[namespace] = cache
+    return cache
+
+
+def get_cache_stats() -> dict:
+    return {namespace: cache.stats.as_dict() for namespace, cache in _caches.items()}
+
+
+async def close_caches():
+    # sqlite caches share a connection per file, everything is written before the first one closes it
+    for cache in _caches.values():
+        await cache.flush()
+    for cache in _caches.values():
+        await cache.aclose()
+
+
+def _collect_cache_stats():
+    for namespace, cache in _caches.items():
+        CACHE_REQUESTS.set(cache.stats.hits, cache=namespace, result="hit")
+        CACHE_REQUESTS.set(cache.stats.misses, cache=namespace, result="miss")
+
+
+registry.collectors.append(_collect_cache_stats)
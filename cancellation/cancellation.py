@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+import config
+from cache.cache import CacheBackend, get_cache
+from metrics.metrics import CANCELLED_RUN_AGE, RUNS_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+
+class ActiveRun:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.started_at = time.time()
+        self.reason: Optional[str] = None
+        self.cancelled = asyncio.Event()
+
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+        self.cancelled.set()
+
+
+class RunRegistry:
+    """Graph runs streaming from this process by session, so that another request can cancel them.
+
+    With several workers the run may stream from another process: the cancellation is also left as a
+    marker in the shared cache, which the runs of every worker poll. The in-memory cache is not shared,
+    so without the sqlite cache a run can only be cancelled by the worker it streams from.
+    """
+
+    def __init__(self):
+        self._runs: Dict[str, Set[ActiveRun]] = defaultdict(set)
+
+    @staticmethod
+    def shares_cancellations() -> bool:
+        return config.WORKERS > 1 and config.CACHE_BACKEND == "sqlite"
+
+    @staticmethod
+    def get_markers() -> CacheBackend:
+        return get_cache("cancellations", config.CANCELLATION_MARKER_TTL_SECONDS, 10000)
+
+    def register(self, session_id: str) -> ActiveRun:
+        run = ActiveRun(session_id)
+        self._runs[session_id].add(run)
+        return run
+
+    def unregister(self, run: ActiveRun):
+        runs = self._runs.get(run.session_id)
+        if runs is not None:
+            runs.discard(run)
+            if not runs:
+                del self._runs[run.session_id]
+
+    async def cancel(self, session_id: str, reason: str = "cancel_request") -> int:
+        runs = list(self._runs.get(session_id, ()))
+        for run in runs:
+            run.cancel(reason)
+        if self.shares_cancellations():
+            await self.get_markers().set(session_id, time.time())
+        return len(runs)
+
+    async def is_cancelled_elsewhere(self, run: ActiveRun) -> bool:
+        if not self.shares_cancellations():
+            return False
+        # polled by every run, kept out of the cache stats
+        cancelled_at = await self.get_markers().peek(run.session_id)
+        # a marker left for an earlier run of the session does not stop this one
+        return cancelled_at is not None and cancelled_at >= run.started_at
+
+
+def record_cancellation(run: ActiveRun, reason: str):
+    age = time.time() - run.started_at
+    logger.info("run of session %s cancelled after %.2fs: %s", run.session_id, age, reason)
+    RUNS_CANCELLED.inc(reason=reason)
+    CANCELLED_RUN_AGE.observe(age, reason=reason)
@@ -0,0 +1,429 @@
+"""Checkpoint storage of the master agent.
+
+The backend is picked with CHECKPOINT_BACKEND. Both backends keep the last CHECKPOINT_KEEP_LAST
+checkpoints of every conversation, drop the checkpoints of finished web search subgraph runs and
+delete conversations idle for longer than CHECKPOINT_SESSION_TTL_SECONDS. Compaction runs in the
+background of the server and can be run on its own with:
+
+    python -m checkpoints.checkpoints
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+import aiosqlite
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+import config as settings
+from metrics.metrics import CHECKPOINT_DURATION, CHECKPOINT_WRITE_BYTES, CHECKPOINTS_PRUNED
+
+logger = logging.getLogger(__name__)
+
+# offset between the uuid epoch (1582-10-15) and the unix epoch in 100ns intervals
+UUID_EPOCH_OFFSET = 0x01B21DD213814000
+
+
+def checkpoint_timestamp(checkpoint_id: str) -> float:
+    """Unix time at which a checkpoint was created, read from its uuid6 id."""
+    hex_id = checkpoint_id.replace("-", "")
+    timestamp = (int(hex_id[0:12], 16) << 12) | int(hex_id[13:16], 16)
+    return (timestamp - UUID_EPOCH_OFFSET) / 10_000_000
+
+
+def _timed(op: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            CHECKPOINT_DURATION.observe(time.perf_counter() - start, op=op)
+
+    return wrapper
+
+
+def _timed_iter(op: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            async for item in method(*args, **kwargs):
+                yield item
+        finally:
+            CHECKPOINT_DURATION.observe(time.perf_counter() - start, op=op)
+
+    return wrapper
+
+
+def instrument_saver(saver: BaseCheckpointSaver) -> BaseCheckpointSaver:
+    """Record the latency of the async read and write methods of any checkpoint saver."""
+    saver.aget_tuple = _timed("get", saver.aget_tuple)
+    saver.aput = _timed("put", saver.aput)
+    saver.aput_writes = _timed("put_writes", saver.aput_writes)
+    saver.alist = _timed_iter("list", saver.alist)
+    return saver
+
+
+SQLITE_CREATE_BLOBS = """
+CREATE TABLE IF NOT EXISTS checkpoint_blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE INDEX IF NOT EXISTS checkpoint_blobs_written_at
+    ON checkpoint_blobs (thread_id, checkpoint_ns, channel, checkpoint_id);
+"""
+
+
+class BlobAsyncSqliteSaver(AsyncSqliteSaver):
+    """Stores each version of a channel value once, next to the checkpoints instead of inside them.
+
+    A checkpoint only keeps the versions of its channels. A superstep that changes one channel writes
+    that channel, not the whole message history and every other unchanged channel again. Checkpoints
+    written with their values inline are still read as they are.
+    """
+
+    async def setup(self):
+        if self.is_setup:
+            return
+        await super().setup()
+        await self.conn.executescript(SQLITE_CREATE_BLOBS)
+        await self.conn.commit()
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        await self.setup()
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        values = checkpoint["channel_values"]
+        versions = {channel: version for channel, version in checkpoint["channel_versions"].items()
+                    if channel in new_versions or channel in values}
+        # unchanged channels are only written when their version is not stored yet, i.e. when the
+        # previous checkpoint of the thread still had its values inline
+        unchanged = [(channel, str(version)) for channel, version in versions.items() if channel not in new_versions]
+        stored = await self._stored_versions(thread_id, checkpoint_ns, unchanged)
+        rows = []
+        for channel, version in versions.items():
+            if (channel, str(version)) in stored:
+                continue
+            type_, value = self.serde.dumps_typed(values[channel]) if channel in values else ("empty", None)
+            rows.append((thread_id, checkpoint_ns, channel, str(version), checkpoint["id"], type_, value))
+        CHECKPOINT_WRITE_BYTES.observe(sum(len(row[-1] or b"") for row in rows))
+        if rows:
+            # committed together with the checkpoint row by the saver
+            async with self.lock:
+                await self.conn.executemany(
+                    "INSERT OR REPLACE INTO checkpoint_blobs (thread_id, checkpoint_ns, channel, version, "
+                    "checkpoint_id, type, value) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        return await super().aput(config, {**checkpoint, "channel_values": {}}, metadata, new_versions)
+
+    async def _stored_versions(self, thread_id: str, checkpoint_ns: str, wanted: List[tuple]) -> set:
+        if not wanted:
+            return set()
+        placeholders = ",".join(["(?, ?)"] * len(wanted))
+        async with self.conn.execute(
+                "SELECT channel, version FROM checkpoint_blobs WHERE thread_id = ? AND checkpoint_ns = ? "
+                f"AND (channel, version) IN (VALUES {placeholders})",
+                (thread_id, checkpoint_ns, *(item for pair in wanted for item in pair))
+        ) as cursor:
+            return set(await cursor.fetchall())
+
+    async def _load_channel_values(self, checkpoint_tuple: Optional[CheckpointTuple]) -> Optional[CheckpointTuple]:
+        if checkpoint_tuple is None:
+            return None
+        checkpoint = checkpoint_tuple.checkpoint
+        wanted = [(channel, str(version)) for channel, version in checkpoint["channel_versions"].items()
+                  if channel not in checkpoint["channel_values"]]
+        if not wanted:
+            return checkpoint_tuple
+        configurable = checkpoint_tuple.config["configurable"]
+        placeholders = ",".join(["(?, ?)"] * len(wanted))
+        async with self.conn.execute(
+                "SELECT channel, type, value FROM checkpoint_blobs WHERE thread_id = ? AND checkpoint_ns = ? "
+                f"AND (channel, version) IN (VALUES {placeholders})",
+                (str(configurable["thread_id"]), configurable.get("checkpoint_ns", ""),
+                 *(item for pair in wanted for item in pair))
+        ) as cursor:
+            for channel, type_, value in await cursor.fetchall():
+                if type_ != "empty":
+                    checkpoint["channel_values"][channel] = self.serde.loads_typed((type_, value))
+        return checkpoint_tuple
+
+    async def aget_tuple(self, config):
+        return await self._load_channel_values(await super().aget_tuple(config))
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        async for checkpoint_tuple in super().alist(config, filter=filter, before=before, limit=limit):
+            yield await self._load_channel_values(checkpoint_tuple)
+
+
+class PooledAsyncSqliteSaver(BlobAsyncSqliteSaver):
+    """Writes go through the saver's own connection, reads are spread over a pool of reader connections.
+
+    In WAL mode readers never wait for the writer, so loading the state of one conversation is not
+    queued behind the checkpoint writes of the others.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, readers: List[AsyncSqliteSaver]):
+        super().__init__(conn)
+        self.readers = readers
+        self._next_reader = itertools.cycle(readers)
+
+    async def aget_tuple(self, config):
+        if not self.readers:
+            return await super().aget_tuple(config)
+        await self.setup()
+        return await next(self._next_reader).aget_tuple(config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        if not self.readers:
+            async for item in super().alist(config, filter=filter, before=before, limit=limit):
+                yield item
+            return
+        await self.setup()
+        async for item in next(self._next_reader).alist(config, filter=filter, before=before, limit=limit):
+            yield item
+
+
+class CheckpointStore(ABC):
+    @abstractmethod
+    async def open(self) -> BaseCheckpointSaver:
+        ...
+
+    @abstractmethod
+    async def compact(self) -> dict:
+        """Prune old checkpoints and idle conversations, returns the number of deleted rows per reason."""
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    def idle_threads(self, latest_checkpoints) -> List[str]:
+        deadline = time.time() - settings.CHECKPOINT_SESSION_TTL_SECONDS
+        return [thread_id for thread_id, checkpoint_id in latest_checkpoints
+                if checkpoint_timestamp(checkpoint_id) < deadline]
+
+    def record_pruned(self, pruned: dict) -> dict:
+        for reason, count in pruned.items():
+            CHECKPOINTS_PRUNED.inc(count, reason=reason)
+        logger.info("checkpoint compaction: %s", pruned)
+        return pruned
+
+
+# checkpoints of web search subgraph runs that finished before the latest checkpoint of their conversation
+SQLITE_DELETE_FINISHED_SUBGRAPHS = """
+DELETE FROM checkpoints WHERE checkpoint_ns != '' AND checkpoint_id < (
+    SELECT MAX(c.checkpoint_id) FROM checkpoints c
+    WHERE c.thread_id = checkpoints.thread_id AND c.checkpoint_ns = ''
+)
+"""
+SQLITE_DELETE_OLD_CHECKPOINTS = """
+DELETE FROM checkpoints WHERE rowid IN (
+    SELECT rowid FROM (
+        SELECT rowid, ROW_NUMBER() OVER (
+            PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+        ) AS position FROM checkpoints
+    ) WHERE position > ?
+)
+"""
+# channel values no checkpoint can reach anymore: their checkpoints are all gone, or a later version of
+# the channel was written before the oldest checkpoint kept
+SQLITE_DELETE_STALE_BLOBS = """
+DELETE FROM checkpoint_blobs WHERE NOT EXISTS (
+    SELECT 1 FROM checkpoints c
+    WHERE c.thread_id = checkpoint_blobs.thread_id AND c.checkpoint_ns = checkpoint_blobs.checkpoint_ns
+) OR EXISTS (
+    SELECT 1 FROM checkpoint_blobs newer
+    WHERE newer.thread_id = checkpoint_blobs.thread_id AND newer.checkpoint_ns = checkpoint_blobs.checkpoint_ns
+    AND newer.channel = checkpoint_blobs.channel AND newer.checkpoint_id > checkpoint_blobs.checkpoint_id
+    AND newer.checkpoint_id <= (
+        SELECT MIN(c.checkpoint_id) FROM checkpoints c
+        WHERE c.thread_id = checkpoint_blobs.thread_id AND c.checkpoint_ns = checkpoint_blobs.checkpoint_ns
+    )
+)
+"""
+SQLITE_DELETE_ORPHAN_WRITES = """
+DELETE FROM writes WHERE NOT EXISTS (
+    SELECT 1 FROM checkpoints c WHERE c.thread_id = writes.thread_id
+    AND c.checkpoint_ns = writes.checkpoint_ns AND c.checkpoint_id = writes.checkpoint_id
+)
+"""
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    def __init__(self, path: str = settings.CHECKPOINT_SQLITE_PATH, readers: int = settings.CHECKPOINT_POOL_SIZE):
+        self.path = path
+        self.reader_count = readers
+        self.connections: List[aiosqlite.Connection] = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, check_same_thread=False)
+        # wait for the write lock held by another worker instead of failing right away
+        await conn.execute("PRAGMA busy_timeout = 5000")
+        self.connections.append(conn)
+        return conn
+
+    async def open(self) -> BaseCheckpointSaver:
+        writer = await self._connect()
+        await writer.execute("PRAGMA journal_mode = WAL")
+        await writer.execute("PRAGMA synchronous = NORMAL")
+
+        readers = []
+        for _ in range(self.reader_count):
+            reader = BlobAsyncSqliteSaver(await self._connect())
+            # the writer creates the tables
+            reader.is_setup = True
+            readers.append(reader)
+
+        saver = PooledAsyncSqliteSaver(writer, readers)
+        await saver.setup()
+        return instrument_saver(saver)
+
+    async def compact(self) -> dict:
+        # a dedicated connection so compaction never holds the lock of the request path
+        async with aiosqlite.connect(self.path) as conn:
+            await conn.execute("PRAGMA busy_timeout = 30000")
+            async with conn.execute(
+                    "SELECT thread_id, MAX(checkpoint_id) FROM checkpoints WHERE checkpoint_ns = '' GROUP BY thread_id"
+            ) as cursor:
+                idle = self.idle_threads(await cursor.fetchall())
+
+            pruned = {"idle_session": 0}
+            for idx in range(0, len(idle), 500):
+                batch = idle[idx:idx + 500]
+                placeholders = ",".join("?" * len(batch))
+                cursor = await conn.execute(f"DELETE FROM checkpoints WHERE thread_id IN ({placeholders})", batch)
+                pruned["idle_session"] += cursor.rowcount
+                await conn.execute(f"DELETE FROM writes WHERE thread_id IN ({placeholders})", batch)
+
+            pruned["finished_subgraph"] = (await conn.execute(SQLITE_DELETE_FINISHED_SUBGRAPHS)).rowcount
+            pruned["keep_last"] = (await conn.execute(SQLITE_DELETE_OLD_CHECKPOINTS,
+                                                      (settings.CHECKPOINT_KEEP_LAST,))).rowcount
+            pruned["orphan_writes"] = (await conn.execute(SQLITE_DELETE_ORPHAN_WRITES)).rowcount
+            pruned["stale_blobs"] = (await conn.execute(SQLITE_DELETE_STALE_BLOBS)).rowcount
+            await conn.commit()
+            await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        return self.record_pruned(pruned)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+
+
+class PostgresCheckpointStore(CheckpointStore):
+    """Checkpoints in Postgres, shared by every worker and host.
+
+    Requires the optional `langgraph-checkpoint-postgres` and `psycopg[pool]` packages. Channel
+    blobs are only deleted together with idle conversations.
+    """
+
+    def __init__(self, url: str = settings.CHECKPOINT_POSTGRES_URL, pool_size: int = settings.CHECKPOINT_POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self.pool = None
+
+    async def open(self) -> BaseCheckpointSaver:
+        try:
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+            from psycopg.rows import dict_row
+            from psycopg_pool import AsyncConnectionPool
+        except ImportError as e:
+            raise RuntimeError(
+                "CHECKPOINT_BACKEND=postgres requires `pip install langgraph-checkpoint-postgres psycopg[pool]`"
+            ) from e
+
+        self.pool = AsyncConnectionPool(
+            self.url, min_size=1, max_size=self.pool_size, open=False,
+            kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+        )
+        await self.pool.open()
+        saver = AsyncPostgresSaver(self.pool)
+        await saver.setup()
+        return instrument_saver(saver)
+
+    async def compact(self) -> dict:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(
+                "SELECT thread_id, MAX(checkpoint_id) AS checkpoint_id FROM checkpoints "
+                "WHERE checkpoint_ns = '' GROUP BY thread_id"
+            )
+            idle = self.idle_threads([(row["thread_id"], row["checkpoint_id"]) for row in await cursor.fetchall()])
+
+            pruned = {"idle_session": 0}
+            if idle:
+                cursor = await conn.execute("DELETE FROM checkpoints WHERE thread_id = ANY(%s)", (idle,))
+                pruned["idle_session"] = cursor.rowcount
+                await conn.execute("DELETE FROM checkpoint_writes WHERE thread_id = ANY(%s)", (idle,))
+                await conn.execute("DELETE FROM checkpoint_blobs WHERE thread_id = ANY(%s)", (idle,))
+
+            cursor = await conn.execute(
+                "DELETE FROM checkpoints c WHERE c.checkpoint_ns != '' AND c.checkpoint_id < ("
+                "SELECT MAX(p.checkpoint_id) FROM checkpoints p "
+                "WHERE p.thread_id = c.thread_id AND p.checkpoint_ns = '')"
+            )
+            pruned["finished_subgraph"] = cursor.rowcount
+            cursor = await conn.execute(
+                "DELETE FROM checkpoints c USING ("
+                "SELECT thread_id, checkpoint_ns, checkpoint_id, ROW_NUMBER() OVER ("
+                "PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position FROM checkpoints"
+                ") old WHERE old.position > %s AND c.thread_id = old.thread_id "
+                "AND c.checkpoint_ns = old.checkpoint_ns AND c.checkpoint_id = old.checkpoint_id",
+                (settings.CHECKPOINT_KEEP_LAST,)
+            )
+            pruned["keep_last"] = cursor.rowcount
+            cursor = await conn.execute(
+                "DELETE FROM checkpoint_writes w WHERE NOT EXISTS ("
+                "SELECT 1 FROM checkpoints c WHERE c.thread_id = w.thread_id "
+                "AND c.checkpoint_ns = w.checkpoint_ns AND c.checkpoint_id = w.checkpoint_id)"
+            )
+            pruned["orphan_writes"] = cursor.rowcount
+
+        return self.record_pruned(pruned)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+def create_checkpoint_store() -> CheckpointStore:
+    if settings.CHECKPOINT_BACKEND == "postgres":
+        return PostgresCheckpointStore()
+    return SqliteCheckpointStore()
+
+
+async def run_compaction(store: CheckpointStore, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await store.compact()
+        except Exception:
+            logger.exception("checkpoint compaction failed")
+
+
+async def _compact_once():
+    store = create_checkpoint_store()
+    await store.open()
+    try:
+        await store.compact()
+    finally:
+        await store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    asyncio.run(_compact_once())
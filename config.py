@@ -0,0 +1,217 @@
+import os
+
+from dotenv import load_dotenv
+
+_ = load_dotenv()
+
+
+def _get_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _get_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _get_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return value.lower() in ("1", "true", "yes") if value else default
+
+
+def _get_mapping(name: str, default: str) -> dict:
+    # "key=value,key=value", values with several entries are separated by "|"
+    value = os.getenv(name, default)
+    pairs = (item.split("=", 1) for item in value.split(",") if "=" in item)
+    return {key.strip(): value.strip() for key, value in pairs}
+
+
+# llm provider, `openai` or `fake` for the deterministic offline model used by the benchmarks
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+FAKE_LLM_LATENCY_SECONDS = _get_float("FAKE_LLM_LATENCY_SECONDS", 0.3)
+FAKE_LLM_TOKENS_PER_SECOND = _get_float("FAKE_LLM_TOKENS_PER_SECOND", 50)
+# model of the nodes without a policy below, the model requested in the run config wins over it
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o")
+# per node model policy, e.g. `summarize_query=gpt-4o-mini,generate_plan=gpt-4o-mini,step_executor=gpt-4o-mini,
+# smalltalk=gpt-4o-mini`: the rewrite, plan and search query nodes only produce a line or a short json
+NODE_MODELS = _get_mapping("NODE_MODELS", "")
+# models tried in order when a model times out or is unavailable
+MODEL_FALLBACKS = {model: fallbacks.split("|") for model, fallbacks in
+                   _get_mapping("MODEL_FALLBACKS", "gpt-4o-mini=gpt-4o,gpt-4o=gpt-4o-mini").items()}
+# budget of a whole llm call, fallbacks included
+LLM_TIMEOUT_SECONDS = _get_float("LLM_TIMEOUT_SECONDS", 30.0)
+LLM_MAX_RETRIES = _get_int("LLM_MAX_RETRIES", 2)
+# timeout of one request to a model, 0 leaves requests untimed. LLM_TIMEOUT_SECONDS / (LLM_MAX_RETRIES + 2) fits the
+# attempts of the first model and one attempt of its fallback in the budget, otherwise a hanging model uses it
+# all before the fallback is tried
+LLM_ATTEMPT_TIMEOUT_SECONDS = _get_float("LLM_ATTEMPT_TIMEOUT_SECONDS", 0)
+
+# search provider
+SEARCH_PROVIDER = os.getenv("SEARCH_PROVIDER", "tavily")
+FAKE_SEARCH_LATENCY_SECONDS = _get_float("FAKE_SEARCH_LATENCY_SECONDS", 0.5)
+SEARCH_MAX_RESULTS = _get_int("SEARCH_MAX_RESULTS", 5)
+# timeout applied to every single search query
+SEARCH_TIMEOUT_SECONDS = _get_float("SEARCH_TIMEOUT_SECONDS", 10.0)
+# max search queries in flight across all requests served by this process
+SEARCH_MAX_CONCURRENCY = _get_int("SEARCH_MAX_CONCURRENCY", 16)
+# search the rewritten query while the plan is generated, the results go to the first plan step
+SPECULATIVE_SEARCH = _get_bool("SPECULATIVE_SEARCH", True)
+# a speculative search nobody picked up within this time is cancelled
+SPECULATIVE_SEARCH_TTL_SECONDS = _get_float("SPECULATIVE_SEARCH_TTL_SECONDS", 60.0)
+
+# page fetching, the top results of a search are downloaded and their main text replaces the snippet
+FETCH_PAGES = _get_bool("FETCH_PAGES", False)
+FETCH_TOP_K = _get_int("FETCH_TOP_K", 3)
+# the whole fetch stage of a step, pages that are not back by then keep their search snippet
+FETCH_BUDGET_SECONDS = _get_float("FETCH_BUDGET_SECONDS", 2.5)
+FETCH_TIMEOUT_SECONDS = _get_float("FETCH_TIMEOUT_SECONDS", 5.0)
+FETCH_MAX_BYTES = _get_int("FETCH_MAX_BYTES", 1024 * 1024)
+FETCH_MAX_CONCURRENCY = _get_int("FETCH_MAX_CONCURRENCY", 16)
+FETCH_MAX_PER_HOST = _get_int("FETCH_MAX_PER_HOST", 2)
+# redirects are followed by the fetcher itself, every hop has to resolve to public addresses only
+FETCH_MAX_REDIRECTS = _get_int("FETCH_MAX_REDIRECTS", 5)
+FETCH_ALLOW_PRIVATE_ADDRESSES = _get_bool("FETCH_ALLOW_PRIVATE_ADDRESSES", False)
+FETCH_CHUNK_CHARS = _get_int("FETCH_CHUNK_CHARS", 1200)
+# chunks of a page that go into the context, the ones closest to the step
+FETCH_CHUNKS_PER_PAGE = _get_int("FETCH_CHUNKS_PER_PAGE", 2)
+PAGE_CACHE_TTL_SECONDS = _get_float("PAGE_CACHE_TTL_SECONDS", 24 * 60 * 60)
+PAGE_CACHE_MAX_SIZE = _get_int("PAGE_CACHE_MAX_SIZE", 512)
+# cached pages older than this are revalidated with their ETag
+PAGE_REVALIDATE_SECONDS = _get_float("PAGE_REVALIDATE_SECONDS", 15 * 60)
+
+# local passage index, search results and fetched pages are indexed (SQLite FTS5) and searched
+# before the web; a query is served locally when enough fresh passages match most of its terms
+PASSAGE_INDEX_ENABLED = _get_bool("PASSAGE_INDEX_ENABLED", False)
+PASSAGE_INDEX_PATH = os.getenv("PASSAGE_INDEX_PATH", "passages.sqlite")
+PASSAGE_INDEX_TTL_SECONDS = _get_float("PASSAGE_INDEX_TTL_SECONDS", 6 * 60 * 60)
+PASSAGE_INDEX_MAX_PASSAGES = _get_int("PASSAGE_INDEX_MAX_PASSAGES", 50000)
+PASSAGE_INDEX_PRUNE_INTERVAL_SECONDS = _get_float("PASSAGE_INDEX_PRUNE_INTERVAL_SECONDS", 60)
+PASSAGE_INDEX_MAX_CHARS = _get_int("PASSAGE_INDEX_MAX_CHARS", 2000)
+PASSAGE_INDEX_MIN_RESULTS = _get_int("PASSAGE_INDEX_MIN_RESULTS", 3)
+PASSAGE_INDEX_MIN_COVERAGE = _get_float("PASSAGE_INDEX_MIN_COVERAGE", 0.75)
+
+# caches, `memory` is per process, `sqlite` is shared by all the workers on the host
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "cache.sqlite")
+SEARCH_CACHE_ENABLED = _get_bool("SEARCH_CACHE_ENABLED", True)
+SEARCH_CACHE_TTL_SECONDS = _get_float("SEARCH_CACHE_TTL_SECONDS", 15 * 60)
+SEARCH_CACHE_MAX_SIZE = _get_int("SEARCH_CACHE_MAX_SIZE", 2048)
+
+# step search results are stored once under the hash of their content and the web search state only
+# keeps references to them, so checkpoints do not carry the result text; `sqlite` (in CACHE_SQLITE_PATH)
+# is shared by the workers of the host and outlives a restart, `memory` is per process; CACHE_BACKEND by default
+RESULT_STORE_BACKEND = os.getenv("RESULT_STORE_BACKEND", CACHE_BACKEND)
+RESULT_STORE_TTL_SECONDS = _get_float("RESULT_STORE_TTL_SECONDS", 24 * 60 * 60)
+RESULT_STORE_MAX_SIZE = _get_int("RESULT_STORE_MAX_SIZE", 10000)
+
+# final answers by rewritten query and model, a repeated question is replayed from the cache instead of
+# being planned, searched and answered again; queries matching the bypass pattern are always run
+ANSWER_CACHE_ENABLED = _get_bool("ANSWER_CACHE_ENABLED", True)
+ANSWER_CACHE_TTL_SECONDS = _get_float("ANSWER_CACHE_TTL_SECONDS", 10 * 60)
+ANSWER_CACHE_MAX_SIZE = _get_int("ANSWER_CACHE_MAX_SIZE", 1024)
+ANSWER_CACHE_BYPASS_PATTERN = os.getenv(
+    "ANSWER_CACHE_BYPASS_PATTERN",
+    r"\b(today|tonight|tomorrow|yesterday|now|right now|latest|current|currently|breaking|live|recent|"
+    r"this (morning|evening|week|weekend|month)|score|scores|weather|price|prices|stock|stocks)\b"
+)
+
+# llm response cache for the deterministic (temperature 0) rewrite/planning calls: `exact`, `semantic` or `off`
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "exact")
+LLM_CACHE_TTL_SECONDS = _get_float("LLM_CACHE_TTL_SECONDS", 60 * 60)
+LLM_CACHE_MAX_SIZE = _get_int("LLM_CACHE_MAX_SIZE", 1024)
+LLM_CACHE_SIMILARITY_THRESHOLD = _get_float("LLM_CACHE_SIMILARITY_THRESHOLD", 0.97)
+LLM_CACHE_EMBEDDING_MODEL = os.getenv("LLM_CACHE_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# conversation checkpoints of the master agent, `sqlite` or `postgres`
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "sqlite")
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "master_checkpoints.sqlite")
+CHECKPOINT_POSTGRES_URL = os.getenv("CHECKPOINT_POSTGRES_URL", "")
+# sqlite reader connections, or max connections of the postgres pool
+CHECKPOINT_POOL_SIZE = _get_int("CHECKPOINT_POOL_SIZE", 4)
+CHECKPOINT_KEEP_LAST = _get_int("CHECKPOINT_KEEP_LAST", 20)
+CHECKPOINT_SESSION_TTL_SECONDS = _get_float("CHECKPOINT_SESSION_TTL_SECONDS", 7 * 24 * 60 * 60)
+# 0 disables the background compaction
+CHECKPOINT_COMPACTION_INTERVAL_SECONDS = _get_float("CHECKPOINT_COMPACTION_INTERVAL_SECONDS", 10 * 60)
+
+# query rewrite
+REWRITE_SKIP_SELF_CONTAINED = _get_bool("REWRITE_SKIP_SELF_CONTAINED", True)
+REWRITE_HISTORY_MAX_MESSAGES = _get_int("REWRITE_HISTORY_MAX_MESSAGES", 6)
+REWRITE_HISTORY_MAX_CHARS_PER_MESSAGE = _get_int("REWRITE_HISTORY_MAX_CHARS_PER_MESSAGE", 500)
+
+# web search execution: `adaptive` answers simple queries from a single search of the rewritten query
+# and plans the others, `plan` always plans, `direct` never does
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "adaptive")
+# longest query (in words) the adaptive mode still considers simple
+DIRECT_MAX_WORDS = _get_int("DIRECT_MAX_WORDS", 8)
+
+# token budgets of the search results put in the prompts
+CONTEXT_TOKEN_BUDGET = _get_int("CONTEXT_TOKEN_BUDGET", 6000)
+PREV_STEPS_CONTEXT_TOKEN_BUDGET = _get_int("PREV_STEPS_CONTEXT_TOKEN_BUDGET", 1500)
+
+# master agent, `keyword` routes clear search intents straight to the web search agent, `llm` always asks gpt-4o
+ROUTER = os.getenv("ROUTER", "keyword")
+MASTER_HISTORY_MAX_MESSAGES = _get_int("MASTER_HISTORY_MAX_MESSAGES", 10)
+MASTER_HISTORY_MAX_CHARS_PER_MESSAGE = _get_int("MASTER_HISTORY_MAX_CHARS_PER_MESSAGE", 1000)
+
+# admission control of /stream: graph runs in flight per process, requests allowed to wait for a slot
+# and for how long, before they are turned away with a 503
+ADMISSION_MAX_IN_FLIGHT = _get_int("ADMISSION_MAX_IN_FLIGHT", 32)
+ADMISSION_MAX_QUEUE = _get_int("ADMISSION_MAX_QUEUE", 64)
+ADMISSION_QUEUE_TIMEOUT_SECONDS = _get_float("ADMISSION_QUEUE_TIMEOUT_SECONDS", 10.0)
+# Retry-After sent with the 503s
+ADMISSION_RETRY_AFTER_SECONDS = _get_float("ADMISSION_RETRY_AFTER_SECONDS", 2.0)
+# per session and per client ip (429 with Retry-After), 0 disables the limit
+SESSION_MAX_IN_FLIGHT = _get_int("SESSION_MAX_IN_FLIGHT", 1)
+SESSION_REQUESTS_PER_MINUTE = _get_float("SESSION_REQUESTS_PER_MINUTE", 20)
+SESSION_BURST = _get_int("SESSION_BURST", 5)
+CLIENT_REQUESTS_PER_MINUTE = _get_float("CLIENT_REQUESTS_PER_MINUTE", 120)
+CLIENT_BURST = _get_int("CLIENT_BURST", 20)
+# take the client ip from X-Forwarded-For, only behind a proxy that sets it
+TRUST_FORWARDED_FOR = _get_bool("TRUST_FORWARDED_FOR", False)
+# upstream budgets shared by every request of the process, calls wait for a token; 0 disables
+LLM_REQUESTS_PER_SECOND = _get_float("LLM_REQUESTS_PER_SECOND", 0)
+LLM_BURST = _get_int("LLM_BURST", 10)
+SEARCH_REQUESTS_PER_SECOND = _get_float("SEARCH_REQUESTS_PER_SECOND", 0)
+SEARCH_BURST = _get_int("SEARCH_BURST", 10)
+
+# end to end deadline of a /stream request, every llm and search call gets what is left of it (0 disables)
+REQUEST_DEADLINE_SECONDS = _get_float("REQUEST_DEADLINE_SECONDS", 45.0)
+# kept for the answer, the steps before it stop and the answer is written from what they have by then
+DEADLINE_ANSWER_RESERVE_SECONDS = _get_float("DEADLINE_ANSWER_RESERVE_SECONDS", 15.0)
+# hedged requests: a duplicate llm json call or search query is sent when the first one is slower than
+# the HEDGE_PERCENTILE of its recent latencies, the first answer wins
+HEDGE_ENABLED = _get_bool("HEDGE_ENABLED", False)
+HEDGE_PERCENTILE = _get_float("HEDGE_PERCENTILE", 0.95)
+HEDGE_MIN_SAMPLES = _get_int("HEDGE_MIN_SAMPLES", 20)
+
+# sse streaming, answer tokens are coalesced for at most this long before being sent (0 sends every token)
+STREAM_FLUSH_INTERVAL_SECONDS = _get_float("STREAM_FLUSH_INTERVAL_SECONDS", 0.05)
+# how often a stream checks that its client is still there; a run whose client left is cancelled
+DISCONNECT_POLL_INTERVAL_SECONDS = _get_float("DISCONNECT_POLL_INTERVAL_SECONDS", 0.5)
+# cancel requests reaching another worker than the run are passed on through the shared cache
+CANCELLATION_MARKER_TTL_SECONDS = _get_float("CANCELLATION_MARKER_TTL_SECONDS", 5 * 60)
+
+# serving, every worker is a process with its own event loop. sessions only survive a switch of worker
+# with a checkpointer they share (CHECKPOINT_BACKEND sqlite on one host, postgres across hosts)
+HOST = os.getenv("HOST", "localhost")
+PORT = _get_int("PORT", 8080)
+WORKERS = _get_int("WORKERS", 1)
+# on shutdown, streams in flight get this long to finish before they are cut
+SHUTDOWN_DRAIN_SECONDS = _get_float("SHUTDOWN_DRAIN_SECONDS", 30.0)
+
+# batch runs (POST /batch and batch_runner.py): graph runs in flight per batch, identical requests of a
+# batch are run once
+BATCH_CONCURRENCY = _get_int("BATCH_CONCURRENCY", 8)
+BATCH_MAX_CONCURRENCY = _get_int("BATCH_MAX_CONCURRENCY", 32)
+# largest batch accepted by the endpoint, the cli has no limit
+BATCH_MAX_REQUESTS = _get_int("BATCH_MAX_REQUESTS", 1000)
+# admission slots the runs of every batch of the process can hold together, the others stay free for /stream
+BATCH_MAX_IN_FLIGHT = _get_int("BATCH_MAX_IN_FLIGHT", max(ADMISSION_MAX_IN_FLIGHT // 2, 1))
+
+# observability
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# export node and llm spans, requires the opentelemetry sdk to be installed and configured
+OTEL_ENABLED = _get_bool("OTEL_ENABLED", False)
+# length of the search result snippets sent to the client in `sources` events
+SOURCE_SNIPPET_MAX_CHARS = _get_int("SOURCE_SNIPPET_MAX_CHARS", 300)
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+from langchain_core.runnables import RunnableConfig
+
+import config
+from metrics.metrics import DEADLINE_DEGRADATIONS, HEDGED_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def new_deadline() -> Optional[float]:
+    if config.REQUEST_DEADLINE_SECONDS <= 0:
+        return None
+    return time.time() + config.REQUEST_DEADLINE_SECONDS
+
+
+def get_deadline(runnable_config: Optional[RunnableConfig]) -> Optional[float]:
+    return (runnable_config or {}).get("configurable", {}).get("deadline")
+
+
+def stage_budget(runnable_config: Optional[RunnableConfig], default: Optional[float]) -> Optional[float]:
+    """Time a call made before the answer may take: its own timeout, cut to what is left before the answer reserve."""
+    deadline = get_deadline(runnable_config)
+    if deadline is None:
+        return default
+    remaining = deadline - config.DEADLINE_ANSWER_RESERVE_SECONDS - time.time()
+    return max(min(default, remaining) if default else remaining, 0.0)
+
+
+def answer_budget(runnable_config: Optional[RunnableConfig]) -> Optional[float]:
+    """Time the reply to the user may take: what is left of the deadline, the answer reserve included."""
+    deadline = get_deadline(runnable_config)
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0.0)
+
+
+async def first_chunk_within(chunks: AsyncIterator[T], timeout: Optional[float]) -> AsyncIterator[T]:
+    """Passes the chunks on, raises asyncio.TimeoutError when the first one is not there within timeout seconds.
+
+    A stream that has started is not cut, the user is already reading it.
+    """
+    iterator = chunks.__aiter__()
+    try:
+        first = await asyncio.wait_for(iterator.__anext__(), timeout)
+    except StopAsyncIteration:
+        return
+    yield first
+    async for chunk in iterator:
+        yield chunk
+
+
+def is_expired(runnable_config: Optional[RunnableConfig], node: str) -> bool:
+    # nodes before the answer check this and hand over what they have instead of starting new work
+    if stage_budget(runnable_config, 1.0) > 0:
+        return False
+    logger.info("deadline reached, %s is skipped", node)
+    DEADLINE_DEGRADATIONS.inc(node=node)
+    return True
+
+
+class LatencyTracker:
+    """Rolling window of the latencies of one upstream, the hedging delay is its HEDGE_PERCENTILE."""
+
+    def __init__(self, name: str, window: int = 200):
+        self.name = name
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self._samples) < config.HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(int(config.HEDGE_PERCENTILE * len(samples)), len(samples) - 1)]
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+
+
+def get_latency_tracker(name: str) -> LatencyTracker:
+    tracker = _trackers.get(name)
+    if tracker is None:
+        tracker = _trackers[name] = LatencyTracker(name)
+    return tracker
+
+
+async def hedged(call: Callable[[], Awaitable[T]], tracker: LatencyTracker) -> T:
+    """Run the call, and a second copy of it when the first is slower than usual; the first answer wins."""
+
+    async def attempt():
+        started_at = time.perf_counter()
+        result = await call()
+        tracker.observe(time.perf_counter() - started_at)
+        return result
+
+    delay = tracker.hedge_delay() if config.HEDGE_ENABLED else None
+    if delay is None:
+        return await attempt()
+
+    pending = {asyncio.ensure_future(attempt())}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            HEDGED_REQUESTS.inc(upstream=tracker.name)
+            pending.add(asyncio.ensure_future(attempt()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
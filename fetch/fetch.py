@@ -0,0 +1,286 @@
+import asyncio
+import ipaddress
+import logging
+import re
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import httpcore
+import httpx
+from bs4 import BeautifulSoup
+
+import config
+from cache.cache import CacheBackend, get_cache
+from metrics.metrics import CANCELLED_WORK, FETCH_DURATION, FETCH_PAGES
+from schemas import PageContent
+
+logger = logging.getLogger(__name__)
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# elements that never hold the main text of a page
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "svg", "iframe", "form",
+                    "nav", "header", "footer", "aside"]
+# lines shorter than this are menus, buttons and captions
+MIN_LINE_CHARS = 40
+
+
+def extract_text(html: str) -> str:
+    soup = BeautifulSoup(html, HTML_PARSER)
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    root = soup.find("article") or soup.find("main") or soup.body or soup
+    lines = (re.sub(r"\s+", " ", line).strip() for line in root.get_text("\n").splitlines())
+    return "\n".join(line for line in lines if len(line) >= MIN_LINE_CHARS)
+
+
+def chunk_text(text: str, max_chars: int) -> List[str]:
+    # paragraphs are packed into chunks of at most max_chars, longer paragraphs are split
+    chunks, current = [], ""
+    for paragraph in text.split("\n"):
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:cut])
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class BlockedAddressError(httpcore.ConnectError):
+    pass
+
+
+async def resolve(host: str, port: int) -> List[str]:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+
+class PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Connects to the addresses a host resolves to only once they are checked to be public.
+
+    The check and the connection use the same DNS answer, so a host that resolves to a public address when
+    checked and to an internal one when connecting (DNS rebinding) is never reached. The request itself keeps
+    the host name, for the Host header and the TLS server name.
+    """
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options=None) -> httpcore.AsyncNetworkStream:
+        try:
+            addresses = await resolve(host, port)
+        except (OSError, UnicodeError, ValueError) as e:
+            raise httpcore.ConnectError(f"{host} does not resolve: {e}") from e
+        if not addresses or not all(is_public_address(address) for address in addresses):
+            raise BlockedAddressError(f"{host} does not resolve to public addresses only")
+        error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                                  socket_options=None) -> httpcore.AsyncNetworkStream:
+        raise BlockedAddressError("unix sockets are never fetched")
+
+    async def sleep(self, seconds: float):
+        await self._backend.sleep(seconds)
+
+
+class PageFetcher:
+    def __init__(self,
+                 max_concurrency: int = config.FETCH_MAX_CONCURRENCY,
+                 max_per_host: int = config.FETCH_MAX_PER_HOST,
+                 max_bytes: int = config.FETCH_MAX_BYTES,
+                 timeout: float = config.FETCH_TIMEOUT_SECONDS,
+                 max_redirects: int = config.FETCH_MAX_REDIRECTS,
+                 allow_private_addresses: bool = config.FETCH_ALLOW_PRIVATE_ADDRESSES):
+        self.max_bytes = max_bytes
+        self.max_per_host = max_per_host
+        self.max_redirects = max_redirects
+        self.allow_private_addresses = allow_private_addresses
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        if not allow_private_addresses:
+            # httpx has no option for the network backend of its connection pool
+            transport._pool._network_backend = PublicAddressBackend()
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            timeout=timeout,
+            # result urls come from anywhere on the web, every redirect is checked before it is followed
+            follow_redirects=False,
+            headers={"User-Agent": "Mozilla/5.0 (compatible; searchgpt-fetcher/1.0)",
+                     "Accept": "text/html,text/plain;q=0.9"},
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # a slow host can only hold a few of the global slots. host -> [semaphore, fetches using it], hosts
+        # are forgotten when their last fetch is done
+        self._host_slots: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def _host_slot(self, host: str):
+        entry = self._host_slots.get(host)
+        if entry is None:
+            entry = self._host_slots[host] = [asyncio.Semaphore(self.max_per_host), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._host_slots[host]
+
+    @staticmethod
+    def is_allowed(url: str) -> bool:
+        """Only http(s) urls are fetched. Their addresses are checked when connecting, see PublicAddressBackend."""
+        parts = urlsplit(url)
+        return parts.scheme in ("http", "https") and bool(parts.hostname)
+
+    @staticmethod
+    def get_cache() -> CacheBackend:
+        return get_cache("pages", config.PAGE_CACHE_TTL_SECONDS, config.PAGE_CACHE_MAX_SIZE)
+
+    async def fetch(self, url: str) -> Optional[PageContent]:
+        cache = self.get_cache()
+        cached = await cache.get(url)
+        page = PageContent(**cached) if cached is not None else None
+        if page is not None and time.time() - page.fetched_at < config.PAGE_REVALIDATE_SECONDS:
+            FETCH_PAGES.inc(outcome="cache_hit")
+            return page
+
+        headers = {"If-None-Match": page.etag} if page is not None and page.etag else {}
+        target = url
+        for _ in range(self.max_redirects + 1):
+            if not self.is_allowed(target):
+                logger.info("not fetching %s, it is not an http(s) url", target)
+                FETCH_PAGES.inc(outcome="blocked")
+                return None
+            async with self._host_slot(urlsplit(target).hostname), self._semaphore:
+                started_at = time.perf_counter()
+                try:
+                    async with self.client.stream("GET", target, headers=headers) as response:
+                        if response.has_redirect_location:
+                            target = urljoin(target, response.headers["location"])
+                            continue
+                        if response.status_code == 304 and page is not None:
+                            FETCH_PAGES.inc(outcome="not_modified")
+                            page = page.model_copy(update={"fetched_at": time.time()})
+                            await cache.set(url, page.model_dump())
+                            return page
+                        content_type = response.headers.get("content-type", "")
+                        if response.status_code != 200 or not content_type.startswith(("text/html", "text/plain")):
+                            FETCH_PAGES.inc(outcome="skipped")
+                            return None
+                        body = await self._read_capped(response)
+                        etag = response.headers.get("etag")
+                        encoding = response.charset_encoding or "utf-8"
+                except httpx.HTTPError as e:
+                    if isinstance(e.__cause__, BlockedAddressError):
+                        logger.info("not fetching %s, it does not resolve to a public address", target)
+                        FETCH_PAGES.inc(outcome="blocked")
+                    else:
+                        logger.debug("fetch failed for %s: %s", target, e)
+                        FETCH_PAGES.inc(outcome="error")
+                    return None
+                finally:
+                    FETCH_DURATION.observe(time.perf_counter() - started_at)
+            break
+        else:
+            logger.debug("fetch of %s gave up after %s redirects", url, self.max_redirects)
+            FETCH_PAGES.inc(outcome="too_many_redirects")
+            return None
+
+        text = body.decode(encoding, errors="replace")
+        # parsing a large page takes long enough to hold up every other stream on the loop
+        if content_type.startswith("text/html"):
+            text = await asyncio.to_thread(extract_text, text)
+        page = PageContent(url=url, etag=etag, fetched_at=time.time(),
+                           chunks=chunk_text(text, config.FETCH_CHUNK_CHARS))
+        FETCH_PAGES.inc(outcome="ok")
+        await cache.set(url, page.model_dump())
+        return page
+
+    async def _read_capped(self, response: httpx.Response) -> bytes:
+        body = bytearray()
+        async for data in response.aiter_bytes():
+            body += data
+            if len(body) >= self.max_bytes:
+                FETCH_PAGES.inc(outcome="truncated")
+                break
+        return bytes(body[:self.max_bytes])
+
+    async def fetch_pages(self, urls: List[str], budget: float = config.FETCH_BUDGET_SECONDS
+                          ) -> Dict[str, PageContent]:
+        """Fetch the pages concurrently, whatever is not back within the budget is cancelled and left out."""
+        if not urls:
+            return {}
+        tasks = {asyncio.ensure_future(self.fetch(url)): url for url in urls}
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=budget)
+        except asyncio.CancelledError:
+            CANCELLED_WORK.inc(sum(not task.done() for task in tasks), kind="fetch")
+            raise
+        finally:
+            # also when the step itself is cancelled
+            for task in tasks:
+                task.cancel()
+        if pending:
+            FETCH_PAGES.inc(len(pending), outcome="over_budget")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        pages = {}
+        for task in done:
+            if task.exception() is not None:
+                logger.warning("fetch failed for %s: %s", tasks[task], task.exception())
+            elif task.result() is not None and task.result().chunks:
+                pages[tasks[task]] = task.result()
+        return pages
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_fetcher: Optional[PageFetcher] = None
+
+
+def get_page_fetcher() -> PageFetcher:
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = PageFetcher()
+    return _fetcher
+
+
+async def close_page_fetcher():
+    global _fetcher
+    if _fetcher is not None:
+        await _fetcher.aclose()
+        _fetcher = None
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from typing import List, Optional
+
+import aiosqlite
+
+import config
+from metrics.metrics import PASSAGE_INDEX_LOOKUPS
+from schemas import SearchResult
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+")
+# words that match nearly every passage, they are left out of the fts query and the coverage
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "by", "with", "from", "and", "or", "is", "are", "was",
+    "were", "be", "what", "who", "when", "where", "which", "how", "does", "do", "did", "it", "its", "about",
+}
+MAX_QUERY_TERMS = 16
+
+
+def query_terms(query: str) -> List[str]:
+    terms = [token for token in TOKEN_RE.findall(query.lower()) if token not in STOPWORDS]
+    return list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+
+
+def _stem(token: str) -> str:
+    # rough plural folding, the fts side uses the porter stemmer
+    return token[:-1] if len(token) > 3 and token.endswith("s") else token
+
+
+def coverage(terms: List[str], content: str) -> float:
+    if not terms:
+        return 0.0
+    tokens = {_stem(token) for token in TOKEN_RE.findall(content.lower())}
+    return sum(_stem(term) in tokens for term in terms) / len(terms)
+
+
+class PassageIndex:
+    """On-disk full text index of the passages we got from the web, shared by every session and worker."""
+
+    def __init__(self, path: str = config.PASSAGE_INDEX_PATH,
+                 ttl_seconds: float = config.PASSAGE_INDEX_TTL_SECONDS,
+                 max_passages: int = config.PASSAGE_INDEX_MAX_PASSAGES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_passages = max_passages
+        # inserts between two prunes on top of the timer, keeps a burst of searches from overshooting the max count
+        self.prune_every = max(max_passages // 10, 1)
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._inserted_since_prune = 0
+        self._prune_task: Optional[asyncio.Task] = None
+
+    async def _get_conn(self) -> aiosqlite.Connection:
+        if self._conn is not None:
+            return self._conn
+        async with self._connect_lock:
+            if self._conn is not None:
+                return self._conn
+            conn = await aiosqlite.connect(self.path, check_same_thread=False)
+            # must be set before the first table is created, lets pruning give pages back to the filesystem
+            await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.executescript("""
+                CREATE TABLE IF NOT EXISTS passages (
+                    id INTEGER PRIMARY KEY,
+                    hash TEXT NOT NULL UNIQUE,
+                    url TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    indexed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS passages_indexed_at ON passages (indexed_at);
+                CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+                    content, content='passages', content_rowid='id', tokenize='porter unicode61'
+                );
+                CREATE TRIGGER IF NOT EXISTS passages_ai AFTER INSERT ON passages BEGIN
+                    INSERT INTO passages_fts (rowid, content) VALUES (new.id, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS passages_ad AFTER DELETE ON passages BEGIN
+                    INSERT INTO passages_fts (passages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END;
+            """)
+            await conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def open(self):
+        await self._get_conn()
+
+    async def add(self, results: List[SearchResult]):
+        if not results:
+            return
+        conn = await self._get_conn()
+        now = time.time()
+        rows = []
+        for result in results:
+            content = result.content[:config.PASSAGE_INDEX_MAX_CHARS]
+            digest = hashlib.sha1(f"{result.url}\n{content}".encode()).hexdigest()
+            rows.append((digest, result.url, content, now))
+        # a passage seen again is fresh again
+        await conn.executemany(
+            "INSERT INTO passages (hash, url, content, indexed_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (hash) DO UPDATE SET indexed_at = excluded.indexed_at",
+            rows
+        )
+        await conn.commit()
+        # pruning scans the whole table, it runs in the background instead of on the search path
+        self._inserted_since_prune += len(rows)
+        if self._inserted_since_prune >= self.prune_every and (self._prune_task is None or self._prune_task.done()):
+            self._prune_task = asyncio.create_task(self._prune_logged())
+
+    async def prune(self):
+        self._inserted_since_prune = 0
+        conn = await self._get_conn()
+        await conn.execute("DELETE FROM passages WHERE indexed_at < ?", (time.time() - self.ttl_seconds,))
+        async with conn.execute("SELECT count(*) FROM passages") as cursor:
+            (count,) = await cursor.fetchone()
+        if count > self.max_passages:
+            await conn.execute(
+                "DELETE FROM passages WHERE id IN (SELECT id FROM passages ORDER BY indexed_at, id LIMIT ?)",
+                (count - self.max_passages,)
+            )
+        await conn.commit()
+        await conn.execute("PRAGMA incremental_vacuum")
+
+    async def _prune_logged(self):
+        try:
+            await self.prune()
+        except Exception:
+            logger.exception("passage index pruning failed")
+
+    async def search(self, query: str, limit: int = config.SEARCH_MAX_RESULTS) -> Optional[List[SearchResult]]:
+        """Fresh passages matching the query, None when there are not enough of them to skip the web search."""
+        terms = query_terms(query)
+        if not terms:
+            return None
+        conn = await self._get_conn()
+        match = " OR ".join(f'"{term}"' for term in terms)
+        async with conn.execute(
+                "SELECT p.url, p.content FROM passages_fts JOIN passages p ON p.id = passages_fts.rowid "
+                "WHERE passages_fts MATCH ? AND p.indexed_at >= ? ORDER BY bm25(passages_fts) LIMIT ?",
+                (match, time.time() - self.ttl_seconds, limit * 4)
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+        # bm25 ranks passages matching a single rare term high, recall is judged on the terms they cover
+        results = [SearchResult(url=url, content=content) for url, content in rows
+                   if coverage(terms, content) >= config.PASSAGE_INDEX_MIN_COVERAGE][:limit]
+        if len(results) < config.PASSAGE_INDEX_MIN_RESULTS:
+            PASSAGE_INDEX_LOOKUPS.inc(outcome="miss")
+            return None
+        PASSAGE_INDEX_LOOKUPS.inc(outcome="hit")
+        return results
+
+    async def aclose(self):
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            await asyncio.gather(self._prune_task, return_exceptions=True)
+            self._prune_task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+async def run_pruning(index: PassageIndex, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await index._prune_logged()
+
+
+_index: Optional[PassageIndex] = None
+
+
+def get_passage_index() -> Optional[PassageIndex]:
+    global _index
+    if not config.PASSAGE_INDEX_ENABLED:
+        return None
+    if _index is None:
+        _index = PassageIndex()
+    return _index
+
+
+async def close_passage_index():
+    global _index
+    if _index is not None:
+        await _index.aclose()
+        _index = None
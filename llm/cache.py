@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+import math
+from collections import OrderedDict
+from typing import List, Optional, Type
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableConfig
+from langchain_openai import OpenAIEmbeddings
+from pydantic import BaseModel
+
+import config
+from cache.cache import SingleFlight, get_cache
+from deadline.deadline import get_latency_tracker, hedged
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticIndex:
+    """Bounded in-process index of prompt embeddings pointing to exact cache keys."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[str, List[float]]] = OrderedDict()
+
+    def add(self, namespace: str, key: str, vector: List[float]):
+        self._entries[key] = (namespace, _normalize(vector))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def search(self, namespace: str, vector: List[float], threshold: float) -> Optional[str]:
+        # the scan runs in a thread on a snapshot of the namespace, prompts added meanwhile are not seen
+        entries = [(key, entry_vector) for key, (entry_namespace, entry_vector) in self._entries.items()
+                   if entry_namespace == namespace]
+        return await asyncio.to_thread(_best_match, entries, _normalize(vector), threshold)
+
+
+def _best_match(entries: List[tuple[str, List[float]]], vector: List[float], threshold: float) -> Optional[str]:
+    best_key, best_score = None, threshold
+    for key, entry_vector in entries:
+        score = sum(a * b for a, b in zip(vector, entry_vector))
+        if score >= best_score:
+            best_key, best_score = key, score
+    return best_key
+
+
+class LLMResponseCache:
+    def __init__(self, mode: str = config.LLM_CACHE_MODE):
+        self.mode = mode
+        self.similarity_threshold = config.LLM_CACHE_SIMILARITY_THRESHOLD
+        self.cache = get_cache("llm", config.LLM_CACHE_TTL_SECONDS, config.LLM_CACHE_MAX_SIZE)
+        self.index = SemanticIndex(config.LLM_CACHE_MAX_SIZE) if mode == "semantic" else None
+        self.embeddings = OpenAIEmbeddings(model=config.LLM_CACHE_EMBEDDING_MODEL) if mode == "semantic" else None
+        self.in_flight = SingleFlight("llm")
+
+    async def ainvoke(self, llm: BaseChatModel, prompt: str, schema: Optional[Type[BaseModel]] = None,
+                      runnable_config: Optional[RunnableConfig] = None, timeout: Optional[float] = None):
+        if self.mode == "off":
+            return await _ainvoke(llm, prompt, schema, runnable_config, timeout)
+
+        model_name = getattr(llm, "model_name", type(llm).__name__)
+        schema_name = schema.__name__ if schema else "str"
+        namespace = f"{model_name}:{schema_name}"
+        schema_json = json.dumps(schema.model_json_schema(), sort_keys=True) if schema else ""
+        key = hashlib.sha256(f"{namespace}\n{schema_json}\n{prompt}".encode()).hexdigest()
+
+        cached = await self.cache.get(key)
+        vector = None
+        if cached is None and self.index is not None:
+            vector = await self.embeddings.aembed_query(prompt)
+            similar_key = await self.index.search(namespace, vector, self.similarity_threshold)
+            if similar_key is not None:
+                cached = await self.cache.get(similar_key)
+
+        if cached is not None:
+            return schema.model_validate(cached) if schema else cached
+
+        async def call():
+            resp = await _ainvoke(llm, prompt, schema, runnable_config, timeout)
+            await self.cache.set(key, resp.model_dump() if schema else resp)
+            if self.index is not None:
+                self.index.add(namespace, key, vector)
+            return resp
+
+        # identical prompts of concurrent runs are sent once, every run waiting at most its own timeout
+        return await self.in_flight.do(key, call, timeout)
+
+
+async def _ainvoke(llm: BaseChatModel, prompt: str, schema: Optional[Type[BaseModel]],
+                   runnable_config: Optional[RunnableConfig], timeout: Optional[float]):
+    runnable = llm.with_structured_output(schema) if schema else llm | StrOutputParser()
+    # short deterministic calls, a slow one is raced by a duplicate when hedging is on
+    tracker = get_latency_tracker(f"llm:{getattr(llm, 'model_name', type(llm).__name__)}")
+    return await asyncio.wait_for(hedged(lambda: runnable.ainvoke(prompt, runnable_config), tracker), timeout)
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMResponseCache()
+    return _llm_cache
+
+
+async def cached_ainvoke(llm: BaseChatModel, prompt: str, schema: Optional[Type[BaseModel]] = None,
+                         runnable_config: Optional[RunnableConfig] = None, timeout: Optional[float] = None):
+    """Invoke a deterministic llm call, returning the cached response for the same model/prompt/schema.
+
+    Raises asyncio.TimeoutError when no answer came within timeout seconds.
+    """
+    return await get_llm_cache().ainvoke(llm, prompt, schema, runnable_config, timeout)
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+from schemas import QueryPlan, QueryPlanStep, QueryStepExecution
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:8]
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic offline stand-in for ChatOpenAI, used by the benchmarks.
+
+    `latency` is the time before the first token, `tokens_per_second` the streaming rate.
+    Chat models with bound tools always call the first tool.
+    """
+
+    model_name: str = "fake"
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    response_tokens: int = 50
+    plan_steps: int = 3
+    tool_name: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _response(self, messages: List[BaseMessage]) -> AIMessage:
+        prompt = messages[-1].content
+        usage = {"input_tokens": len(prompt) // 4 + 1, "output_tokens": self.response_tokens,
+                 "total_tokens": len(prompt) // 4 + 1 + self.response_tokens}
+        if self.tool_name:
+            return AIMessage(content="", tool_calls=[{"name": self.tool_name, "args": {}, "id": _digest(prompt)}],
+                             usage_metadata={**usage, "output_tokens": 1, "total_tokens": usage["input_tokens"] + 1})
+        words = [f"word{i}-{_digest(prompt)}" for i in range(self.response_tokens)]
+        return AIMessage(content=" ".join(words), usage_metadata=usage)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        raise NotImplementedError("FakeChatModel only supports async calls")
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._response(messages)
+        generation_time = len(message.content.split(" ")) / self.tokens_per_second if self.tokens_per_second else 0
+        await asyncio.sleep(self.latency + generation_time)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        message = self._response(messages)
+        await asyncio.sleep(self.latency)
+        if message.tool_calls:
+            tool_call = message.tool_calls[0]
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="", usage_metadata=message.usage_metadata,
+                tool_call_chunks=[{"name": tool_call["name"], "args": "{}", "id": tool_call["id"], "index": 0}]
+            ))
+            return
+
+        tokens = message.content.split(" ")
+        for idx, token in enumerate(tokens):
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token if idx == 0 else f" {token}"))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=message.usage_metadata))
+
+    def bind_tools(self, tools, **kwargs: Any):
+        tool = tools[0]
+        return self.model_copy(update={"tool_name": getattr(tool, "name", None) or tool.__name__})
+
+    def with_structured_output(self, schema, **kwargs: Any):
+        async def structured_output(prompt: Any):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            await asyncio.sleep(self.latency)
+            key = _digest(str(prompt))
+            if schema is QueryPlan:
+                steps = [QueryPlanStep(id=i, step=f"Research part {i} of {key}", dependencies=[])
+                         for i in range(self.plan_steps - 1)]
+                steps.append(QueryPlanStep(id=len(steps), step=f"Combine the findings of {key}",
+                                           dependencies=[step.id for step in steps]))
+                return QueryPlan(steps=steps)
+            if schema is QueryStepExecution:
+                return QueryStepExecution(search_queries=[f"search {key} {i}" for i in range(2)])
+            raise NotImplementedError(f"FakeChatModel has no structured output for {schema}")
+
+        return RunnableLambda(structured_output, name="FakeStructuredOutput")
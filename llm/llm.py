@@ -1,22 +1,115 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import openai
+from langchain_core.language_models import BaseChatModel
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
 
+import config
+from admission.admission import get_upstream_rate_limiter
+from llm.fake import FakeChatModel
+from metrics.metrics import LLM_QUEUE_DURATION
+
+# errors after which the next model of the fallback chain is tried, anything else is a bug in the request
+FALLBACK_EXCEPTIONS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class TimedRateLimiter(BaseRateLimiter):
+    """The process wide llm rate limiter, recording how long the calls of one model wait for it."""
+
+    def __init__(self, limiter: BaseRateLimiter, model_name: str):
+        self.limiter = limiter
+        self.model_name = model_name
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        queued_at = time.perf_counter()
+        acquired = self.limiter.acquire(blocking=blocking)
+        if acquired:
+            LLM_QUEUE_DURATION.observe(time.perf_counter() - queued_at, model=self.model_name)
+        return acquired
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        queued_at = time.perf_counter()
+        acquired = await self.limiter.aacquire(blocking=blocking)
+        if acquired:
+            LLM_QUEUE_DURATION.observe(time.perf_counter() - queued_at, model=self.model_name)
+        return acquired
+
+
+def _rate_limiter(model_name: str) -> Optional[BaseRateLimiter]:
+    limiter = get_upstream_rate_limiter("llm")
+    return TimedRateLimiter(limiter, model_name) if limiter is not None else None
+
 
 class LLMFactory:
+    # clients are shared by the whole process so that every node reuses the connection pool of its model
+    _clients: Dict[str, BaseChatModel] = {}
+    # clients wrapped with their fallback chain, by model name
+    _routed: Dict[str, BaseChatModel] = {}
+
     def __init__(self):
-        self.llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            max_tokens=None,
-            timeout=None,
-            max_retries=2,
-        )
+        self.llm = self.get_llm_by_name(config.DEFAULT_MODEL)
+
+    def get_client(self, model_name: str) -> BaseChatModel:
+        llm = self._clients.get(model_name)
+        if llm is None:
+            if config.LLM_PROVIDER == "fake":
+                llm = FakeChatModel(model_name=model_name,
+                                    latency=config.FAKE_LLM_LATENCY_SECONDS,
+                                    tokens_per_second=config.FAKE_LLM_TOKENS_PER_SECOND,
+                                    rate_limiter=_rate_limiter(model_name))
+            else:
+                llm = ChatOpenAI(
+                    model=model_name,
+                    temperature=0,
+                    max_tokens=None,
+                    timeout=config.LLM_ATTEMPT_TIMEOUT_SECONDS or None,
+                    max_retries=config.LLM_MAX_RETRIES,
+                    # token usage of streamed answers is reported to the metrics
+                    stream_usage=True,
+                    # one request budget for every llm call of the process
+                    rate_limiter=_rate_limiter(model_name),
+                )
+            self._clients[model_name] = llm
+        return llm
 
     def get_llm_by_name(self, model_name: str):
-        return self.llm
+        llm = self._routed.get(model_name)
+        if llm is None:
+            llm = self.get_client(model_name)
+            fallbacks = [self.get_client(name) for name in config.MODEL_FALLBACKS.get(model_name, [])
+                         if name != model_name]
+            if fallbacks:
+                # bind_tools and with_structured_output are applied to every model of the chain
+                llm = llm.with_fallbacks(fallbacks, exceptions_to_handle=FALLBACK_EXCEPTIONS)
+            self._routed[model_name] = llm
+        return llm
+
+    @staticmethod
+    def model_for_node(node: str, runnable_config: Optional[RunnableConfig] = None) -> str:
+        requested = (runnable_config or {}).get("configurable", {}).get("model")
+        return config.NODE_MODELS.get(node) or requested or config.DEFAULT_MODEL
+
+    def get_llm_for_node(self, node: str, runnable_config: Optional[RunnableConfig] = None):
+        return self.get_llm_by_name(self.model_for_node(node, runnable_config))
+
+    @staticmethod
+    def configured_models() -> List[str]:
+        models = {config.DEFAULT_MODEL, *config.NODE_MODELS.values()}
+        return sorted(models)
 
     def complete_with_structured_output(self, response_model: dict, prompt: str):
         self.llm.with_structured_output(response_model)
         return self.llm.invoke(prompt)
 
     def complete(self, prompt: str):
-        return self.llm.invoke(prompt);
\ No newline at end of file
+        return self.llm.invoke(prompt);
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+
+import config
+from metrics.metrics import NODE_DURATION, NODE_ERRORS, LLM_DURATION, LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS, \
+    CANCELLED_WORK
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+
+def _get_tracer():
+    if trace is None or not config.OTEL_ENABLED:
+        return None
+    return trace.get_tracer("searchgpt")
+
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Records the wall time of every graph node and llm call, and the tokens of llm calls.
+
+    When opentelemetry is installed and OTEL_ENABLED is set the same runs are exported as spans.
+    """
+
+    def __init__(self):
+        # run_id -> (kind, label, start time)
+        self.runs: Dict[UUID, tuple] = {}
+        self.first_token_seen = set()
+        self.tracer = _get_tracer()
+        self.spans: Dict[UUID, Any] = {}
+        self.parents: Dict[UUID, Optional[UUID]] = {}
+        # llm run_id -> the chain it runs in. a cancelled llm call gets no callback of its own, it is closed
+        # when its chain is cancelled
+        self.llm_parents: Dict[UUID, Optional[UUID]] = {}
+
+    def _start_span(self, name: str, run_id: UUID, parent_run_id: Optional[UUID], attributes: dict):
+        self.parents[run_id] = parent_run_id
+        parent_span = None
+        while parent_run_id is not None and parent_span is None:
+            parent_span = self.spans.get(parent_run_id)
+            parent_run_id = self.parents.get(parent_run_id)
+        context = trace.set_span_in_context(parent_span) if parent_span is not None else None
+        self.spans[run_id] = self.tracer.start_span(name, context=context, attributes=attributes)
+
+    def _end_span(self, run_id: UUID, attributes: Optional[dict] = None, error: Optional[BaseException] = None):
+        self.parents.pop(run_id, None)
+        span = self.spans.pop(run_id, None)
+        if span is None:
+            return
+        if attributes:
+            span.set_attributes(attributes)
+        if error is not None:
+            span.record_exception(error)
+        span.end()
+
+    async def on_chain_start(self, serialized: Optional[Dict[str, Any]], inputs: Any, *, run_id: UUID,
+                             parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None,
+                             metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        # node runs are the only chains tagged with their graph step
+        node = kwargs.get("name") or (metadata or {}).get("langgraph_node") or ""
+        is_node = not node.startswith("__") and any(t.startswith("graph:step:") for t in tags or [])
+        if is_node:
+            self.runs[run_id] = ("node", node, time.perf_counter())
+            if self.tracer is not None:
+                self._start_span(f"node {node}", run_id, parent_run_id, {"langgraph.node": node})
+        elif self.tracer is not None:
+            # kept so that llm spans nested in runnables of a node find the node span
+            self.parents[run_id] = parent_run_id
+
+    async def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            NODE_DURATION.observe(time.perf_counter() - run[2], node=run[1])
+        if self.tracer is not None:
+            self._end_span(run_id)
+
+    async def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            NODE_DURATION.observe(time.perf_counter() - run[2], node=run[1])
+            # a cancelled run is not a failure of the node
+            if isinstance(error, asyncio.CancelledError):
+                CANCELLED_WORK.inc(kind="node", node=run[1])
+            else:
+                NODE_ERRORS.inc(node=run[1])
+        if isinstance(error, asyncio.CancelledError):
+            for llm_run_id in [llm_run_id for llm_run_id, parent in self.llm_parents.items() if parent == run_id]:
+                await self.on_llm_error(error, run_id=llm_run_id)
+        if self.tracer is not None:
+            self._end_span(run_id, error=error)
+
+    async def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                                  parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None,
+                                  metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        metadata = metadata or {}
+        labels = {"model": metadata.get("ls_model_name", "unknown"), "node": metadata.get("langgraph_node", "")}
+        self.runs[run_id] = ("llm", labels, time.perf_counter())
+        self.llm_parents[run_id] = parent_run_id
+        if self.tracer is not None:
+            self._start_span(f"llm {labels['model']}", run_id, parent_run_id,
+                             {"llm.model": labels["model"], "langgraph.node": labels["node"]})
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if run_id in self.first_token_seen:
+            return
+        run = self.runs.get(run_id)
+        if run is not None:
+            self.first_token_seen.add(run_id)
+            LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - run[2], **run[1])
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        self.first_token_seen.discard(run_id)
+        self.llm_parents.pop(run_id, None)
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        labels = run[1]
+        LLM_DURATION.observe(time.perf_counter() - run[2], **labels)
+
+        prompt_tokens, completion_tokens = 0, 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+        LLM_TOKENS.inc(prompt_tokens, kind="prompt", **labels)
+        LLM_TOKENS.inc(completion_tokens, kind="completion", **labels)
+        if self.tracer is not None:
+            self._end_span(run_id, {"llm.prompt_tokens": prompt_tokens, "llm.completion_tokens": completion_tokens})
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.first_token_seen.discard(run_id)
+        self.llm_parents.pop(run_id, None)
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            LLM_DURATION.observe(time.perf_counter() - run[2], **run[1])
+            if isinstance(error, asyncio.CancelledError):
+                CANCELLED_WORK.inc(kind="llm", node=run[1]["node"])
+        if self.tracer is not None:
+            self._end_span(run_id, error=error)
+
+
+metrics_callback_handler = MetricsCallbackHandler()
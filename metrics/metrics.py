@@ -0,0 +1,157 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(labels: dict) -> LabelValues:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: Dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[_labels(labels)] += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[_labels(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.values[_labels(labels)] -= amount
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[idx] += 1
+        counts[-1] += 1
+        self.sums[key] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', str(bound)))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal in-process registry rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+        # called before rendering, to refresh gauges owned by other modules
+        self.collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+NODE_DURATION = registry.histogram("searchgpt_node_duration_seconds", "Wall time of a graph node run")
+NODE_ERRORS = registry.counter("searchgpt_node_errors_total", "Graph node runs that raised")
+LLM_DURATION = registry.histogram("searchgpt_llm_call_duration_seconds", "Wall time of an llm call")
+LLM_TIME_TO_FIRST_TOKEN = registry.histogram("searchgpt_llm_time_to_first_token_seconds",
+                                             "Time until a streaming llm call produced its first token")
+LLM_QUEUE_DURATION = registry.histogram("searchgpt_llm_queue_seconds",
+                                        "Time an llm call waited for the upstream rate limiter, by model")
+LLM_TOKENS = registry.counter("searchgpt_llm_tokens_total", "Prompt and completion tokens of llm calls")
+SEARCH_DURATION = registry.histogram("searchgpt_search_duration_seconds", "Wall time of a search query")
+SEARCH_QUEUE_DURATION = registry.histogram("searchgpt_search_queue_seconds",
+                                           "Time a search query waited for a concurrency slot")
+SEARCH_QUERIES = registry.counter("searchgpt_search_queries_total", "Search queries by outcome")
+SEARCH_RESULTS = registry.counter("searchgpt_search_results_total", "Search results returned by the provider")
+FETCH_DURATION = registry.histogram("searchgpt_fetch_duration_seconds", "Wall time of a page download")
+FETCH_PAGES = registry.counter("searchgpt_fetch_pages_total", "Page fetches by outcome")
+PASSAGE_INDEX_LOOKUPS = registry.counter("searchgpt_passage_index_lookups_total",
+                                         "Local passage index lookups by outcome (hit, miss)")
+ANSWER_CACHE_LOOKUPS = registry.counter("searchgpt_answer_cache_lookups_total",
+                                        "Final answer cache lookups by outcome (hit, miss, bypass)")
+SPECULATIVE_SEARCHES = registry.counter("searchgpt_speculative_searches_total",
+                                        "Speculative searches by outcome (reused, merged, cancelled)")
+CHECKPOINT_DURATION = registry.histogram("searchgpt_checkpoint_duration_seconds",
+                                         "Latency of checkpoint reads and writes by operation")
+CHECKPOINTS_PRUNED = registry.counter("searchgpt_checkpoints_pruned_total", "Checkpoint rows deleted by compaction")
+CHECKPOINT_WRITE_BYTES = registry.histogram("searchgpt_checkpoint_write_bytes",
+                                            "Serialized channel values written with a checkpoint",
+                                            buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576))
+RESULT_STORE_MISSING = registry.counter("searchgpt_result_store_missing_total",
+                                        "Step results referenced by a graph state but no longer stored")
+COALESCED_CALLS = registry.counter("searchgpt_coalesced_calls_total",
+                                   "Calls that joined an identical call already in flight, by upstream")
+CACHE_REQUESTS = registry.gauge("searchgpt_cache_requests", "Cache lookups by cache and result")
+ADMISSION_IN_FLIGHT = registry.gauge("searchgpt_admission_in_flight", "Graph runs admitted and not finished")
+ADMISSION_QUEUE_DEPTH = registry.gauge("searchgpt_admission_queue_depth", "Requests waiting for a graph run slot")
+ADMISSION_REJECTIONS = registry.counter("searchgpt_admission_rejections_total", "Requests turned away by reason")
+HEDGED_REQUESTS = registry.counter("searchgpt_hedged_requests_total", "Duplicate upstream requests sent by hedging")
+DEADLINE_DEGRADATIONS = registry.counter("searchgpt_deadline_degradations_total",
+                                         "Work skipped or cut short by the request deadline, by node")
+RUNS_CANCELLED = registry.counter("searchgpt_runs_cancelled_total",
+                                  "Graph runs cancelled before their answer, by reason (disconnect, cancel_request)")
+CANCELLED_RUN_AGE = registry.histogram("searchgpt_cancelled_run_age_seconds",
+                                       "How long cancelled graph runs had been running, by reason")
+CANCELLED_WORK = registry.counter("searchgpt_cancelled_work_total",
+                                  "Node runs, llm calls, searches and page fetches cut short by a cancellation or "
+                                  "timeout, by kind")
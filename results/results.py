@@ -0,0 +1,53 @@
+import asyncio
+import hashlib
+import json
+from typing import List, Optional
+
+import config
+from cache.cache import CacheBackend, get_cache
+from metrics.metrics import RESULT_STORE_MISSING
+from schemas import SingleStepResults, StepResultsRef
+
+
+class ResultsMissingError(LookupError):
+    """Step results referenced by a graph state are no longer in the store."""
+
+
+class ResultStore:
+    """Step results stored under the hash of their content.
+
+    Identical results are stored once, whichever session and step produced them, and the graph state
+    only carries the small StepResultsRef pointing at them.
+    """
+
+    def __init__(self, cache: CacheBackend):
+        self.cache = cache
+
+    async def put(self, results: SingleStepResults) -> StepResultsRef:
+        value = results.model_dump(mode="json")
+        ref = hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+        await self.cache.set(ref, value)
+        return StepResultsRef(step=results.step, ref=ref, result_count=len(results.results))
+
+    async def get(self, ref: StepResultsRef) -> SingleStepResults:
+        value = await self.cache.get(ref.ref)
+        if value is None:
+            # expired or evicted before the run that stored it got to use it, answering from nothing would
+            # look like the search found nothing
+            RESULT_STORE_MISSING.inc()
+            raise ResultsMissingError(f"results of step {ref.step!r} are no longer in the result store")
+        return SingleStepResults(**value)
+
+    async def get_many(self, refs: List[StepResultsRef]) -> List[SingleStepResults]:
+        return list(await asyncio.gather(*(self.get(ref) for ref in refs)))
+
+
+_store: Optional[ResultStore] = None
+
+
+def get_result_store() -> ResultStore:
+    global _store
+    if _store is None:
+        _store = ResultStore(get_cache("results", config.RESULT_STORE_TTL_SECONDS, config.RESULT_STORE_MAX_SIZE,
+                                       backend=config.RESULT_STORE_BACKEND))
+    return _store
@@ -1,7 +1,10 @@
-from server import app
+import uvicorn
 
+import config
 
-if __name__ == "__main__":
-    import uvicorn
 
-    uvicorn.run(app, host="localhost", port=8080)
\ No newline at end of file
+if __name__ == "__main__":
+    # the app is passed as an import string so that every worker process imports its own copy;
+    # uvicorn waits for the draining streams a little longer than they are given
+    uvicorn.run("server:app", host=config.HOST, port=config.PORT, workers=config.WORKERS,
+                timeout_graceful_shutdown=config.SHUTDOWN_DRAIN_SECONDS + 5)
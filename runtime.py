@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Optional
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
+
+import config
+from admission.admission import AdmissionController
+from agents.master import Master
+from agents.websearchagent.websearchagent import get_websearch_agent
+from cache.cache import close_caches
+from cancellation.cancellation import RunRegistry
+from fetch.fetch import close_page_fetcher, get_page_fetcher
+from index.index import close_passage_index, get_passage_index, run_pruning
+from checkpoints.checkpoints import CheckpointStore, create_checkpoint_store, run_compaction
+from llm.llm import LLMFactory
+from search.search import close_search_provider, get_search_provider
+
+logger = logging.getLogger(__name__)
+
+
+class AppRuntime:
+    """Process wide objects built once at application startup and shared by every request."""
+
+    def __init__(self):
+        self.checkpoint_store: Optional[CheckpointStore] = None
+        self.checkpointer: Optional[BaseCheckpointSaver] = None
+        self.compaction_task: Optional[asyncio.Task] = None
+        self.pruning_task: Optional[asyncio.Task] = None
+        self.master_agent = None
+        self.admission: Optional[AdmissionController] = None
+        self.runs = RunRegistry()
+
+    async def start(self):
+        self.admission = AdmissionController()
+        self.checkpoint_store = create_checkpoint_store()
+        self.checkpointer = await self.checkpoint_store.open()
+        if config.CHECKPOINT_COMPACTION_INTERVAL_SECONDS > 0:
+            self.compaction_task = asyncio.create_task(
+                run_compaction(self.checkpoint_store, config.CHECKPOINT_COMPACTION_INTERVAL_SECONDS)
+            )
+
+        self.master_agent = Master(self.checkpointer).get_agent()
+        await self.warm_up()
+
+    async def warm_up(self):
+        # everything the first request would otherwise build, so that a fresh worker answers as fast as the others
+        get_websearch_agent()
+        for model_name in LLMFactory.configured_models():
+            LLMFactory().get_llm_by_name(model_name)
+        get_search_provider()
+        if config.FETCH_PAGES:
+            get_page_fetcher()
+        index = get_passage_index()
+        if index is not None:
+            await index.open()
+            if config.PASSAGE_INDEX_PRUNE_INTERVAL_SECONDS > 0 and self.pruning_task is None:
+                self.pruning_task = asyncio.create_task(
+                    run_pruning(index, config.PASSAGE_INDEX_PRUNE_INTERVAL_SECONDS)
+                )
+
+        if config.WORKERS > 1 and config.CACHE_BACKEND == "memory":
+            logger.warning("running %s workers with CACHE_BACKEND=memory, cache hits are not shared between them",
+                           config.WORKERS)
+
+    async def stop(self):
+        if self.compaction_task is not None:
+            self.compaction_task.cancel()
+            await asyncio.gather(self.compaction_task, return_exceptions=True)
+            self.compaction_task = None
+        if self.pruning_task is not None:
+            self.pruning_task.cancel()
+            await asyncio.gather(self.pruning_task, return_exceptions=True)
+            self.pruning_task = None
+        await close_search_provider()
+        await close_page_fetcher()
+        await close_passage_index()
+        await close_caches()
+        if self.checkpoint_store is not None:
+            await self.checkpoint_store.close()
+            self.checkpoint_store = None
+
+
+runtime = AppRuntime()
+
+
+def get_runtime() -> AppRuntime:
+    return runtime
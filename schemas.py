@@ -22,6 +22,11 @@ class ChatRequest(BaseModel):
     llm_model_name: Optional[str] = None
 
 
+class BatchRequest(BaseModel):
+    requests: List[ChatRequest]
+    concurrency: Optional[int] = None
+
+
 class QueryPlanStep(BaseModel):
     id: int = Field(..., description="Unique id of the step")
     step: str
@@ -60,11 +65,25 @@ class SearchResult(BaseModel):
         return f"URL: {self.url}\n Summary: {self.content}"
 
 
+class PageContent(BaseModel):
+    url: str
+    etag: Optional[str] = None
+    fetched_at: float
+    chunks: List[str]
+
+
 class SingleStepResults(BaseModel):
     step: str
     results: List[SearchResult]
 
 
+class StepResultsRef(BaseModel):
+    """Results of a step as kept in the graph state, the results themselves are in the result store."""
+    step: str
+    ref: str
+    result_count: int = 0
+
+
 class StepSearchResultsTracker(BaseModel):
     results: List[SingleStepResults]
 
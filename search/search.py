@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+
+import httpx
+from tavily import InvalidAPIKeyError, MissingAPIKeyError, UsageLimitExceededError
+
+import config
+from admission.admission import get_upstream_rate_limiter
+from cache.cache import CacheBackend, SingleFlight, get_cache
+from deadline.deadline import get_latency_tracker, hedged
+from metrics.metrics import CANCELLED_WORK, SEARCH_DURATION, SEARCH_QUEUE_DURATION, SEARCH_QUERIES, SEARCH_RESULTS
+from schemas import SearchResult
+
+logger = logging.getLogger(__name__)
+
+
+class SearchProvider(ABC):
+    @abstractmethod
+    async def search(self, query: str) -> List[SearchResult]:
+        ...
+
+    async def aclose(self):
+        pass
+
+
+class TavilySearchProvider(SearchProvider):
+    base_url = "https://api.tavily.com"
+
+    def __init__(self, api_key: Optional[str] = None, max_results: int = config.SEARCH_MAX_RESULTS):
+        api_key = api_key or os.getenv("TAVILY_API_KEY")
+        if not api_key:
+            raise MissingAPIKeyError()
+        self.api_key = api_key
+        self.max_results = max_results
+        # one pooled client per provider, connections are kept alive between searches
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Content-Type": "application/json"},
+            timeout=config.SEARCH_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=config.SEARCH_MAX_CONCURRENCY,
+                                max_keepalive_connections=config.SEARCH_MAX_CONCURRENCY),
+        )
+
+    async def search(self, query: str) -> List[SearchResult]:
+        response = await self.client.post("/search", json={
+            "api_key": self.api_key,
+            "query": query,
+            "search_depth": "basic",
+            "max_results": self.max_results,
+        })
+
+        if response.status_code == 429:
+            raise UsageLimitExceededError("Too many requests.")
+        if response.status_code == 401:
+            raise InvalidAPIKeyError()
+        response.raise_for_status()
+
+        return [SearchResult(url=x['url'], content=x['content']) for x in response.json()['results']]
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class FakeSearchProvider(SearchProvider):
+    """Deterministic offline provider for tests and benchmarks."""
+
+    def __init__(self, latency: float = 0.0, max_results: int = config.SEARCH_MAX_RESULTS):
+        self.latency = latency
+        self.max_results = max_results
+
+    async def search(self, query: str) -> List[SearchResult]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        digest = hashlib.sha1(query.encode()).hexdigest()[:8]
+        return [
+            SearchResult(url=f"https://example.com/{digest}/{i}", content=f"Result {i} for {query}")
+            for i in range(self.max_results)
+        ]
+
+
+_provider: Optional[SearchProvider] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_latency_tracker = get_latency_tracker("search")
+_in_flight = SingleFlight("search")
+
+
+def get_search_provider() -> SearchProvider:
+    global _provider
+    if _provider is None:
+        if config.SEARCH_PROVIDER == "fake":
+            _provider = FakeSearchProvider(latency=config.FAKE_SEARCH_LATENCY_SECONDS)
+        else:
+            _provider = TavilySearchProvider()
+    return _provider
+
+
+def set_search_provider(provider: SearchProvider):
+    global _provider
+    _provider = provider
+
+
+def get_search_cache() -> Optional[CacheBackend]:
+    if not config.SEARCH_CACHE_ENABLED:
+        return None
+    return get_cache("search", config.SEARCH_CACHE_TTL_SECONDS, config.SEARCH_CACHE_MAX_SIZE)
+
+
+def normalize_query(query: str) -> str:
+    # "  What is LangGraph? " and "what is langgraph" share a cache entry
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!.")
+
+
+async def close_search_provider():
+    global _provider, _semaphore
+    if _provider is not None:
+        await _provider.aclose()
+        _provider = None
+    # the semaphore belongs to the event loop that is shutting down
+    _semaphore = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(config.SEARCH_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def search_query(query: str, timeout: float = config.SEARCH_TIMEOUT_SECONDS) -> List[SearchResult]:
+    cache = get_search_cache()
+    cache_key = normalize_query(query)
+    if cache is not None:
+        cached = await cache.get(cache_key)
+        if cached is not None:
+            SEARCH_QUERIES.inc(outcome="cache_hit")
+            return [SearchResult(**x) for x in cached]
+
+    # the same query searched by concurrent requests or steps goes to the provider once, but a request joining
+    # a search started by another one still only waits for what is left of its own budget. The provider call
+    # itself is not timed, it is cancelled once every request waiting for it has given up
+    try:
+        return await _in_flight.do(cache_key, lambda: _search_provider_query(query, cache, cache_key), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("search timed out after %ss: %s", timeout, query)
+        SEARCH_QUERIES.inc(outcome="timeout")
+        return []
+
+
+async def _search_provider_query(query: str, cache: Optional[CacheBackend], cache_key: str) -> List[SearchResult]:
+    provider = get_search_provider()
+    provider_name = type(provider).__name__
+    queued_at = time.perf_counter()
+    rate_limiter = get_upstream_rate_limiter("search")
+    if rate_limiter is not None:
+        await rate_limiter.aacquire()
+    async with _get_semaphore():
+        started_at = time.perf_counter()
+        SEARCH_QUEUE_DURATION.observe(started_at - queued_at, provider=provider_name)
+        try:
+            results = await hedged(lambda: provider.search(query), _latency_tracker)
+        except (httpx.HTTPError, UsageLimitExceededError) as e:
+            logger.warning("search failed for %s: %s", query, e)
+            SEARCH_QUERIES.inc(outcome="error")
+            return []
+        except asyncio.CancelledError:
+            # every run waiting for this query is gone
+            CANCELLED_WORK.inc(kind="search")
+            raise
+        finally:
+            SEARCH_DURATION.observe(time.perf_counter() - started_at, provider=provider_name)
+
+    SEARCH_QUERIES.inc(outcome="ok")
+    SEARCH_RESULTS.inc(len(results), provider=provider_name)
+
+    # empty results are not cached, they are usually a transient upstream problem
+    if cache is not None and results:
+        await cache.set(cache_key, [x.model_dump() for x in results])
+    return results
+
+
+async def iter_search_queries(queries: List[str], timeout: float = config.SEARCH_TIMEOUT_SECONDS,
+                              in_flight: Optional[Dict[str, Awaitable[List[SearchResult]]]] = None
+                              ) -> AsyncIterator[Tuple[str, List[SearchResult]]]:
+    # queries of one step are issued together and every query is handed out as soon as it returns.
+    # `in_flight` are searches started earlier (speculatively), a query matching one of them is not issued again
+    in_flight = in_flight or {}
+    started = {normalize_query(query) for query in in_flight}
+
+    async def wait(query: str, search: Awaitable[List[SearchResult]]):
+        return query, await search
+
+    async def run(query: str):
+        return query, await search_query(query, timeout)
+
+    tasks = [asyncio.ensure_future(wait(query, search)) for query, search in in_flight.items()]
+    for query in queries:
+        if normalize_query(query) not in started:
+            started.add(normalize_query(query))
+            tasks.append(asyncio.ensure_future(run(query)))
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
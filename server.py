@@ -1,15 +1,30 @@
 import asyncio
+import logging
+import math
+import time
 import uuid
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.messages import AIMessageChunk, HumanMessage
 
-from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+from sse_starlette.sse import AppStatus, EventSourceResponse, ServerSentEvent
+from starlette.background import BackgroundTask
 
-from agents.master import Master
-from agents.websearchagent.websearchagent import WebSearchAgent
-from schemas import ChatRequest
+from agents.master import answer_before_run
+from agents.websearchagent.speculative import cancel_speculative_searches
+import config as settings
+from admission.admission import AdmissionRejected, AdmissionTicket
+from batch.batch import BatchRun
+from cache.cache import get_cache_stats
+from cancellation.cancellation import ActiveRun, record_cancellation
+from deadline.deadline import new_deadline
+from metrics.callbacks import metrics_callback_handler
+from metrics.metrics import registry
+from runtime import get_runtime
+from schemas import BatchRequest
 from pydantic import BaseModel
 
 from dotenv import load_dotenv
@@ -17,7 +32,19 @@ import json
 
 _ = load_dotenv()
 
-app = FastAPI()
+logging.basicConfig(level=settings.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # graphs, checkpointer connection and clients are built once and shared by every request
+    await get_runtime().start()
+    yield
+    await get_runtime().stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,8 +66,105 @@ def convert_pydantic_to_dict(obj):
         return obj
 
 
-async def event_stream(query: str, request: Request, session_id=None):
-    agent = Master().get_agent()
+# node and custom events the client is told about, everything else is filtered out by astream_events itself
+PROGRESS_NODES = ["summarize_query", "generate_plan", "step_executor", "direct_search", "search_results",
+                  "cached_answer", "fallback_answer"]
+# nodes whose chat model tokens are streamed back as the answer
+ANSWER_NODES = {"chat_response", "converstationagent", "smalltalk"}
+
+
+def thought_event(message: str, session_id: str, **extra) -> ServerSentEvent:
+    data = {"message": message, **extra, "session_id": session_id}
+    return ServerSentEvent(event="thoughts", data=json.dumps(data))
+
+
+def to_server_sent_event(event: dict, session_id: str):
+    event_type = event["event"]
+    if event_type == "on_custom_event":
+        if event["name"] == "search_results":
+            return sources_event(event["data"], session_id)
+        if event["name"] == "fallback_answer":
+            # reply written by the agent itself when the llm did not answer in time
+            return answer_event([event["data"]["answer"]], session_id)
+        return None
+    if event_type == "on_chat_model_start":
+        if event["metadata"].get("langgraph_node") in ANSWER_NODES:
+            return ServerSentEvent(event="assistant_msg_start", data="")
+        return None
+
+    # only the node run itself, not runnables with the same name nested in it
+    if not any(t.startswith("graph:step:") for t in event.get("tags", [])):
+        return None
+    name = event["name"]
+    if event_type == "on_chain_end" and name == "summarize_query":
+        return thought_event("Understanding query", session_id)
+    if event_type == "on_chain_start" and name == "generate_plan":
+        return thought_event("Generating plan", session_id)
+    if event_type == "on_chain_end" and name == "generate_plan":
+        plan = convert_pydantic_to_dict(event["data"]["output"]["plan"])
+        return thought_event("Generated plan", session_id, plan=plan)
+    if event_type == "on_chain_start" and name in ("step_executor", "direct_search"):
+        return thought_event("Searching the Internet", session_id)
+    return None
+
+
+def sources_event(data: dict, session_id: str) -> ServerSentEvent:
+    results = [{"url": x.url, "content": x.content[:settings.SOURCE_SNIPPET_MAX_CHARS]} for x in data["results"]]
+    payload = {"message": "Found sources", "step_id": data["step_id"], "step": data["step"],
+               "query": data["query"], "results": results, "session_id": session_id}
+    return ServerSentEvent(event="sources", data=json.dumps(payload))
+
+
+def cached_answer_events(data: dict, session_id: str) -> list:
+    # the events of the run that produced the answer, in the same order
+    events = [thought_event("Generated plan", session_id, plan=data["plan"], cached=True)]
+    for source in data["sources"]:
+        payload = {"message": "Found sources", "step_id": source["step_id"], "step": source["step"],
+                   "query": source["step"], "results": source["results"], "session_id": session_id}
+        events.append(ServerSentEvent(event="sources", data=json.dumps(payload)))
+    events.append(ServerSentEvent(event="assistant_msg_start", data=""))
+    events.append(answer_event([data["answer"]], session_id))
+    return events
+
+
+def answer_chunk(event: dict):
+    if event["event"] == "on_chat_model_stream" and event["metadata"].get("langgraph_node") in ANSWER_NODES:
+        chunk: AIMessageChunk = event["data"]["chunk"]
+        return chunk.content
+    return None
+
+
+def answer_event(chunks: list, session_id: str) -> ServerSentEvent:
+    # same payload as json.dumps of the dict, without building it for every batch
+    data = ('{"message": "Received response", "search_result": ' + json.dumps("".join(chunks)) +
+            ', "session_id": ' + json.dumps(session_id) + '}')
+    return ServerSentEvent(event="assistant", data=data)
+
+
+async def watch_cancellation(request: Request, run: ActiveRun) -> str:
+    while True:
+        if await request.is_disconnected():
+            return "disconnect"
+        if await get_runtime().runs.is_cancelled_elsewhere(run):
+            return "cancel_request"
+        try:
+            await asyncio.wait_for(run.cancelled.wait(), timeout=settings.DISCONNECT_POLL_INTERVAL_SECONDS)
+            return run.reason
+        except asyncio.TimeoutError:
+            pass
+
+
+async def event_stream(query: str, request: Request, session_id=None, ticket: AdmissionTicket = None):
+    try:
+        async for server_sent_event in run_event_stream(query, request, session_id):
+            yield server_sent_event
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+async def run_event_stream(query: str, request: Request, session_id=None):
+    agent = get_runtime().master_agent
 
     if not session_id:
         session_id = uuid.uuid4().__str__()
@@ -48,68 +172,180 @@ async def event_stream(query: str, request: Request, session_id=None):
         yield ServerSentEvent(event="start_session", data=json.dumps(data))
 
     messages = [HumanMessage(content=query)]
-    agent_config = {"configurable": {"thread_id": session_id}}
-    async for event in agent.astream_events({"messages": messages}, config=agent_config,
-                                            version="v2"):
-        if await request.is_disconnected():
-            break
-        is_on_chain_end = event["event"] == "on_chain_end"
-        is_graph_step = any(t.startswith("graph:step:") for t in event.get("tags", []))
-        is_on_chain_start = event["event"] == "on_chain_start"
-        is_chat_model_stream = event["event"] == "on_chat_model_stream"
-        is_on_chat_model_start = event["event"] == "on_chat_model_start"
-
-        data = None
-
-        if is_on_chain_end and is_graph_step and event["name"] == "summarize_query":
-            data = {"message": "Understanding query", "session_id": session_id}
-            yield ServerSentEvent(event="thoughts", data=json.dumps(data))
-
-        elif is_on_chain_start and is_graph_step and event["name"] == "generate_plan":
-            data = {"message": "Generating plan", "session_id": session_id}
-            yield ServerSentEvent(event="thoughts", data=json.dumps(data))
-
-        elif is_on_chain_end and is_graph_step and event["name"] == "generate_plan":
-            plan = convert_pydantic_to_dict(event["data"]["output"]["plan"])
-            data = {"message": "Generated plan", "plan": plan, "session_id": session_id}
-            yield ServerSentEvent(event="thoughts", data=json.dumps(data))
-
-        elif is_on_chain_start and is_graph_step and event["name"] == "step_executor":
-            data = {"message": "Searching the Internet", "session_id": session_id}
-            yield ServerSentEvent(event="thoughts", data=json.dumps(data))
-
-        # elif is_on_chain_end and is_graph_step and event["name"] == "chat_response":
-        #     search_result = convert_pydantic_to_dict(event["data"]["output"]["response"])
-        #     data = {"message": "Received response", "search_result": search_result, "session_id": session_id}
-        #     yield ServerSentEvent(event="assistant", data=json.dumps(data))
-        elif is_on_chat_model_start and event["metadata"]["langgraph_node"] == "chat_response":
-            yield ServerSentEvent(event="assistant_msg_start", data="")
-
-        elif is_on_chat_model_start and event["metadata"]["langgraph_node"] == "converstationagent":
-            yield ServerSentEvent(event="assistant_msg_start", data="")
-
-        elif is_chat_model_stream and event["metadata"]["langgraph_node"] == "chat_response":
-            # search_result = convert_pydantic_to_dict(event["data"]["output"]["response"])
-            search_result_chunk: AIMessageChunk = event["data"]["chunk"]
-            # In case of tool call content will be blank
-            if search_result_chunk.content != "":
-                data = {"message": "Received response", "search_result": search_result_chunk.content,
-                        "session_id": session_id}
-                yield ServerSentEvent(event="assistant", data=json.dumps(data))
-
-        elif is_chat_model_stream and event["metadata"]["langgraph_node"] == "converstationagent":
-            # search_result = convert_pydantic_to_dict(event["data"]["output"]["response"])
-            search_result_chunk: AIMessageChunk = event["data"]["chunk"]
+    # every node and upstream call of the run shares this deadline, see deadline.py
+    agent_config = {"configurable": {"thread_id": session_id, "deadline": new_deadline()},
+                    "callbacks": [metrics_callback_handler]}
+    cached = await answer_before_run(agent, query, agent_config)
+    if cached is not None:
+        for server_sent_event in cached_answer_events(cached, session_id):
+            yield server_sent_event
+        yield ServerSentEvent(event="end", data=f"{json.dumps({'message': 'Stream ended'})}")
+        return
+    events = agent.astream_events({"messages": messages}, config=agent_config, version="v2",
+                                  include_names=PROGRESS_NODES, include_types=["chat_model"])
+
+    flush_interval = settings.STREAM_FLUSH_INTERVAL_SECONDS
+    run = get_runtime().runs.register(session_id)
+    cancellation_watcher = asyncio.create_task(watch_cancellation(request, run))
+    cancelled_by = None
+    finished = False
+    next_event = None
+    # answer tokens are sent in micro-batches of at most flush_interval seconds
+    chunks = []
+    flush_at = 0.0
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+            timeout = max(flush_at - time.monotonic(), 0) if chunks else None
+            done, _ = await asyncio.wait({next_event, cancellation_watcher}, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if cancellation_watcher in done:
+                cancelled_by = cancellation_watcher.result()
+                break
+            if next_event not in done:
+                yield answer_event(chunks, session_id)
+                chunks = []
+                continue
+
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                finished = True
+                break
+            next_event = None
+
+            content = answer_chunk(event)
             # In case of tool call content will be blank
-            if search_result_chunk.content != "":
-                data = {"message": "Received response", "search_result": search_result_chunk.content,
-                        "session_id": session_id}
-                yield ServerSentEvent(event="assistant", data=json.dumps(data))
+            if content:
+                if not chunks:
+                    flush_at = time.monotonic() + flush_interval
+                chunks.append(content)
+                if time.monotonic() >= flush_at:
+                    yield answer_event(chunks, session_id)
+                    chunks = []
+                continue
+
+            if event["event"] == "on_custom_event" and event["name"] == "cached_answer":
+                for server_sent_event in cached_answer_events(event["data"], session_id):
+                    yield server_sent_event
+                continue
+
+            server_sent_event = to_server_sent_event(event, session_id)
+            if server_sent_event is not None:
+                if chunks:
+                    yield answer_event(chunks, session_id)
+                    chunks = []
+                yield server_sent_event
 
+        if chunks:
+            yield answer_event(chunks, session_id)
+    except (asyncio.CancelledError, GeneratorExit):
+        # the response was torn down before the graph finished, which only happens when the client left
+        if not finished:
+            cancelled_by = cancelled_by or "disconnect"
+        raise
+    finally:
+        cancellation_watcher.cancel()
+        get_runtime().runs.unregister(run)
+        if cancelled_by is not None:
+            record_cancellation(run, cancelled_by)
+            cancel_speculative_searches(session_id)
+        # cancelling the pending event cancels the graph run, with its nodes, subgraph and upstream calls.
+        # on a disconnect the awaits below are cancelled too, so everything else is done before them
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+        await events.aclose()
+
+    if cancelled_by == "disconnect":
+        return
+    if cancelled_by is not None:
+        yield ServerSentEvent(event="cancelled", data=json.dumps({"reason": cancelled_by, "session_id": session_id}))
     yield ServerSentEvent(event="end", data=f"{json.dumps({'message': 'Stream ended'})}")
 
 
+class DrainingEventSourceResponse(EventSourceResponse):
+    """Lets a stream finish its answer when the server shuts down, instead of cutting it on the exit signal."""
+
+    @staticmethod
+    async def listen_for_exit_signal() -> None:
+        await EventSourceResponse.listen_for_exit_signal()
+        await asyncio.sleep(settings.SHUTDOWN_DRAIN_SECONDS)
+
+
+def client_address(request: Request) -> str:
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if settings.TRUST_FORWARDED_FOR and forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
 @app.get("/stream")
 async def stream(query: str, session_id: str, request: Request):
-    print(session_id)
-    return EventSourceResponse(event_stream(query, request, session_id))
+    logger.info("stream requested for session %s", session_id)
+    if AppStatus.should_exit:
+        # draining, the client retries on another worker or replica
+        raise HTTPException(status_code=503, detail="shutting_down",
+                            headers={"Retry-After": str(math.ceil(settings.ADMISSION_RETRY_AFTER_SECONDS))})
+    try:
+        ticket = await get_runtime().admission.admit(session_id, client_address(request))
+    except AdmissionRejected as e:
+        logger.info("stream rejected for session %s: %s", session_id, e.reason)
+        raise HTTPException(status_code=e.status_code, detail=e.reason,
+                            headers={"Retry-After": str(math.ceil(e.retry_after))})
+    # the ticket is released when the stream ends, or once the response is done if the stream never started
+    return DrainingEventSourceResponse(event_stream(query, request, session_id, ticket),
+                                       background=BackgroundTask(ticket.release))
+
+
+@app.post("/sessions/{session_id}/cancel")
+async def cancel_session(session_id: str):
+    runs = get_runtime().runs
+    cancelled = await runs.cancel(session_id)
+    # with several workers sharing the cache the run may stream from another one, which picks the
+    # cancellation up from there
+    if not cancelled and not runs.shares_cancellations():
+        raise HTTPException(status_code=404, detail="no run in flight for this session")
+    return {"session_id": session_id, "cancelled_runs": cancelled}
+
+
+@app.post("/batch")
+async def batch(body: BatchRequest, request: Request):
+    if len(body.requests) > settings.BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=413, detail=f"at most {settings.BATCH_MAX_REQUESTS} requests per batch")
+    if AppStatus.should_exit:
+        raise HTTPException(status_code=503, detail="shutting_down",
+                            headers={"Retry-After": str(math.ceil(settings.ADMISSION_RETRY_AFTER_SECONDS))})
+    admission = get_runtime().admission
+    try:
+        admission.admit_batch(client_address(request))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.reason,
+                            headers={"Retry-After": str(math.ceil(e.retry_after))})
+    concurrency = min(body.concurrency or settings.BATCH_CONCURRENCY, settings.BATCH_MAX_CONCURRENCY)
+    # every graph run of the batch holds an admission slot, out of the share batches may use
+    run = BatchRun(body.requests, concurrency, admission)
+
+    async def lines():
+        # one json object per line as the requests finish, the summary of the batch comes last
+        async for result in run.results():
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"summary": run.summary()}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return get_cache_stats()
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return get_runtime().admission.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
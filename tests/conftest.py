@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# the fake providers, so that importing the agents never needs credentials or the network
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("SEARCH_PROVIDER", "fake")
+os.environ.setdefault("CACHE_BACKEND", "memory")
+# the sqlite files the runtime opens, out of the working tree
+_data_dir = tempfile.mkdtemp(prefix="searchgpt-tests-")
+for name, filename in (("CHECKPOINT_SQLITE_PATH", "checkpoints.sqlite"), ("CACHE_SQLITE_PATH", "cache.sqlite"),
+                       ("PASSAGE_INDEX_PATH", "passages.sqlite")):
+    os.environ.setdefault(name, os.path.join(_data_dir, filename))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import config
+from admission.admission import AdmissionController, AdmissionRejected, KeyedRateLimiter, TokenBucket
+
+
+def test_token_bucket_reports_the_wait_for_the_next_token():
+    bucket = TokenBucket(rate=1.0, capacity=2)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 0.0
+    assert 0.9 < bucket.try_acquire() <= 1.0
+
+
+def test_keyed_rate_limiter_forgets_the_least_recent_keys():
+    limiter = KeyedRateLimiter(per_minute=60, burst=1, max_keys=2)
+    assert limiter.try_acquire("a") == 0.0
+    assert limiter.try_acquire("a") > 0
+    limiter.try_acquire("b")
+    limiter.try_acquire("c")
+    # "a" was evicted and starts with a full bucket again
+    assert limiter.try_acquire("a") == 0.0
+
+
+def test_admission_rejects_when_the_queue_is_full():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=0, queue_timeout=1, max_batch_in_flight=1)
+        ticket = await controller.admit("s1", "client")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit("s2", "client")
+        assert rejected.value.status_code == 503
+        assert rejected.value.reason == "queue_full"
+        assert rejected.value.retry_after == config.ADMISSION_RETRY_AFTER_SECONDS
+
+        ticket.release()
+        ticket.release()
+        assert controller.in_flight == 0
+        (await controller.admit("s2", "client")).release()
+
+    asyncio.run(scenario())
+
+
+def test_admission_queue_timeout():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.01, max_batch_in_flight=1)
+        ticket = await controller.admit("s1", "client")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit("s2", "client")
+        assert (rejected.value.status_code, rejected.value.reason) == (503, "queue_timeout")
+        assert controller.queued == 0
+        ticket.release()
+
+    asyncio.run(scenario())
+
+
+def test_queued_request_gets_the_released_slot():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=1, max_batch_in_flight=1)
+        ticket = await controller.admit("s1", "client")
+        waiting = asyncio.create_task(controller.admit("s2", "client"))
+        await asyncio.sleep(0.01)
+        assert controller.queued == 1
+        ticket.release()
+        (await waiting).release()
+        assert controller.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_admission_rejects_a_busy_session(monkeypatch):
+    monkeypatch.setattr(config, "SESSION_MAX_IN_FLIGHT", 1)
+
+    async def scenario():
+        controller = AdmissionController(max_in_flight=4, max_queue=4, queue_timeout=1, max_batch_in_flight=1)
+        ticket = await controller.admit("s1", "client")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit("s1", "client")
+        assert (rejected.value.status_code, rejected.value.reason) == (429, "session_busy")
+        ticket.release()
+        (await controller.admit("s1", "client")).release()
+
+    asyncio.run(scenario())
+
+
+def test_admission_rate_limits_clients():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=4, max_queue=4, queue_timeout=1, max_batch_in_flight=1)
+        controller.client_limiter = KeyedRateLimiter(per_minute=60, burst=1)
+        (await controller.admit("s1", "client")).release()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit("s2", "client")
+        assert (rejected.value.status_code, rejected.value.reason) == (429, "client_rate")
+        assert 0.9 < rejected.value.retry_after <= 1.0
+        # a rejected request holds no slot
+        assert controller.in_flight == 0
+        with pytest.raises(AdmissionRejected):
+            controller.admit_batch("client")
+        controller.admit_batch("other client")
+
+    asyncio.run(scenario())
+
+
+def test_batch_runs_leave_slots_to_streams():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=2, max_queue=0, queue_timeout=1, max_batch_in_flight=1)
+        batch_ticket = await controller.admit_batch_run()
+        waiting = asyncio.create_task(controller.admit_batch_run())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        # the slot the batch can not take is still there for a stream
+        stream_ticket = await controller.admit("s1", "client")
+        assert controller.stats()["batch_in_flight"] == 1
+
+        stream_ticket.release()
+        batch_ticket.release()
+        (await asyncio.wait_for(waiting, 1)).release()
+        assert controller.stats()["in_flight"] == 0
+        assert controller.stats()["batch_in_flight"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+import config
+from agents.master import Master, answer_before_run
+from agents.websearchagent.answer_cache import get_cached_answer, is_cacheable, store_answer
+from metrics.metrics import ANSWER_CACHE_LOOKUPS
+from schemas import QueryPlan, QueryPlanStep, SearchResult, SingleStepResults
+
+PLAN = QueryPlan(steps=[QueryPlanStep(id=0, step="history of city 1"), QueryPlanStep(id=1, step="history of city 2")])
+
+
+def step_results(*steps) -> list:
+    return [SingleStepResults(step=step, results=[SearchResult(url=f"https://example.com/{idx}", content=step)])
+            for idx, step in enumerate(steps)]
+
+
+def lookups() -> dict:
+    return {outcome: ANSWER_CACHE_LOOKUPS.values[(("outcome", outcome),)] for outcome in ("hit", "miss")}
+
+
+def test_questions_about_now_are_not_cached(monkeypatch):
+    assert is_cacheable("what is the history of city 1")
+    assert not is_cacheable("what is the weather in city 1")
+    assert not is_cacheable("Latest news about city 1")
+    monkeypatch.setattr(config, "ANSWER_CACHE_ENABLED", False)
+    assert not is_cacheable("what is the history of city 1")
+
+
+def test_only_complete_runs_are_stored():
+    async def scenario(query, plan_results, answer):
+        await store_answer(query, "model", PLAN, plan_results, answer)
+        return await get_cached_answer(query, "model")
+
+    # a step cut by the deadline, no result at all, no answer, a question about now
+    assert asyncio.run(scenario("compare city 1 and city 2", step_results("history of city 1"), "answer")) is None
+    assert asyncio.run(scenario("compare city 3 and city 4",
+                                [SingleStepResults(step=step.step, results=[]) for step in PLAN.steps], "answer")) is None
+    assert asyncio.run(scenario("compare city 5 and city 6", step_results("a", "b"), "")) is None
+    assert asyncio.run(scenario("compare the weather of city 7 and city 8", step_results("a", "b"), "answer")) is None
+
+    cached = asyncio.run(scenario("compare city 9 and city 10", step_results("a", "b"), "answer"))
+    assert cached["answer"] == "answer"
+    assert [source["step_id"] for source in cached["sources"]] == [0, 1]
+    # the lookup ignores case and spacing
+    assert asyncio.run(get_cached_answer("  Compare City 9 and city 10", "model")) == cached
+    assert asyncio.run(get_cached_answer("compare city 9 and city 10", "other model")) is None
+
+
+def test_follow_ups_are_looked_up_after_the_rewrite():
+    async def scenario():
+        agent = Master(MemorySaver()).get_agent()
+        config = {"configurable": {"thread_id": "t1"}}
+        await agent.aupdate_state(config, {"messages": [HumanMessage(content="tell me about city 11"),
+                                                        AIMessage(content="city 11 is old")]},
+                                  as_node="websearcheagent")
+        before = lookups()
+        assert await answer_before_run(agent, "and what about its history?", config) is None
+        assert lookups() == before
+        assert "answer_cache_checked" not in config["configurable"]
+
+        # a question searched as asked is looked up once, the web search agent does not repeat it
+        assert await answer_before_run(agent, "what is the history of city 12", config) is None
+        assert lookups()["miss"] == before["miss"] + 1
+        assert config["configurable"]["answer_cache_checked"] == "what is the history of city 12"
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import batch.batch as batch
+import batch_runner
+from admission.admission import AdmissionController
+from batch.batch import BatchRun
+from schemas import ChatRequest
+
+
+def fake_runs(monkeypatch, latencies: dict = None) -> dict:
+    runs = {"queries": [], "in_flight": 0, "max_in_flight": 0}
+
+    async def run_request(request):
+        runs["queries"].append(request.query)
+        runs["in_flight"] += 1
+        runs["max_in_flight"] = max(runs["max_in_flight"], runs["in_flight"])
+        try:
+            await asyncio.sleep((latencies or {}).get(request.query, 0.01))
+            return {"answer": f"answer to {request.query}"}
+        finally:
+            runs["in_flight"] -= 1
+
+    monkeypatch.setattr(batch, "run_request", run_request)
+    return runs
+
+
+def run_batch(run: BatchRun) -> list:
+    async def scenario():
+        return [result async for result in run.results()]
+
+    return asyncio.run(scenario())
+
+
+def test_identical_requests_run_once(monkeypatch):
+    runs = fake_runs(monkeypatch)
+    requests = [ChatRequest(query="What is LangGraph?"), ChatRequest(query="what is  langgraph"),
+                ChatRequest(query="what is langgraph", llm_model_name="other"), ChatRequest(query="what is python")]
+    run = BatchRun(requests)
+    results = sorted(run_batch(run), key=lambda result: result["index"])
+
+    assert sorted(runs["queries"]) == ["What is LangGraph?", "what is langgraph", "what is python"]
+    assert [result["deduplicated"] for result in results] == [False, True, False, False]
+    assert results[1]["answer"] == "answer to What is LangGraph?"
+    assert run.summary()["unique_requests"] == 3
+    assert run.summary()["completed"] == 4
+
+
+def test_results_come_in_completion_order(monkeypatch):
+    fake_runs(monkeypatch, {"slow": 0.1, "medium": 0.05, "fast": 0.01})
+    requests = [ChatRequest(query=query) for query in ("slow", "medium", "fast")]
+
+    results = run_batch(BatchRun(requests, concurrency=3))
+    assert [result["query"] for result in results] == ["fast", "medium", "slow"]
+    assert [result["index"] for result in results] == [2, 1, 0]
+
+
+def test_runs_take_the_batch_slots_of_the_admission_controller(monkeypatch):
+    runs = fake_runs(monkeypatch)
+    admission = AdmissionController(max_in_flight=4, max_queue=0, queue_timeout=1, max_batch_in_flight=2)
+    requests = [ChatRequest(query=f"question {idx}") for idx in range(6)]
+
+    assert len(run_batch(BatchRun(requests, concurrency=4, admission=admission))) == 6
+    # the batch concurrency is capped by the batch slots
+    assert runs["max_in_flight"] == 2
+    assert admission.stats()["batch_in_flight"] == 0
+
+
+def test_batch_runner_writes_a_line_per_request(tmp_path, capsys):
+    input_path, output_path = tmp_path / "queries.jsonl", tmp_path / "results.jsonl"
+    input_path.write_text('who founded the company number 41\n\n'
+                          '{"query": "who founded the company number 41"}\n'
+                          '{"query": "who founded the company number 42", "history": []}\n')
+
+    asyncio.run(batch_runner.main(SimpleNamespace(input=str(input_path), output=str(output_path), concurrency=2)))
+    results = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1, 2]
+    assert all(result["answer"] and result["sources"] for result in results)
+    summary = json.loads(capsys.readouterr().err)
+    assert (summary["requests"], summary["unique_requests"], summary["errors"]) == (3, 2, 0)
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+from cache.cache import SingleFlight, SqliteCache
+
+
+async def count_entries(cache: SqliteCache) -> int:
+    conn = await cache._get_conn()
+    async with conn.execute("SELECT count(*) FROM cache_entries WHERE namespace = ?", (cache.namespace,)) as cursor:
+        (count,) = await cursor.fetchone()
+    return count
+
+
+def test_sqlite_cache_round_trip(tmp_path):
+    async def scenario():
+        cache = SqliteCache("test", ttl_seconds=60, max_size=10, path=str(tmp_path / "cache.sqlite"))
+        try:
+            await cache.set("key", {"answer": [1, 2]})
+            assert await cache.get("key") == {"answer": [1, 2]}
+            assert await cache.get("other") is None
+            assert cache.stats.as_dict()["hits"] == 1
+            assert cache.stats.as_dict()["misses"] == 1
+        finally:
+            await cache.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_cache_expired_entry_is_a_miss(tmp_path):
+    async def scenario():
+        cache = SqliteCache("test", ttl_seconds=0, max_size=10, path=str(tmp_path / "cache.sqlite"))
+        try:
+            await cache.set("key", "value")
+            await asyncio.sleep(0.01)
+            assert await cache.get("key") is None
+        finally:
+            await cache.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_cache_evicts_least_recently_used_in_batches(tmp_path):
+    async def scenario():
+        cache = SqliteCache("test", ttl_seconds=None, max_size=20, path=str(tmp_path / "cache.sqlite"))
+        try:
+            for i in range(20):
+                await cache.set(f"key{i}", i)
+            # a hit only updates the access time in memory, eviction writes it first
+            assert await cache.get("key0") == 0
+            assert cache._touched
+
+            await cache.set("key20", 20)
+            assert await count_entries(cache) == 21
+
+            await cache.set("key21", 21)
+            assert await count_entries(cache) == 20
+            assert not cache._touched
+            assert await cache.get("key0") == 0
+            assert await cache.get("key1") is None
+            assert await cache.get("key2") is None
+            assert cache.stats.evictions == 2
+        finally:
+            await cache.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_cache_flush_writes_access_times(tmp_path):
+    async def scenario():
+        cache = SqliteCache("test", ttl_seconds=None, max_size=10, path=str(tmp_path / "cache.sqlite"))
+        try:
+            await cache.set("key", "value")
+            await cache.get("key")
+            await cache.flush()
+            conn = await cache._get_conn()
+            async with conn.execute("SELECT created_at < accessed_at FROM cache_entries") as cursor:
+                assert (await cursor.fetchone())[0] == 1
+        finally:
+            await cache.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_cache_connects_once_per_file_in_every_event_loop(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def scenario():
+        caches = [SqliteCache(f"test{idx}", ttl_seconds=60, max_size=10, path=path) for idx in range(3)]
+        try:
+            connections = await asyncio.gather(*(cache._get_conn() for cache in caches))
+            assert all(conn is connections[0] for conn in connections)
+        finally:
+            await caches[0].aclose()
+
+    # the second loop must not reuse the lock or the connection of the first one
+    asyncio.run(scenario())
+    asyncio.run(scenario())
+
+
+def test_single_flight_shares_one_call():
+    async def scenario():
+        flight = SingleFlight("test")
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        results = await asyncio.gather(*(flight.do("key", call) for _ in range(3)))
+        assert results == ["result"] * 3
+        assert len(calls) == 1
+        # a call that is done is not shared anymore
+        assert await flight.do("key", call) == "result"
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_error_reaches_every_caller():
+    async def scenario():
+        flight = SingleFlight("test")
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        results = await asyncio.gather(flight.do("key", call), flight.do("key", call), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not flight._calls
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_joiner_timeout_leaves_the_call_running():
+    async def scenario():
+        flight = SingleFlight("test")
+
+        async def call():
+            await asyncio.sleep(0.1)
+            return "result"
+
+        first = asyncio.create_task(flight.do("key", call))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await flight.do("key", call, timeout=0.01)
+        assert await first == "result"
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_cancels_the_call_once_every_caller_is_gone():
+    async def scenario():
+        flight = SingleFlight("test")
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def call():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(flight.do("key", call)) for _ in range(2)]
+        await started.wait()
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert not flight._calls
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+import asyncio
+
+import config
+from cache.cache import SqliteCache
+from cancellation.cancellation import RunRegistry
+
+
+def test_cancellation_reaches_the_runs_of_other_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "WORKERS", 2)
+    monkeypatch.setattr(config, "CACHE_BACKEND", "sqlite")
+    markers = SqliteCache("cancellations", 60, 100, path=str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(RunRegistry, "get_markers", staticmethod(lambda: markers))
+
+    async def scenario():
+        worker, other_worker = RunRegistry(), RunRegistry()
+        run = other_worker.register("s1")
+        try:
+            assert not await other_worker.is_cancelled_elsewhere(run)
+            assert await worker.cancel("s1") == 0
+            assert await other_worker.is_cancelled_elsewhere(run)
+            # a marker left for an earlier run of the session does not stop the next one
+            await asyncio.sleep(0.01)
+            assert not await other_worker.is_cancelled_elsewhere(other_worker.register("s1"))
+            # polling is not a cache lookup
+            assert markers.stats.as_dict()["hits"] == markers.stats.as_dict()["misses"] == 0
+        finally:
+            await markers.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_runs_are_only_cancelled_locally_without_a_shared_cache(monkeypatch):
+    monkeypatch.setattr(config, "WORKERS", 2)
+    monkeypatch.setattr(config, "CACHE_BACKEND", "memory")
+
+    async def scenario():
+        worker = RunRegistry()
+        run = worker.register("s1")
+        assert not RunRegistry.shares_cancellations()
+        assert await worker.cancel("s1") == 1
+        assert run.cancelled.is_set() and run.reason == "cancel_request"
+        assert await RunRegistry.get_markers().peek("s1") is None
+        assert not await worker.is_cancelled_elsewhere(run)
+
+    asyncio.run(scenario())
@@ -0,0 +1,121 @@
+import asyncio
+import operator
+from typing import Annotated, TypedDict
+
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import StateGraph
+
+import config
+from agents.master import Master
+from checkpoints.checkpoints import SqliteCheckpointStore
+
+
+class State(TypedDict):
+    items: Annotated[list, operator.add]
+    note: str
+
+
+def build_graph(checkpointer):
+    workflow = StateGraph(State)
+    workflow.add_node("answer", lambda state: {"items": ["answer"]})
+    workflow.set_entry_point("answer")
+    workflow.set_finish_point("answer")
+    return workflow.compile(checkpointer=checkpointer)
+
+
+async def blob_versions(store: SqliteCheckpointStore, channel: str) -> int:
+    async with store.connections[0].execute("SELECT count(*) FROM checkpoint_blobs WHERE channel = ?",
+                                            (channel,)) as cursor:
+        (count,) = await cursor.fetchone()
+    return count
+
+
+async def count_checkpoints(store: SqliteCheckpointStore, thread_id: str) -> int:
+    async with store.connections[0].execute("SELECT count(*) FROM checkpoints WHERE thread_id = ?",
+                                            (thread_id,)) as cursor:
+        (count,) = await cursor.fetchone()
+    return count
+
+
+def test_unchanged_channels_are_written_once(tmp_path):
+    async def scenario():
+        store = SqliteCheckpointStore(path=str(tmp_path / "checkpoints.sqlite"), readers=1)
+        graph = build_graph(await store.open())
+        thread = {"configurable": {"thread_id": "t1"}}
+        try:
+            await graph.ainvoke({"items": ["question"], "note": "kept"}, thread)
+            await graph.ainvoke({"items": ["follow up"]}, thread)
+
+            assert await blob_versions(store, "note") == 1
+            assert await blob_versions(store, "items") > 1
+            state = await graph.aget_state(thread)
+            assert state.values == {"items": ["question", "answer", "follow up", "answer"], "note": "kept"}
+            # every checkpoint still reads back with all of its channel values
+            history = [snapshot async for snapshot in graph.aget_state_history(thread)]
+            assert all(snapshot.values.get("note") == "kept" for snapshot in history[:-1])
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_compaction_keeps_the_last_checkpoints_and_their_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "CHECKPOINT_KEEP_LAST", 1)
+
+    async def scenario():
+        store = SqliteCheckpointStore(path=str(tmp_path / "checkpoints.sqlite"), readers=1)
+        graph = build_graph(await store.open())
+        thread = {"configurable": {"thread_id": "t1"}}
+        try:
+            await graph.ainvoke({"items": ["question"], "note": "kept"}, thread)
+            await graph.ainvoke({"items": ["follow up"]}, thread)
+            items_versions = await blob_versions(store, "items")
+
+            pruned = await store.compact()
+            assert pruned["keep_last"] > 0
+            assert pruned["stale_blobs"] > 0
+            assert pruned["idle_session"] == 0
+            assert await count_checkpoints(store, "t1") == 1
+            assert await blob_versions(store, "items") < items_versions
+            state = await graph.aget_state(thread)
+            assert state.values == {"items": ["question", "answer", "follow up", "answer"], "note": "kept"}
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_compaction_deletes_idle_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "CHECKPOINT_SESSION_TTL_SECONDS", -60)
+
+    async def scenario():
+        store = SqliteCheckpointStore(path=str(tmp_path / "checkpoints.sqlite"), readers=1)
+        graph = build_graph(await store.open())
+        thread = {"configurable": {"thread_id": "t1"}}
+        try:
+            await graph.ainvoke({"items": ["question"], "note": "kept"}, thread)
+            pruned = await store.compact()
+            assert pruned["idle_session"] > 0
+            assert await count_checkpoints(store, "t1") == 0
+            assert await blob_versions(store, "note") == 0
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_conversations_keep_their_whole_history(monkeypatch):
+    monkeypatch.setattr(config, "MASTER_HISTORY_MAX_MESSAGES", 2)
+
+    async def scenario():
+        graph = Master(MemorySaver()).get_agent()
+        thread = {"configurable": {"thread_id": "t1"}}
+        for turn in range(3):
+            await graph.ainvoke({"messages": [HumanMessage(content=f"hi, I am user {turn}")]}, thread)
+        return (await graph.aget_state(thread)).values["messages"]
+
+    # only the prompts look at the last MASTER_HISTORY_MAX_MESSAGES messages
+    messages = asyncio.run(scenario())
+    assert [msg.content for msg in messages[::2]] == [f"hi, I am user {turn}" for turn in range(3)]
+    assert len(messages) == 6
@@ -0,0 +1,43 @@
+from agents.websearchagent.context import dedupe_results, estimate_tokens, normalize_url, select_context
+from schemas import SearchResult, SingleStepResults
+
+FOX = "the quick brown fox jumps over the lazy dog near the river bank on a sunny afternoon"
+
+
+def test_normalize_url_ignores_case_www_and_trailing_slash():
+    assert normalize_url("https://WWW.Example.com/Page/") == normalize_url("http://example.com/page")
+    assert normalize_url("https://example.com/page?id=1") != normalize_url("https://example.com/page?id=2")
+
+
+def test_dedupe_drops_same_urls_and_near_duplicate_content():
+    results = [
+        (0, SearchResult(url="https://example.com/a", content=FOX)),
+        (0, SearchResult(url="https://www.example.com/a/", content="something else entirely")),
+        (1, SearchResult(url="https://mirror.org/a", content=FOX + " today")),
+        (1, SearchResult(url="https://other.org/b", content="a different passage about cooking pasta at home")),
+    ]
+    kept = dedupe_results(results)
+    assert [result.url for _, result in kept] == ["https://example.com/a", "https://other.org/b"]
+
+
+def test_select_context_keeps_the_most_relevant_results_within_the_budget():
+    steps = [
+        SingleStepResults(step="step one", results=[
+            SearchResult(url="https://a.org", content="pasta recipes and cooking times " * 5),
+            SearchResult(url="https://b.org", content="the history of the river bank fox " * 5),
+        ]),
+        SingleStepResults(step="step two", results=[
+            SearchResult(url="https://c.org", content="fox population near the river " * 5),
+        ]),
+    ]
+    overhead = sum(estimate_tokens(f"Step: {x.step}\n Context: ") for x in steps)
+    budget = overhead + estimate_tokens(str(steps[0].results[1])) + estimate_tokens(str(steps[1].results[0]))
+
+    selected = select_context(steps, "fox near the river", budget)
+    assert [x.step for x in selected] == ["step one", "step two"]
+    assert [result.url for result in selected[0].results] == ["https://b.org"]
+    assert [result.url for result in selected[1].results] == ["https://c.org"]
+
+    everything = select_context(steps, "fox near the river", 10000)
+    # inside a step the results are ordered by relevance
+    assert [result.url for result in everything[0].results] == ["https://b.org", "https://a.org"]
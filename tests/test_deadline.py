@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+import config
+from agents.master import REPLY_TIMEOUT_MESSAGE, SMALLTALK_PROMPT, ChatState, reply
+from deadline.deadline import LatencyTracker, answer_budget, first_chunk_within, hedged, is_expired, stage_budget
+from llm.fake import FakeChatModel
+
+
+def deadline_in(seconds: float) -> dict:
+    return {"configurable": {"deadline": time.time() + seconds}}
+
+
+def test_stage_budget_keeps_the_answer_reserve(monkeypatch):
+    monkeypatch.setattr(config, "DEADLINE_ANSWER_RESERVE_SECONDS", 10)
+    assert stage_budget({}, 5) == 5
+    assert stage_budget(deadline_in(30), 5) == 5
+    assert 11 < stage_budget(deadline_in(22), 30) <= 12
+    assert 11 < stage_budget(deadline_in(22), None) <= 12
+    assert stage_budget(deadline_in(5), 30) == 0
+    assert is_expired(deadline_in(5), "step_executor")
+    assert not is_expired(deadline_in(30), "step_executor")
+
+
+def test_answer_budget_includes_the_reserve(monkeypatch):
+    monkeypatch.setattr(config, "DEADLINE_ANSWER_RESERVE_SECONDS", 10)
+    assert answer_budget({}) is None
+    assert 4 < answer_budget(deadline_in(5)) <= 5
+    assert answer_budget(deadline_in(-1)) == 0
+
+
+async def chunks(first_after: float, then: float, count: int = 3):
+    await asyncio.sleep(first_after)
+    for idx in range(count):
+        yield idx
+        await asyncio.sleep(then)
+
+
+def test_first_chunk_within_only_bounds_the_start():
+    async def scenario():
+        # the whole stream takes longer than the timeout, it is not cut once started
+        assert [chunk async for chunk in first_chunk_within(chunks(0, 0.03), 0.02)] == [0, 1, 2]
+        with pytest.raises(asyncio.TimeoutError):
+            [chunk async for chunk in first_chunk_within(chunks(0.05, 0), 0.01)]
+        assert [chunk async for chunk in first_chunk_within(chunks(0, 0, count=0), 0.01)] == []
+
+    asyncio.run(scenario())
+
+
+def test_hedged_races_a_slow_call(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "HEDGE_MIN_SAMPLES", 2)
+    tracker = LatencyTracker("test")
+    latencies = [0.5, 0.01]
+
+    async def call():
+        latency = latencies.pop(0)
+        await asyncio.sleep(latency)
+        return latency
+
+    async def scenario():
+        # not enough samples yet, no hedging
+        assert await hedged(lambda: asyncio.sleep(0, "first"), tracker) == "first"
+        tracker.observe(0.01)
+        started = time.perf_counter()
+        assert await hedged(call, tracker) == 0.01
+        assert time.perf_counter() - started < 0.2
+
+    asyncio.run(scenario())
+
+
+def test_hedged_raises_when_every_attempt_failed(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "HEDGE_MIN_SAMPLES", 1)
+    tracker = LatencyTracker("test")
+    tracker.observe(0.001)
+
+    async def call():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        asyncio.run(hedged(call, tracker))
+
+
+def run_reply(model: FakeChatModel, budget: float) -> str:
+    async def node(state, config):
+        return await reply(state, config, "smalltalk", SMALLTALK_PROMPT, model)
+
+    state = ChatState(messages=[HumanMessage(content="hello")])
+    result = asyncio.run(RunnableLambda(node).ainvoke(state, deadline_in(budget)))
+    return result["messages"][-1].content
+
+
+def test_reply_that_started_in_time_is_not_cut():
+    content = run_reply(FakeChatModel(latency=0.02, tokens_per_second=100, response_tokens=20), 0.1)
+    assert len(content.split(" ")) == 20
+
+
+def test_reply_that_does_not_start_in_time_is_replaced():
+    assert run_reply(FakeChatModel(latency=0.5, response_tokens=20), 0.05) == REPLY_TIMEOUT_MESSAGE
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch.fetch
+from fetch.fetch import PageFetcher, is_public_address
+
+ARTICLE = "<html><body><nav>Home | About | Contact</nav><article><p>{}</p></article>" \
+          "<footer>copyright notice of the site</footer></body></html>"
+PARAGRAPH = "The quick brown fox jumps over the lazy dog, again and again, for the whole afternoon."
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.hosts.append(self.headers["Host"])
+        if self.path == "/article":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = ARTICLE.format(PARAGRAPH).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/article")
+            self.end_headers()
+        elif self.path == "/loop":
+            self.send_response(302)
+            self.send_header("Location", "/loop")
+            self.end_headers()
+        elif self.path == "/internal":
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.2:{self.server.server_port}/article")
+            self.end_headers()
+        elif self.path == "/image":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", "4")
+            self.end_headers()
+            self.wfile.write(b"\x89PNG")
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    httpd.requests = []
+    httpd.hosts = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_port}{path}"
+
+
+def fetch_pages(urls, **kwargs):
+    async def run():
+        fetcher = PageFetcher(**kwargs)
+        try:
+            pages = await fetcher.fetch_pages(urls, budget=5)
+            assert fetcher._host_slots == {}
+            return pages
+        finally:
+            await fetcher.aclose()
+
+    return asyncio.run(run())
+
+
+def test_extracts_the_main_text(server):
+    pages = fetch_pages([url(server, "/article")], allow_private_addresses=True)
+    page = pages[url(server, "/article")]
+    assert page.chunks == [PARAGRAPH]
+    assert page.etag == '"v1"'
+
+
+def test_follows_redirects_and_skips_other_content(server):
+    pages = fetch_pages([url(server, "/redirect"), url(server, "/image"), url(server, "/missing")],
+                        allow_private_addresses=True)
+    assert list(pages) == [url(server, "/redirect")]
+    assert "/article" in server.requests
+
+
+def test_gives_up_on_redirect_loops(server):
+    assert fetch_pages([url(server, "/loop")], allow_private_addresses=True, max_redirects=3) == {}
+    assert server.requests.count("/loop") == 4
+
+
+def test_never_fetches_private_addresses(server):
+    assert fetch_pages([url(server, "/article")]) == {}
+    assert server.requests == []
+
+
+def test_checks_every_redirect_hop(server, monkeypatch):
+    # the fixture server counts as public, the address it redirects to does not
+    monkeypatch.setattr(fetch.fetch, "is_public_address", lambda address: address == "127.0.0.1")
+    assert fetch_pages([url(server, "/internal")]) == {}
+    assert server.requests == ["/internal"]
+
+
+@pytest.mark.parametrize("address, public", [
+    ("93.184.216.34", True),
+    ("127.0.0.1", False),
+    ("10.1.2.3", False),
+    ("192.168.0.1", False),
+    ("169.254.169.254", False),
+    ("::1", False),
+    ("fe80::1%eth0", False),
+    ("::ffff:127.0.0.1", False),
+    ("2606:4700:4700::1111", True),
+])
+def test_public_addresses(address, public):
+    assert is_public_address(address) is public
+
+
+def test_rejects_other_schemes():
+    assert not PageFetcher.is_allowed("file:///etc/passwd")
+    assert not PageFetcher.is_allowed("ftp://example.com/")
+    assert PageFetcher.is_allowed("https://example.com/")
+
+
+def resolve_to(monkeypatch, addresses):
+    lookups = []
+
+    async def resolve(host, port):
+        lookups.append(host)
+        return addresses
+
+    monkeypatch.setattr(fetch.fetch, "resolve", resolve)
+    monkeypatch.setattr(fetch.fetch, "is_public_address", lambda address: address == "127.0.0.1")
+    return lookups
+
+
+def test_connects_to_the_checked_address_with_the_original_host(server, monkeypatch):
+    lookups = resolve_to(monkeypatch, ["127.0.0.1"])
+    page_url = f"http://pages.test:{server.server_port}/article"
+    assert list(fetch_pages([page_url])) == [page_url]
+    # resolved once, by the connection itself
+    assert lookups == ["pages.test"]
+    assert server.hosts == [f"pages.test:{server.server_port}"]
+
+
+def test_never_connects_when_any_address_is_internal(server, monkeypatch):
+    resolve_to(monkeypatch, ["127.0.0.1", "10.0.0.1"])
+    assert fetch_pages([f"http://pages.test:{server.server_port}/article"]) == {}
+    assert server.requests == []
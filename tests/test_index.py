@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import config
+from index.index import PassageIndex, coverage, query_terms, run_pruning
+from schemas import SearchResult
+
+PASSAGES = [
+    "LangGraph is a library for building stateful agents with large language models.",
+    "Agents built with LangGraph keep their state in checkpoints between the steps of a graph.",
+    "The LangGraph library models an agent as a graph of nodes that share a state.",
+    "Python is a programming language that is popular for data science.",
+]
+
+
+def results(*contents):
+    return [SearchResult(url=f"https://example.com/{idx}", content=content) for idx, content in enumerate(contents)]
+
+
+async def count_passages(index: PassageIndex) -> int:
+    conn = await index._get_conn()
+    async with conn.execute("SELECT count(*) FROM passages") as cursor:
+        (count,) = await cursor.fetchone()
+    return count
+
+
+@pytest.fixture
+def open_index(tmp_path):
+    def run(scenario, **kwargs):
+        async def main():
+            index = PassageIndex(path=str(tmp_path / "passages.sqlite"), **kwargs)
+            try:
+                return await scenario(index)
+            finally:
+                await index.aclose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_coverage_of_the_query_terms():
+    terms = query_terms("What is the LangGraph library?")
+    assert terms == ["langgraph", "library"]
+    assert coverage(terms, PASSAGES[0]) == 1.0
+    assert coverage(terms, PASSAGES[1]) == 0.5
+    # plurals count for the singular
+    assert coverage(query_terms("langgraph agent"), "agents built with langgraph") == 1.0
+
+
+def test_search_needs_enough_covering_passages(open_index, monkeypatch):
+    monkeypatch.setattr(config, "PASSAGE_INDEX_MIN_RESULTS", 2)
+    monkeypatch.setattr(config, "PASSAGE_INDEX_MIN_COVERAGE", 0.75)
+
+    async def scenario(index):
+        await index.add(results(*PASSAGES))
+        hits = await index.search("langgraph library")
+        # the second passage only covers half of the terms
+        misses = await index.search("langgraph state checkpoints steps")
+        return hits, misses
+
+    hits, misses = open_index(scenario)
+    assert sorted(hit.content for hit in hits) == sorted([PASSAGES[0], PASSAGES[2]])
+    assert misses is None
+
+
+def test_expired_passages_are_not_served_and_pruned(open_index, monkeypatch):
+    monkeypatch.setattr(config, "PASSAGE_INDEX_MIN_RESULTS", 1)
+
+    async def scenario(index):
+        await index.add(results(*PASSAGES))
+        await asyncio.sleep(0.05)
+        index.ttl_seconds = 0.01
+        assert await index.search("langgraph library") is None
+        await index.prune()
+        return await count_passages(index)
+
+    assert open_index(scenario) == 0
+
+
+def test_prune_keeps_the_newest_passages(open_index):
+    async def scenario(index):
+        for content in PASSAGES:
+            await index.add(results(content))
+            await asyncio.sleep(0.01)
+        await index.prune()
+        conn = await index._get_conn()
+        async with conn.execute("SELECT content FROM passages") as cursor:
+            return sorted(content for (content,) in await cursor.fetchall())
+
+    assert open_index(scenario, max_passages=2) == sorted(PASSAGES[2:])
+
+
+def test_inserts_prune_in_the_background(open_index):
+    async def scenario(index):
+        await index.add(results(*PASSAGES))
+        assert index._prune_task is not None
+        await index._prune_task
+        return await count_passages(index)
+
+    # prune_every is a tenth of max_passages, at least one insert
+    assert open_index(scenario, max_passages=2) == 2
+
+
+def test_pruning_runs_on_a_timer(open_index):
+    async def scenario(index):
+        index.prune_every = 100
+        await index.add(results(*PASSAGES))
+        assert index._prune_task is None
+        pruning = asyncio.create_task(run_pruning(index, 0.01))
+        await asyncio.sleep(0.1)
+        pruning.cancel()
+        await asyncio.gather(pruning, return_exceptions=True)
+        return await count_passages(index)
+
+    assert open_index(scenario, max_passages=3) == 3
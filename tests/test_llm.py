@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+import config
+from llm.fake import FakeChatModel
+from llm.llm import LLMFactory
+
+
+class FailingChatModel(FakeChatModel):
+    error: type = asyncio.TimeoutError
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise self.error()
+
+
+@pytest.fixture
+def models(monkeypatch):
+    monkeypatch.setattr(LLMFactory, "_clients", {})
+    monkeypatch.setattr(LLMFactory, "_routed", {})
+    monkeypatch.setattr(config, "DEFAULT_MODEL", "default")
+    monkeypatch.setattr(config, "NODE_MODELS", {"generate_plan": "small"})
+    monkeypatch.setattr(config, "MODEL_FALLBACKS", {"default": ["small", "default"]})
+    return LLMFactory._clients
+
+
+def test_node_policy_wins_over_the_requested_and_the_default_model(models):
+    factory = LLMFactory()
+    requested = {"configurable": {"model": "requested"}}
+    assert factory.model_for_node("generate_plan", requested) == "small"
+    assert factory.model_for_node("chat_response", requested) == "requested"
+    assert factory.model_for_node("chat_response") == "default"
+    assert factory.get_llm_for_node("generate_plan").model_name == "small"
+    assert LLMFactory.configured_models() == ["default", "small"]
+
+
+def test_clients_are_shared_by_model(models):
+    assert LLMFactory().get_llm_by_name("small") is LLMFactory().get_llm_by_name("small")
+    assert LLMFactory().get_client("default") is models["default"]
+
+
+def test_fallback_answers_when_the_model_times_out(models):
+    models["default"] = FailingChatModel(model_name="default")
+    llm = LLMFactory().get_llm_by_name("default")
+    # the model itself is never its own fallback
+    assert [fallback.model_name for fallback in llm.fallbacks] == ["small"]
+
+    answer = asyncio.run(llm.ainvoke("what is langgraph"))
+    assert answer.content.startswith("word0-")
+
+
+def test_other_errors_are_not_retried_on_the_fallback(models):
+    models["default"] = FailingChatModel(model_name="default", error=ValueError)
+    with pytest.raises(ValueError):
+        asyncio.run(LLMFactory().get_llm_by_name("default").ainvoke("what is langgraph"))
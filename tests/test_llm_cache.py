@@ -0,0 +1,98 @@
+import asyncio
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from cache.cache import InMemoryCache
+from llm.cache import LLMResponseCache, SemanticIndex
+from llm.fake import FakeChatModel
+from schemas import QueryPlan
+
+
+class CountingChatModel(FakeChatModel):
+    calls: int = 0
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+
+class KeywordEmbeddings(Embeddings):
+    """Prompts mentioning the same keywords embed to the same vector."""
+
+    keywords = ("langgraph", "weather", "python")
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(keyword in text.lower()) for keyword in self.keywords]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+def response_cache(mode: str) -> LLMResponseCache:
+    cache = LLMResponseCache(mode)
+    cache.cache = InMemoryCache("llm", 60, 10)
+    if mode == "semantic":
+        cache.embeddings = KeywordEmbeddings()
+    return cache
+
+
+def test_exact_hit_skips_the_model():
+    async def scenario():
+        cache, llm = response_cache("exact"), CountingChatModel(response_tokens=3)
+        first = await cache.ainvoke(llm, "what is langgraph")
+        assert await cache.ainvoke(llm, "what is langgraph") == first
+        assert llm.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_cache_key_covers_model_schema_and_prompt():
+    async def scenario():
+        cache = response_cache("exact")
+        llm, other_llm = CountingChatModel(), CountingChatModel(model_name="other")
+        assert isinstance(await cache.ainvoke(llm, "plan langgraph"), str)
+        # the same prompt with a schema is a different entry, it comes back as the schema
+        assert isinstance(await cache.ainvoke(llm, "plan langgraph", QueryPlan), QueryPlan)
+        await cache.ainvoke(other_llm, "plan langgraph")
+        await cache.ainvoke(llm, "plan python")
+        await cache.ainvoke(llm, "plan langgraph")
+        assert (llm.calls, other_llm.calls) == (2, 1)
+
+    asyncio.run(scenario())
+
+
+def test_semantic_hit_reuses_a_similar_prompt():
+    async def scenario():
+        cache, llm = response_cache("semantic"), CountingChatModel()
+        first = await cache.ainvoke(llm, "What is LangGraph?")
+        assert await cache.ainvoke(llm, "tell me about langgraph") == first
+        assert await cache.ainvoke(llm, "what is the weather") != first
+        assert llm.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_semantic_index_threshold_and_namespace():
+    async def scenario():
+        index = SemanticIndex(max_size=2)
+        index.add("model:str", "a", [1.0, 0.0])
+        index.add("model:str", "b", [0.6, 0.8])
+        assert await index.search("model:str", [2.0, 0.1], 0.9) == "a"
+        assert await index.search("model:str", [0.0, 1.0], 0.9) is None
+        assert await index.search("model:QueryPlan", [1.0, 0.0], 0.9) is None
+        # the oldest prompt is dropped past max_size
+        index.add("model:str", "c", [0.0, 1.0])
+        assert await index.search("model:str", [1.0, 0.0], 0.9) is None
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_identical_prompts_share_one_call():
+    async def scenario():
+        cache, llm = response_cache("exact"), CountingChatModel(latency=0.05)
+        responses = await asyncio.gather(*(cache.ainvoke(llm, "what is langgraph") for _ in range(3)))
+        assert len(set(responses)) == 1
+        assert llm.calls == 1
+
+    asyncio.run(scenario())
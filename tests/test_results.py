@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from cache.cache import InMemoryCache
+from metrics.metrics import RESULT_STORE_MISSING
+from results.results import ResultsMissingError, ResultStore
+from schemas import SearchResult, SingleStepResults
+
+
+def step_results(step: str, *contents) -> SingleStepResults:
+    return SingleStepResults(step=step, results=[SearchResult(url=f"https://example.com/{content}", content=content)
+                                                 for content in contents])
+
+
+def test_identical_results_are_stored_once():
+    async def scenario():
+        store = ResultStore(InMemoryCache("results", 60, 10))
+        ref = await store.put(step_results("what is langgraph", "a", "b"))
+        assert ref.result_count == 2
+        assert (await store.put(step_results("what is langgraph", "a", "b"))).ref == ref.ref
+        assert (await store.put(step_results("what is langgraph", "a"))).ref != ref.ref
+        assert len(store.cache._entries) == 2
+        assert await store.get(ref) == step_results("what is langgraph", "a", "b")
+
+    asyncio.run(scenario())
+
+
+def test_missing_results_raise():
+    async def scenario():
+        store = ResultStore(InMemoryCache("results", 60, 1))
+        first = await store.put(step_results("first", "a"))
+        # evicted by the next put
+        await store.put(step_results("second", "b"))
+        before = RESULT_STORE_MISSING.values[()]
+        with pytest.raises(ResultsMissingError):
+            await store.get_many([first])
+        assert RESULT_STORE_MISSING.values[()] == before + 1
+
+    asyncio.run(scenario())
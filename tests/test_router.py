@@ -0,0 +1,28 @@
+import pytest
+
+from agents.router import SMALLTALK, WEBSEARCH, KeywordRouter, LLMRouter
+
+
+@pytest.mark.parametrize("message, route", [
+    ("Hi!", SMALLTALK),
+    ("  thank   you ", SMALLTALK),
+    ("good morning ross", SMALLTALK),
+    ("how are you", SMALLTALK),
+    ("latest news about the elections", WEBSEARCH),
+    ("weather in paris tomorrow", WEBSEARCH),
+    ("who won the world cup in 2018", WEBSEARCH),
+    ("What is the capital of Australia?", WEBSEARCH),
+    ("hey, can you search the price of bitcoin for me please", WEBSEARCH),
+    # conversation, left to the master llm
+    ("what can you do", None),
+    ("who are you and who built you", None),
+    ("tell me a joke", None),
+    ("why", None),
+    ("", None),
+])
+def test_keyword_router(message, route):
+    assert KeywordRouter().classify(message) == route
+
+
+def test_llm_router_leaves_every_decision_to_the_llm():
+    assert LLMRouter().classify("hi") is None
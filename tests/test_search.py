@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from tavily import InvalidAPIKeyError, UsageLimitExceededError
+
+import config
+import search.search as search
+from metrics.metrics import SEARCH_QUERIES
+from schemas import SearchResult
+
+
+class SlowSearchProvider(search.SearchProvider):
+    def __init__(self, latencies: dict):
+        self.latencies = latencies
+        self.queries = []
+        self.running = self.max_running = 0
+
+    async def search(self, query):
+        self.queries.append(query)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.latencies.get(query, 0))
+        finally:
+            self.running -= 1
+        return [SearchResult(url=f"https://example.com/{query}", content=query)]
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    def use(latencies: dict):
+        provider = SlowSearchProvider(latencies)
+        monkeypatch.setattr(search, "_provider", provider)
+        return provider
+
+    monkeypatch.setattr(search, "_semaphore", None)
+    monkeypatch.setattr(config, "SEARCH_CACHE_ENABLED", False)
+    monkeypatch.setattr(config, "HEDGE_ENABLED", False)
+    return use
+
+
+def tavily(handler) -> search.TavilySearchProvider:
+    provider = search.TavilySearchProvider(api_key="key", max_results=2)
+    provider.client = httpx.AsyncClient(base_url=provider.base_url, transport=httpx.MockTransport(handler))
+    return provider
+
+
+def test_tavily_provider_posts_the_query():
+    def handler(request: httpx.Request):
+        body = json.loads(request.content)
+        assert request.url.path == "/search"
+        assert (body["api_key"], body["query"], body["max_results"]) == ("key", "langgraph", 2)
+        return httpx.Response(200, json={"results": [{"url": "https://a.com", "content": "a", "score": 1}]})
+
+    async def scenario():
+        provider = tavily(handler)
+        try:
+            assert await provider.search("langgraph") == [SearchResult(url="https://a.com", content="a")]
+        finally:
+            await provider.aclose()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("status, error", [(429, UsageLimitExceededError), (401, InvalidAPIKeyError),
+                                           (500, httpx.HTTPStatusError)])
+def test_tavily_provider_errors(status, error):
+    async def scenario():
+        provider = tavily(lambda request: httpx.Response(status, json={}))
+        try:
+            with pytest.raises(error):
+                await provider.search("langgraph")
+        finally:
+            await provider.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_fake_provider_is_deterministic():
+    async def scenario():
+        provider = search.FakeSearchProvider(max_results=3)
+        first, second = await provider.search("query"), await provider.search("query")
+        assert first == second and len(first) == 3
+        assert first != await provider.search("other query")
+
+    asyncio.run(scenario())
+
+
+def test_iter_search_queries_yields_in_completion_order(provider):
+    provider({"slow": 0.05, "medium": 0.02, "fast": 0})
+
+    async def scenario():
+        return [query async for query, _ in search.iter_search_queries(["slow", "medium", "fast", "Fast?"])]
+
+    # a query that normalizes to one already issued is searched once
+    assert asyncio.run(scenario()) == ["fast", "medium", "slow"]
+
+
+def test_iter_search_queries_reuses_in_flight_searches(provider):
+    searches = provider({"speculative": 0.02})
+
+    async def scenario():
+        in_flight = {"Speculative": asyncio.ensure_future(search.search_query("speculative"))}
+        return [query async for query, _ in search.iter_search_queries(["speculative", "other"], in_flight=in_flight)]
+
+    assert sorted(asyncio.run(scenario())) == ["Speculative", "other"]
+    assert sorted(searches.queries) == ["other", "speculative"]
+
+
+def test_iter_search_queries_respects_the_concurrency_limit(provider, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_MAX_CONCURRENCY", 2)
+    searches = provider({f"query {idx}": 0.01 for idx in range(6)})
+
+    async def scenario():
+        return [query async for query, _ in search.iter_search_queries([f"query {idx}" for idx in range(6)])]
+
+    assert len(asyncio.run(scenario())) == 6
+    assert searches.max_running == 2
+
+
+def test_timed_out_search_is_counted_once(provider):
+    provider({"slow": 1})
+    before = SEARCH_QUERIES.values[(("outcome", "timeout"),)]
+
+    assert asyncio.run(search.search_query("slow", timeout=0.01)) == []
+    assert SEARCH_QUERIES.values[(("outcome", "timeout"),)] == before + 1
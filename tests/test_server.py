@@ -0,0 +1,222 @@
+import asyncio
+import json
+import signal
+import socket
+
+import httpx
+import pytest
+import uvicorn
+from langgraph.checkpoint.memory import MemorySaver
+from sse_starlette.sse import AppStatus
+
+import config
+from agents.master import Master
+from metrics.metrics import ANSWER_CACHE_LOOKUPS
+from runtime import get_runtime
+from schemas import SearchResult
+from server import app, run_event_stream, sources_event
+
+
+class ConnectedRequest:
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+async def collect_events(query: str, session_id: str) -> list:
+    return [(event.event, event.data) async for event in run_event_stream(query, ConnectedRequest(), session_id)]
+
+
+def with_master_agent(scenario):
+    async def main():
+        runtime = get_runtime()
+        runtime.master_agent = Master(MemorySaver()).get_agent()
+        try:
+            return await scenario(runtime.master_agent)
+        finally:
+            runtime.master_agent = None
+            await runtime.stop()
+
+    return asyncio.run(main())
+
+
+def stream_events(query: str, session_id: str) -> list:
+    return with_master_agent(lambda agent: collect_events(query, session_id))
+
+
+def test_stream_merges_answer_tokens(monkeypatch):
+    monkeypatch.setattr(config, "STREAM_FLUSH_INTERVAL_SECONDS", 0.2)
+    events = stream_events("who founded the company number 11", "flush")
+
+    answers = [json.loads(data)["search_result"] for event, data in events if event == "assistant"]
+    # 50 tokens streamed over about a second, sent in a handful of batches instead of one event per token
+    assert 1 < len(answers) <= 10
+    assert len("".join(answers).split(" ")) == 50
+
+
+def test_stream_only_sends_progress_events():
+    events = stream_events("who founded the company number 12", "filter")
+
+    assert {event for event, _ in events} == {"thoughts", "sources", "assistant_msg_start", "assistant", "end"}
+    messages = [json.loads(data)["message"] for event, data in events if event == "thoughts"]
+    assert messages == ["Understanding query", "Searching the Internet"]
+    assert events[-1][0] == "end"
+
+
+def test_sources_event_payload(monkeypatch):
+    monkeypatch.setattr(config, "SOURCE_SNIPPET_MAX_CHARS", 5)
+    event = sources_event({"step_id": 1, "step": "step", "query": "query",
+                           "results": [SearchResult(url="https://a.com", content="0123456789")]}, "s1")
+
+    assert event.event == "sources"
+    assert json.loads(event.data) == {"message": "Found sources", "step_id": 1, "step": "step", "query": "query",
+                                      "results": [{"url": "https://a.com", "content": "01234"}], "session_id": "s1"}
+
+
+def test_stream_sends_the_sources_of_every_query():
+    events = stream_events("who founded the company number 13", "sources")
+
+    sources = [json.loads(data) for event, data in events if event == "sources"]
+    assert [(source["step_id"], source["query"]) for source in sources] == [(0, "who founded the company number 13")]
+    assert sources[0]["results"] and set(sources[0]["results"][0]) == {"url", "content"}
+    # the sources come before the answer
+    assert [event for event, _ in events].index("sources") < [event for event, _ in events].index("assistant")
+
+
+def test_repeated_question_is_replayed_before_the_graph_runs():
+    query = "who founded the company number 14"
+
+    async def scenario(agent):
+        misses = ANSWER_CACHE_LOOKUPS.values[(("outcome", "miss"),)]
+        first = await collect_events(query, "replay-1")
+        # looked up once, before the graph ran
+        assert ANSWER_CACHE_LOOKUPS.values[(("outcome", "miss"),)] == misses + 1
+        replayed = await collect_events(query, "replay-2")
+        state = await agent.aget_state({"configurable": {"thread_id": "replay-2"}})
+        return first, replayed, state.values["messages"]
+
+    first, replayed, messages = with_master_agent(scenario)
+    thoughts = [json.loads(data) for event, data in replayed if event == "thoughts"]
+    # no query rewrite, plan or search, only what the first run showed
+    assert [(thought["message"], thought.get("cached")) for thought in thoughts] == [("Generated plan", True)]
+    assert [event for event, _ in replayed] == ["thoughts", "sources", "assistant_msg_start", "assistant", "end"]
+
+    def answer(events):
+        return "".join(json.loads(data)["search_result"] for event, data in events if event == "assistant")
+
+    assert answer(replayed) == answer(first)
+    # the replayed turn is part of the conversation
+    assert [msg.content for msg in messages] == [query, answer(first)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve(scenario):
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            await scenario(client, server)
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+@pytest.fixture
+def run_server():
+    # the exit flag of sse_starlette is process wide, and its event belongs to the loop of the test
+    AppStatus.should_exit, AppStatus.should_exit_event = False, None
+    yield lambda scenario: asyncio.run(serve(scenario))
+    AppStatus.should_exit, AppStatus.should_exit_event = False, None
+
+
+async def read_events(resp: httpx.Response, events: list, on_event=None):
+    event = None
+    async for line in resp.aiter_lines():
+        if line.startswith("event:"):
+            event = line.removeprefix("event:").strip()
+        elif line.startswith("data:"):
+            if on_event is not None:
+                await on_event(event, line.removeprefix("data:").strip())
+            events.append(event)
+
+
+def shutdown_during_stream(run_server, query: str) -> list:
+    events = []
+
+    async def scenario(client, server):
+        async def on_event(event, data):
+            if event == "thoughts" and not events:
+                # what uvicorn does on SIGTERM
+                server.handle_exit(signal.SIGTERM, None)
+
+        async with client.stream("GET", "/stream", params={"query": query, "session_id": "drain"}) as resp:
+            try:
+                await read_events(resp, events, on_event)
+            except httpx.RemoteProtocolError:
+                # the stream was cut
+                pass
+
+    # uvicorn raises the signal again once it has shut down
+    previous_handler = signal.signal(signal.SIGTERM, lambda *args: None)
+    try:
+        run_server(scenario)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+    return events
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_cancel_without_a_run_is_not_found(run_server, monkeypatch, workers):
+    # several workers with the in-memory cache can not cancel each other's runs
+    monkeypatch.setattr(config, "WORKERS", workers)
+
+    async def scenario(client, server):
+        resp = await client.post("/sessions/nobody/cancel")
+        assert resp.status_code == 404
+
+    run_server(scenario)
+
+
+def test_cancel_stops_the_running_stream(run_server):
+    events = []
+
+    async def scenario(client, server):
+        async def on_event(event, data):
+            if event == "thoughts" and not events:
+                cancel = await client.post("/sessions/s1/cancel")
+                assert cancel.json() == {"session_id": "s1", "cancelled_runs": 1}
+            if event == "cancelled":
+                assert json.loads(data) == {"reason": "cancel_request", "session_id": "s1"}
+
+        async with client.stream("GET", "/stream", params={"query": "compare the history of rome and athens",
+                                                           "session_id": "s1"}) as resp:
+            await read_events(resp, events, on_event)
+
+        # the run is gone, and its admission slot is free again
+        assert (await client.post("/sessions/s1/cancel")).status_code == 404
+        assert (await client.get("/admission/stats")).json()["in_flight"] == 0
+
+    run_server(scenario)
+    assert "cancelled" in events
+    assert "assistant" not in events
+    assert events[-1] == "end"
+
+
+def test_shutdown_lets_streams_in_flight_finish(run_server, monkeypatch):
+    monkeypatch.setattr(config, "SHUTDOWN_DRAIN_SECONDS", 30)
+    events = shutdown_during_stream(run_server, "compare the history of city 21 and city 22")
+    assert "assistant" in events
+    assert events[-1] == "end"
+
+
+def test_shutdown_cuts_streams_after_the_drain(run_server, monkeypatch):
+    monkeypatch.setattr(config, "SHUTDOWN_DRAIN_SECONDS", 0.1)
+    events = shutdown_during_stream(run_server, "compare the history of city 23 and city 24")
+    assert "end" not in events
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+import agents.websearchagent.speculative as speculative
+import agents.websearchagent.websearchagent as websearchagent
+import config
+import search.search as search
+from agents.websearchagent.state import StepExecutorState
+from cache.cache import close_caches
+from metrics.metrics import SPECULATIVE_SEARCHES
+from results.results import get_result_store
+from schemas import QueryPlanStep, QueryStepExecution, SearchResult
+
+
+class RecordingSearchProvider(search.SearchProvider):
+    def __init__(self, latency: float = 0.0, error: Exception = None):
+        self.latency = latency
+        self.error = error
+        self.queries = []
+
+    async def search(self, query):
+        self.queries.append(query)
+        await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return [SearchResult(url=f"https://example.com/{query.replace(' ', '-')}", content=query)]
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    def use(**kwargs):
+        provider = RecordingSearchProvider(**kwargs)
+        monkeypatch.setattr(search, "_provider", provider)
+        return provider
+
+    monkeypatch.setattr(search, "_semaphore", None)
+    monkeypatch.setattr(config, "SEARCH_CACHE_ENABLED", False)
+    monkeypatch.setattr(config, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(config, "FETCH_PAGES", False)
+    return use
+
+
+def generated_queries(monkeypatch, queries):
+    async def fake_cached_ainvoke(llm, prompt, schema=None, runnable_config=None, timeout=None):
+        return QueryStepExecution(search_queries=queries)
+
+    monkeypatch.setattr(websearchagent, "cached_ainvoke", fake_cached_ainvoke)
+
+
+def outcomes():
+    return {outcome: SPECULATIVE_SEARCHES.values[(("outcome", outcome),)] for outcome in ("reused", "merged")}
+
+
+async def run_step(speculation_id, deadline=None):
+    state = StepExecutorState(query="what is langgraph", speculation_id=speculation_id,
+                              step=QueryPlanStep(id=0, step="what is langgraph", dependencies=[]))
+    runnable_config = {"configurable": {"thread_id": "t1", "deadline": deadline}}
+    try:
+        ref = await RunnableLambda(websearchagent.execute_step).ainvoke(state, runnable_config)
+        return [result.content for result in (await get_result_store().get(ref)).results]
+    finally:
+        await close_caches()
+
+
+def test_step_reuses_the_speculative_search(provider, monkeypatch):
+    searches = provider(latency=0.02)
+    generated_queries(monkeypatch, ["What is LangGraph?", "langgraph tutorial"])
+    before = outcomes()
+
+    async def scenario():
+        speculation_id = speculative.start_speculative_search("what is langgraph", owner="t1")
+        return await run_step(speculation_id)
+
+    assert sorted(asyncio.run(scenario())) == ["langgraph tutorial", "what is langgraph"]
+    assert sorted(searches.queries) == ["langgraph tutorial", "what is langgraph"]
+    assert outcomes()["reused"] == before["reused"] + 1
+
+
+def test_step_merges_a_speculative_search_it_did_not_generate(provider, monkeypatch):
+    searches = provider()
+    generated_queries(monkeypatch, ["langgraph tutorial"])
+    before = outcomes()
+
+    async def scenario():
+        return await run_step(speculative.start_speculative_search("what is langgraph", owner="t1"))
+
+    assert sorted(asyncio.run(scenario())) == ["langgraph tutorial", "what is langgraph"]
+    assert len(searches.queries) == 2
+    assert outcomes()["merged"] == before["merged"] + 1
+
+
+def test_expired_step_keeps_a_finished_speculative_search(provider):
+    provider()
+
+    async def scenario():
+        speculation_id = speculative.start_speculative_search("what is langgraph", owner="t1")
+        await asyncio.sleep(0.01)
+        return await run_step(speculation_id, deadline=time.time())
+
+    assert asyncio.run(scenario()) == ["what is langgraph"]
+
+
+def test_expired_step_ignores_a_failed_speculative_search(provider):
+    provider(error=RuntimeError("provider failed"))
+
+    async def scenario():
+        speculation_id = speculative.start_speculative_search("what is langgraph", owner="t1")
+        await asyncio.sleep(0.01)
+        return await run_step(speculation_id, deadline=time.time())
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_unused_speculative_search_is_cancelled_after_its_ttl(provider, monkeypatch):
+    provider(latency=1)
+    monkeypatch.setattr(config, "SPECULATIVE_SEARCH_TTL_SECONDS", 0.01)
+
+    async def scenario():
+        speculation_id = speculative.start_speculative_search("what is langgraph", owner="t1")
+        task = speculative._searches[speculation_id][1]
+        await asyncio.sleep(0.05)
+        assert task.cancelled()
+        assert speculative.take_speculative_search(speculation_id) is None
+
+    asyncio.run(scenario())
+
+
+def test_cancelling_a_session_only_cancels_the_searches_it_still_owns(provider):
+    provider(latency=1)
+
+    async def scenario():
+        taken_id = speculative.start_speculative_search("taken", owner="t1")
+        pending_id = speculative.start_speculative_search("pending", owner="t1")
+        other_id = speculative.start_speculative_search("other", owner="t2")
+        # a step that took the search owns it now, cancelling the session leaves it to the step
+        _, taken = speculative.take_speculative_search(taken_id)
+        pending = speculative._searches[pending_id][1]
+
+        speculative.cancel_speculative_searches("t1")
+        await asyncio.sleep(0)
+        assert pending.cancelled() and not taken.cancelled()
+        assert other_id in speculative._searches
+
+        taken.cancel()
+        speculative.cancel_speculative_search(other_id)
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import agents.websearchagent.websearchagent as websearchagent
+import config
+from agents.websearchagent.state import WebSearchState
+from agents.websearchagent.websearchagent import is_self_contained, is_simple_query, plan_dependencies, \
+    rephrase_query_with_history_v0
+from schemas import QueryPlan, QueryPlanStep
+
+
+def plan(*dependencies):
+    return QueryPlan(steps=[QueryPlanStep(id=idx, step=f"step {idx}", dependencies=list(deps))
+                            for idx, deps in enumerate(dependencies)])
+
+
+def test_plan_dependencies_keeps_the_steps_that_can_run():
+    assert plan_dependencies(plan([], [0], [0], [1, 2])) == {0: [], 1: [0], 2: [0], 3: [1, 2]}
+
+
+def test_plan_dependencies_ignores_self_references_and_unknown_steps():
+    assert plan_dependencies(plan([0], [0, 7])) == {0: [], 1: [0]}
+
+
+def test_plan_dependencies_drops_cycles_and_their_dependents():
+    assert plan_dependencies(plan([], [2], [1], [1])) == {0: []}
+
+
+def test_execution_mode_routing():
+    assert is_simple_query("who founded the company number 3")
+    assert not is_simple_query("compare the history and the economy of city 3 and city 4")
+    assert not is_simple_query("")
+
+
+def conversation(turns: int, question: str):
+    history = [message for idx in range(turns) for message in (HumanMessage(content=f"question {idx}"),
+                                                                 AIMessage(content=f"answer {idx}"))]
+    return WebSearchState(messages=history + [HumanMessage(content=question)])
+
+
+def rewrite(monkeypatch, state: WebSearchState):
+    prompts = []
+
+    async def fake_cached_ainvoke(llm, prompt, schema=None, runnable_config=None, timeout=None):
+        prompts.append(prompt)
+        return "rewritten question"
+
+    monkeypatch.setattr(websearchagent, "cached_ainvoke", fake_cached_ainvoke)
+    return asyncio.run(rephrase_query_with_history_v0(state, {}))["query"], prompts
+
+
+def test_is_self_contained():
+    assert is_self_contained("what is the population of berlin")
+    assert not is_self_contained("and its population?")
+    assert not is_self_contained("how old is he")
+    assert not is_self_contained("why not")
+
+
+def test_rewrite_is_skipped_on_the_first_turn(monkeypatch):
+    assert rewrite(monkeypatch, conversation(0, " how old is he ")) == ("how old is he", [])
+
+
+def test_rewrite_is_skipped_for_self_contained_questions(monkeypatch):
+    assert rewrite(monkeypatch, conversation(2, "what is the population of berlin")) == \
+           ("what is the population of berlin", [])
+    monkeypatch.setattr(config, "REWRITE_SKIP_SELF_CONTAINED", False)
+    assert rewrite(monkeypatch, conversation(2, "what is the population of berlin"))[0] == "rewritten question"
+
+
+def test_rewrite_sees_a_bounded_history_window(monkeypatch):
+    monkeypatch.setattr(config, "REWRITE_HISTORY_MAX_MESSAGES", 4)
+    question, prompts = rewrite(monkeypatch, conversation(5, "and how old is he"))
+    assert question == "rewritten question"
+    assert "question 3" in prompts[0] and "answer 4" in prompts[0]
+    assert "answer 2" not in prompts[0]